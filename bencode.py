@@ -9,9 +9,17 @@
 #             Example:
 #
 #             dictionary = fmt_bdecode({'name': str, 'age': int}, data)
+#
+# 2011-05-20: Faster decoder and cached dict key
+#             layouts. The original recursive codec is kept for reference
+#             and benchmarks: python bencode.py --bench
+#
+# 2011-05-27: fmt_bdecode() validates while decoding if the format is
+#             compiled with typevalidator.compile()
 
 from types import BooleanType, IntType, LongType, StringType, ListType, TupleType, DictType
-from typevalidator import validate
+from typevalidator import validate, compile_check, Compiled_Validator, \
+     ANY, MAX_LEN, ONE_OR_MORE, OPTIONAL_KEY, ZERO_OR_MORE
 
 def decode_bool(x, f):
     return (x[f + 1] != '0', f + 2)
@@ -78,7 +86,7 @@ decode_func['7'] = decode_string
 decode_func['8'] = decode_string
 decode_func['9'] = decode_string
 
-def bdecode(x):
+def bdecode_recursive(x):
     try:
         r, l = decode_func[x[0]](x, 0)
     except (IndexError, KeyError):
@@ -87,6 +95,122 @@ def bdecode(x):
         raise ValueError
     return r
 
+DIGITS = '0123456789'
+
+# The decoders below parse strings and integers inside lists and
+# dictionaries inline, so only containers cost a function call. One-digit
+# string lengths are parsed without slicing.
+
+def fast_decode_int(x, f):
+    f += 1
+    newf = x.index('e', f)
+    try:
+        n = int(x[f:newf])
+    except (OverflowError, ValueError):
+        n = long(x[f:newf])
+    if x[f] == '-':
+        if x[f + 1] == '0':
+            raise ValueError
+    elif x[f] == '0' and newf != f + 1:
+        raise ValueError
+    return (n, newf + 1)
+
+def fast_decode_string(x, f):
+    c = x[f]
+    if x[f + 1] == ':':
+        n = ord(c) - 48
+        f += 2
+    else:
+        colon = x.index(':', f)
+        if c == '0':
+            raise ValueError
+        n = int(x[f:colon])
+        f = colon + 1
+    return (x[f:f + n], f + n)
+
+def fast_decode_list(x, f):
+    r = []
+    f += 1
+    c = x[f]
+    while c != 'e':
+        if c in DIGITS:
+            if x[f + 1] == ':':
+                n = ord(c) - 48
+                f += 2
+            else:
+                colon = x.index(':', f)
+                if c == '0':
+                    raise ValueError
+                n = int(x[f:colon])
+                f = colon + 1
+            r.append(x[f:f + n])
+            f += n
+        else:
+            v, f = fast_decode_func[c](x, f)
+            r.append(v)
+        c = x[f]
+    return (r, f + 1)
+
+def fast_decode_dict(x, f):
+    r = {}
+    f += 1
+    lastkey = None
+    c = x[f]
+    while c != 'e':
+        if c in DIGITS:
+            if x[f + 1] == ':':
+                n = ord(c) - 48
+                f += 2
+            else:
+                colon = x.index(':', f)
+                if c == '0':
+                    raise ValueError
+                n = int(x[f:colon])
+                f = colon + 1
+            k = x[f:f + n]
+            f += n
+        elif c == 'i':
+            k, f = fast_decode_int(x, f)
+        else:
+            raise ValueError
+        if lastkey >= k:
+            raise ValueError
+        lastkey = k
+
+        c = x[f]
+        if c in DIGITS:
+            if x[f + 1] == ':':
+                n = ord(c) - 48
+                f += 2
+            else:
+                colon = x.index(':', f)
+                if c == '0':
+                    raise ValueError
+                n = int(x[f:colon])
+                f = colon + 1
+            r[k] = x[f:f + n]
+            f += n
+        else:
+            r[k], f = fast_decode_func[c](x, f)
+        c = x[f]
+    return (r, f + 1)
+
+fast_decode_func = decode_func.copy()
+fast_decode_func['l'] = fast_decode_list
+fast_decode_func['d'] = fast_decode_dict
+fast_decode_func['i'] = fast_decode_int
+for c in DIGITS:
+    fast_decode_func[c] = fast_decode_string
+
+def bdecode(x):
+    try:
+        r, l = fast_decode_func[x[0]](x, 0)
+    except (IndexError, KeyError):
+        raise ValueError
+    if l != len(x):
+        raise ValueError
+    return r
+
 def test_bdecode():
     try:
         bdecode('0:0:')
@@ -240,14 +364,362 @@ def test_bdecode():
     except ValueError:
         pass
 
-def fmt_bdecode(fmt, data):
+# Schema directed decoding
+#
+# A compiled format specification is turned into a decoder that checks
+# each value as it is decoded. A message is rejected at the first value
+# that does not match, and MAX_LEN limits are checked before a string is
+# copied or before a list or a dictionary grows past the limit. Parts of
+# the specification that can not be checked while decoding, such as
+# checker functions, are decoded normally and checked afterwards.
+
+MAX_SCHEMA_DECODERS = 256
+schemadecoders = {}
+
+def decode_key(x, f):
+    c = x[f]
+    if c in DIGITS:
+        return fast_decode_string(x, f)
+    elif c == 'i':
+        return fast_decode_int(x, f)
+    raise ValueError
+
+def skip_value(x, f):
+    """ Check the syntax of a value without building it. Returns the
+    position after the value. """
+
+    c = x[f]
+    if c in DIGITS:
+        colon = x.index(':', f)
+        if c == '0' and colon != f + 1:
+            raise ValueError
+        f = colon + 1 + int(x[f:colon])
+        if f > len(x):
+            raise ValueError
+        return f
+    elif c == 'i':
+        return fast_decode_int(x, f)[1]
+    elif c == 'b':
+        if f + 2 > len(x):
+            raise ValueError
+        return f + 2
+    elif c == 'l':
+        f += 1
+        while x[f] != 'e':
+            f = skip_value(x, f)
+        return f + 1
+    elif c == 'd':
+        f += 1
+        lastkey = None
+        while x[f] != 'e':
+            k, f = decode_key(x, f)
+            if lastkey >= k:
+                raise ValueError
+            lastkey = k
+            f = skip_value(x, f)
+        return f + 1
+    raise ValueError
+
+def decode_any(x, f):
+    return fast_decode_func[x[f]](x, f)
+
+def schema_string_decoder(maxlen):
+    if maxlen == None:
+        def decode_str(x, f):
+            if x[f] not in DIGITS:
+                raise ValueError
+            return fast_decode_string(x, f)
+        return decode_str
+
+    def decode_bounded_str(x, f):
+        c = x[f]
+        if c not in DIGITS:
+            raise ValueError
+        colon = x.index(':', f)
+        if c == '0' and colon != f + 1:
+            raise ValueError
+        n = int(x[f:colon])
+        if n > maxlen:
+            raise ValueError
+        f = colon + 1
+        return (x[f:f + n], f + n)
+    return decode_bounded_str
+
+def schema_int_decoder(x, f):
+    if x[f] != 'i':
+        raise ValueError
+    return fast_decode_int(x, f)
+
+def schema_bool_decoder(x, f):
+    if x[f] != 'b':
+        raise ValueError
+    return decode_bool(x, f)
+
+def schema_sized_decoder(maxlen):
+    """ Decoder for MAX_LEN(maxlen, ANY) """
+
+    decode_str = schema_string_decoder(maxlen)
+    decode_list = schema_repetition_decoder(ZERO_OR_MORE, decode_any, maxlen)
+    decode_dict = schema_any_dict_decoder(maxlen)
+    def decode_sized(x, f):
+        c = x[f]
+        if c == 'l':
+            return decode_list(x, f)
+        elif c == 'd':
+            return decode_dict(x, f)
+        return decode_str(x, f)
+    return decode_sized
+
+def schema_repetition_decoder(rep, decode_item, maxlen):
+    minlen = int(rep == ONE_OR_MORE)
+    if decode_item == decode_any and maxlen == None:
+        def decode_any_list(x, f):
+            if x[f] != 'l':
+                raise ValueError
+            r, f = fast_decode_list(x, f)
+            if len(r) < minlen:
+                raise ValueError
+            return (r, f)
+        return decode_any_list
+
+    def decode_repetition(x, f):
+        if x[f] != 'l':
+            raise ValueError
+        r = []
+        f += 1
+        while x[f] != 'e':
+            if maxlen != None and len(r) >= maxlen:
+                raise ValueError
+            v, f = decode_item(x, f)
+            r.append(v)
+        if len(r) < minlen:
+            raise ValueError
+        return (r, f + 1)
+    return decode_repetition
+
+def schema_fixed_list_decoder(decoders):
+    n = len(decoders)
+    def decode_fixed_list(x, f):
+        if x[f] != 'l':
+            raise ValueError
+        r = []
+        f += 1
+        while x[f] != 'e':
+            if len(r) == n:
+                raise ValueError
+            v, f = decoders[len(r)](x, f)
+            r.append(v)
+        if len(r) != n:
+            raise ValueError
+        return (r, f + 1)
+    return decode_fixed_list
+
+def schema_dict_decoder(fields, nrequired, skipunknown, maxlen):
+    """ fields maps a known key to (decoder, required). Values of other
+    keys are decoded normally, or skipped if skipunknown == True. """
+
+    def decode_schema_dict(x, f):
+        if x[f] != 'd':
+            raise ValueError
+        r = {}
+        f += 1
+        lastkey = None
+        nkeys = 0
+        required = 0
+        c = x[f]
+        while c != 'e':
+            if c in DIGITS:
+                if x[f + 1] == ':':
+                    n = ord(c) - 48
+                    f += 2
+                else:
+                    colon = x.index(':', f)
+                    if c == '0':
+                        raise ValueError
+                    n = int(x[f:colon])
+                    f = colon + 1
+                k = x[f:f + n]
+                f += n
+            else:
+                k, f = decode_key(x, f)
+            if lastkey >= k:
+                raise ValueError
+            lastkey = k
+            nkeys += 1
+            if maxlen != None and nkeys > maxlen:
+                raise ValueError
+            field = fields.get(k)
+            if field != None:
+                (decoder, isrequired) = field
+                r[k], f = decoder(x, f)
+                required += isrequired
+            elif skipunknown:
+                f = skip_value(x, f)
+            else:
+                c = x[f]
+                if c in DIGITS:
+                    r[k], f = fast_decode_string(x, f)
+                else:
+                    r[k], f = fast_decode_func[c](x, f)
+            c = x[f]
+        if required != nrequired:
+            raise ValueError
+        return (r, f + 1)
+    return decode_schema_dict
+
+def schema_any_dict_decoder(maxlen):
+    """ Decoder for {} """
+
+    if maxlen != None:
+        return schema_dict_decoder({}, 0, False, maxlen)
+    def decode_any_dict(x, f):
+        if x[f] != 'd':
+            raise ValueError
+        return fast_decode_dict(x, f)
+    return decode_any_dict
+
+def schema_key_type_decoder(types, decoder, maxlen):
+    """ Decoder for {str: fmt} and {int: fmt} """
+
+    if decoder == decode_any and maxlen == None:
+        def decode_any_values(x, f):
+            if x[f] != 'd':
+                raise ValueError
+            r, f = fast_decode_dict(x, f)
+            for k in r:
+                if type(k) not in types:
+                    raise ValueError
+            return (r, f)
+        return decode_any_values
+
+    def decode_key_type_dict(x, f):
+        if x[f] != 'd':
+            raise ValueError
+        r = {}
+        f += 1
+        lastkey = None
+        while x[f] != 'e':
+            k, f = decode_key(x, f)
+            if lastkey >= k or type(k) not in types:
+                raise ValueError
+            lastkey = k
+            if maxlen != None and len(r) >= maxlen:
+                raise ValueError
+            r[k], f = decoder(x, f)
+        return (r, f + 1)
+    return decode_key_type_dict
+
+def schema_checked_decoder(fmt):
+    """ Decode normally, and then validate """
+
+    check = compile_check(fmt)
+    def decode_checked(x, f):
+        v, f = fast_decode_func[x[f]](x, f)
+        if not check(v):
+            raise ValueError
+        return (v, f)
+    return decode_checked
+
+def schema_decoder(fmt, skipunknown, maxlen=None):
+    """ Returns a function decoder(x, f) -> (value, f) that decodes a
+    value that matches fmt, or raises ValueError """
+
+    if type(fmt) == Compiled_Validator:
+        fmt = fmt.fmt
+    if isinstance(fmt, MAX_LEN):
+        if maxlen == None or fmt.maxlen < maxlen:
+            maxlen = fmt.maxlen
+        return schema_decoder(fmt.fmt, skipunknown, maxlen)
+
+    if fmt == ANY:
+        if maxlen != None:
+            return schema_sized_decoder(maxlen)
+        return decode_any
+    elif fmt == str:
+        return schema_string_decoder(maxlen)
+    elif fmt == int and maxlen == None:
+        return schema_int_decoder
+    elif fmt == bool and maxlen == None:
+        return schema_bool_decoder
+
+    elif type(fmt) == list:
+        if len(fmt) == 2 and (fmt[0] == ZERO_OR_MORE or fmt[0] == ONE_OR_MORE):
+            item = schema_decoder(fmt[1], skipunknown)
+            return schema_repetition_decoder(fmt[0], item, maxlen)
+        if ZERO_OR_MORE not in fmt and ONE_OR_MORE not in fmt and \
+           (maxlen == None or len(fmt) <= maxlen):
+            decoders = map(lambda item: schema_decoder(item, skipunknown), fmt)
+            return schema_fixed_list_decoder(decoders)
+
+    elif type(fmt) == dict:
+        fields = {}
+        nrequired = 0
+        keytypes = []
+        for (key, value) in fmt.items():
+            decoder = schema_decoder(value, skipunknown)
+            if key == str:
+                keytypes.append(((str, ), decoder))
+            elif key == int:
+                keytypes.append(((int, long), decoder))
+            elif isinstance(key, OPTIONAL_KEY):
+                fields[key.key] = (decoder, 0)
+            elif type(key) == type:
+                break
+            else:
+                fields[key] = (decoder, 1)
+                nrequired += 1
+        else:
+            # With key types, each key is checked against the key types,
+            # including the keys that have their own value format. Those
+            # combinations are checked after decoding.
+            if len(keytypes) == 1 and len(fields) == 0:
+                (types, decoder) = keytypes[0]
+                return schema_key_type_decoder(types, decoder, maxlen)
+            elif len(fields) == 0 and len(keytypes) == 0:
+                return schema_any_dict_decoder(maxlen)
+            elif len(keytypes) == 0:
+                return schema_dict_decoder(fields, nrequired, skipunknown, maxlen)
+
+    if maxlen != None:
+        fmt = MAX_LEN(maxlen, fmt)
+    return schema_checked_decoder(fmt)
+
+def get_schema_decoder(fmt, skipunknown):
+    key = (fmt, skipunknown)
+    decoder = schemadecoders.get(key)
+    if decoder == None:
+        if len(schemadecoders) >= MAX_SCHEMA_DECODERS:
+            schemadecoders.clear()
+        decoder = schema_decoder(fmt, skipunknown)
+        schemadecoders[key] = decoder
+    return decoder
+
+def fmt_bdecode(fmt, data, skipunknown=False):
+    """ Decode data and validate it against fmt. Returns None if data is
+    invalid.
+
+    If fmt is compiled with typevalidator.compile(), data is validated
+    while it is decoded. Then, if skipunknown == True, dictionary keys
+    that are not listed in the format are checked but left out from the
+    result. This saves memory when only the listed keys are used. """
+
+    if type(fmt) != Compiled_Validator:
+        try:
+            x = bdecode(data)
+        except ValueError:
+            return None
+        if not validate(fmt, x):
+            return None
+        return x
+
+    decoder = get_schema_decoder(fmt, skipunknown)
     try:
-        x = bdecode(data)
-    except ValueError:
+        r, l = decoder(data, 0)
+    except (IndexError, KeyError, ValueError):
         return None
-    if not validate(fmt, x):
+    if l != len(data):
         return None
-    return x
+    return r
 
 class Bencached(object):
     __slots__ = ['bencoded']
@@ -267,21 +739,51 @@ def bencode_string(x, b):
 def bencode_list(x, b):
     b.append('l')
     for e in x:
-        encode_func[type(e)](e, b)
+        t = type(e)
+        if t is StringType:
+            b.extend((str(len(e)), ':', e))
+        else:
+            encode_func[t](e, b)
     b.append('e')
 
-def bencode_dict(x, b):
-    b.append('d')
-    klist = x.keys()
+# Dictionaries of the same shape are encoded often. The sorted keys and
+# their encodings are cached by the keys in dictionary order.
+MAX_DICT_LAYOUTS = 1024
+dictlayouts = {}
+
+def get_dict_layout(x):
+    keys = tuple(x)
+    layout = dictlayouts.get(keys)
+    if layout != None:
+        return layout
+    klist = list(keys)
     klist.sort()
+    layout = []
     for k in klist:
         if type(k) is StringType:
-            bencode_string(k, b)
+            layout.append((k, '%d:%s' % (len(k), k)))
         elif type(k) is IntType or type(k) is LongType:
-            bencode_int(k, b)
+            layout.append((k, 'i%de' % k))
         else:
             assert False
-        encode_func[type(x[k])](x[k], b)
+    if len(dictlayouts) >= MAX_DICT_LAYOUTS:
+        dictlayouts.clear()
+    dictlayouts[keys] = layout
+    return layout
+
+def bencode_dict(x, b):
+    b.append('d')
+    for (k, encodedkey) in get_dict_layout(x):
+        b.append(encodedkey)
+        v = x[k]
+        t = type(v)
+        # Inline the common types
+        if t is StringType:
+            b.extend((str(len(v)), ':', v))
+        elif t is IntType:
+            b.extend(('i', str(v), 'e'))
+        else:
+            encode_func[t](v, b)
     b.append('e')
 
 def bencode_cached(x, b):
@@ -305,6 +807,41 @@ def bencode(item):
         raise ValueError
     return ''.join(b)
 
+def bencode_list_reference(x, b):
+    b.append('l')
+    for e in x:
+        reference_encode_func[type(e)](e, b)
+    b.append('e')
+
+def bencode_dict_reference(x, b):
+    b.append('d')
+    klist = x.keys()
+    klist.sort()
+    for k in klist:
+        if type(k) is StringType:
+            bencode_string(k, b)
+        elif type(k) is IntType or type(k) is LongType:
+            bencode_int(k, b)
+        else:
+            assert False
+        reference_encode_func[type(x[k])](x[k], b)
+    b.append('e')
+
+reference_encode_func = encode_func.copy()
+reference_encode_func[ListType] = bencode_list_reference
+reference_encode_func[TupleType] = bencode_list_reference
+reference_encode_func[DictType] = bencode_dict_reference
+
+def bencode_reference(item):
+    """ The original encoder, which sorts keys of every dictionary """
+
+    b = []
+    try:
+        reference_encode_func[type(item)](item, b)
+    except KeyError:
+        raise ValueError
+    return ''.join(b)
+
 def test_bencode():
     assert bencode(4) == 'i4e'
     assert bencode(0) == 'i0e'
@@ -324,7 +861,179 @@ def test_bencode():
     assert bencode([True, 2]) == 'lb1i2ee'
     assert bencode([2, False]) == 'li2eb0e'
     assert bencode({1: 'foo'}) == 'di1e3:fooe'
+    assert bencode({'a': Bencached('d1:xi1ee'), 'b': [Bencached('0:')]}) == 'd1:ad1:xi1ee1:bl0:ee'
+
+def sample_messages():
+    """ Returns (name, message) pairs of typical Proximate messages """
+
+    uid = '3f2a9c01b7e4d588'
+    hello = {'t': 'hello', 'v': 4, 'pv': 12, 'port': 31337,
+        'nick': 'alice', 'uid': uid}
+    request = {'v': 0, 't': 'uprofile', 'c': '', 'rid': 17,
+        'rt': 'community', 'version': 3}
+    profile = {'v': 12, 'uid': uid, 'nick': 'alice',
+        'communities': ['Proximate', 'Helsinki'], 'faceversion': 2,
+        'fscounter': 5, 'status': 'Hacking', 'city': 'Helsinki',
+        'country': 'Finland', 'name': 'Alice', 'languages': 'en fi',
+        'description': 'Coffee and mesh networks'}
+    reply = {'v': 0, 't': '', 'c': '', 'rid': 17, 'rt': '', 'uprofile': profile}
+    fragment = {'t': 'data', 'from': uid, 'to': 'b' * 16, 'packet': 123456,
+        'frag': 3, 'fragcount': 9, 'payload': 'x' * 1024, 'ack': True,
+        'sack': True}
+    metas = []
+    for i in xrange(200):
+        metas.append({'id': '%s:%d' % (uid, i), 'src': uid, 'v': 1,
+            'title': 'Holiday photos %d' % i, 'type': 'image/jpeg',
+            'size': 1000000 + i, 'keywords': ['summer', 'beach'],
+            'description': 'Photos from the trip'})
+    sharelist = {'v': 0, 't': '', 'c': '', 'rid': 18, 'rt': '',
+        'uid': uid, 'metas': metas}
+    return [('hello', hello), ('fetch request', request),
+            ('profile reply', reply), ('udp fragment', fragment),
+            ('share list', sharelist)]
+
+def test_equivalence():
+    """ The single pass decoder agrees with the original codec on
+    messages and corrupted messages """
+
+    from random import Random
+
+    rand = Random(1)
+    for (name, msg) in sample_messages():
+        data = bencode(msg)
+        assert(data == bencode_reference(msg))
+        assert(bdecode(data) == msg)
+        assert(bdecode_recursive(data) == msg)
+
+        # A corrupted message is either rejected or decoded the same way
+        for i in xrange(200):
+            corrupt = list(data[0:rand.randint(1, min(len(data), 300))])
+            corrupt[rand.randrange(len(corrupt))] = rand.choice('ilde0123456789:b-x')
+            corrupt = ''.join(corrupt)
+            try:
+                x = bdecode(corrupt)
+            except ValueError:
+                continue
+            assert(bdecode_recursive(corrupt) == x)
+
+def sample_specs():
+    """ Returns (message name, format) pairs for sample_messages() """
+
+    from typevalidator import compile as compile_spec
+
+    even = lambda i: type(i) == int and i % 2 == 0
+    return [('hello', {'t': str, 'v': int, 'pv': int, 'port': int,
+                       'nick': MAX_LEN(32, str), 'uid': MAX_LEN(16, str)}),
+            ('hello', {'t': 'hello', OPTIONAL_KEY('x'): int, 'port': even}),
+            ('fetch request', {'rid': int, OPTIONAL_KEY('v'): int, 't': str,
+                               'rt': str, 'c': str}),
+            ('profile reply', {'rid': int, 'uprofile': {str: ANY}}),
+            ('profile reply', {'uprofile': {'communities': [ONE_OR_MORE, str],
+                                            OPTIONAL_KEY('face'): str,
+                                            'v': MAX_LEN(3)}}),
+            ('udp fragment', {'t': str, 'from': str, 'to': str,
+                              OPTIONAL_KEY('payload'): MAX_LEN(1024, str),
+                              'ack': bool, 'sack': bool}),
+            ('udp fragment', {'payload': MAX_LEN(1000, str)}),
+            ('share list', {'uid': str, 'metas': [ZERO_OR_MORE, {}]}),
+            ('share list', {'metas': MAX_LEN(100, [ZERO_OR_MORE, ANY])}),
+            ('share list', {'metas': [ZERO_OR_MORE, {'id': str, 'size': int,
+                                                     'keywords': [str, str]}]}),
+            ('share list', compile_spec({'uid': str})),
+           ]
+
+def test_fmt_bdecode():
+    """ Compiled formats are validated while decoding. The result must be
+    the same as with decoding and validating separately. """
+
+    from random import Random
+    from typevalidator import compile as compile_spec
+
+    rand = Random(2)
+    messages = dict(sample_messages())
+    for (name, fmt) in sample_specs():
+        validator = compile_spec(fmt)
+        data = bencode(messages[name])
+        tests = [data, data[:-1], data + 'e', bencode([messages[name]]), '', 'x']
+        for i in xrange(200):
+            corrupt = list(data[0:rand.randint(1, min(len(data), 300))])
+            corrupt[rand.randrange(len(corrupt))] = rand.choice('ilde0123456789:b-x')
+            tests.append(''.join(corrupt))
+        for x in tests:
+            assert(fmt_bdecode(validator, x) == fmt_bdecode(fmt, x))
+
+            # Unknown keys are skipped, but their syntax is still checked
+            d = fmt_bdecode(validator, x, skipunknown=True)
+            assert((d == None) == (fmt_bdecode(fmt, x) == None))
+
+    fmt = compile_spec({'t': str, OPTIONAL_KEY('n'): int, 'l': [ZERO_OR_MORE, {'a': int}]})
+    data = bencode({'t': 'x', 'n': 1, 'l': [{'a': 1, 'b': 2}], 'z': [1, 2]})
+    assert(fmt_bdecode(fmt, data, skipunknown=True) == {'t': 'x', 'n': 1, 'l': [{'a': 1}]})
+    assert(fmt_bdecode(fmt, data) == bdecode(data))
+    assert(fmt_bdecode(fmt, data.replace('li1ei2ee', 'li1ei02ee'), skipunknown=True) == None)
+
+    # Type keys and long integers
+    fmt = compile_spec({int: {str: int}})
+    assert(fmt_bdecode(fmt, 'di1ed1:ai2eei99999999999999999999edee') == {1: {'a': 2}, 99999999999999999999L: {}})
+    assert(fmt_bdecode(fmt, 'd1:ad1:ai2eee') == None)
+
+    # Limits reject oversized values
+    fmt = compile_spec({'payload': MAX_LEN(10, str), OPTIONAL_KEY('l'): MAX_LEN(2, [ZERO_OR_MORE, int])})
+    assert(fmt_bdecode(fmt, bencode({'payload': 'x' * 10})) != None)
+    assert(fmt_bdecode(fmt, bencode({'payload': 'x' * 11})) == None)
+    assert(fmt_bdecode(fmt, bencode({'payload': '', 'l': [1, 2]})) != None)
+    assert(fmt_bdecode(fmt, bencode({'payload': '', 'l': [1, 2, 3]})) == None)
+    assert(fmt_bdecode(compile_spec(MAX_LEN(1)), bencode({'a': 1, 'b': 2})) == None)
+    assert(fmt_bdecode(compile_spec(MAX_LEN(1)), 'i1e') == None)
+
+def hostile_messages():
+    """ Returns (name, format, message) triples of messages that a
+    compiled format rejects """
+
+    from typevalidator import compile as compile_spec
+
+    fetchspec = compile_spec({'rid': int, OPTIONAL_KEY('v'): int, 't': str, 'rt': str, 'c': str})
+    udpspec = compile_spec({'t': str, OPTIONAL_KEY('payload'): MAX_LEN(1024, str)})
+    listspec = compile_spec({'uid': str, 'ids': MAX_LEN(64, [ZERO_OR_MORE, int])})
+    return [('wrong type', fetchspec, bencode({'c': range(100000), 'rid': 'x'})),
+            ('big string', udpspec, bencode({'payload': 'x' * 1000000, 't': 'data'})),
+            ('long list', listspec, bencode({'ids': range(100000), 'uid': 'x'})),
+           ]
+
+def benchmark(n=2000):
+    """ Compare the original and the current codec on typical messages.
+    Times are microseconds per message. """
+
+    from time import time
+
+    def measure(f, arg):
+        t0 = time()
+        for i in xrange(n):
+            f(arg)
+        return 1000000 * (time() - t0) / n
+
+    print '%-14s %7s   %-18s %s' %('message', 'bytes', 'encode old/new', 'decode old/new')
+    for (name, msg) in sample_messages():
+        data = bencode(msg)
+        print '%-14s %7d %8.1f %8.1f %8.1f %8.1f' %(name, len(data),
+            measure(bencode_reference, msg), measure(bencode, msg),
+            measure(bdecode_recursive, data), measure(bdecode, data))
+
+    # Decoding with a plain format decodes the whole message first
+    print
+    print '%-14s %7s   %-18s' %('hostile', 'bytes', 'fmt_bdecode plain/compiled')
+    n = max(1, n // 100)
+    for (name, fmt, data) in hostile_messages():
+        assert(fmt_bdecode(fmt, data) == None)
+        print '%-14s %7d %8.1f %8.1f' %(name, len(data),
+            measure(lambda x: fmt_bdecode(fmt.fmt, x), data),
+            measure(lambda x: fmt_bdecode(fmt, x), data))
 
 if __name__ == '__main__':
+    import sys
     test_bdecode()
     test_bencode()
+    test_equivalence()
+    test_fmt_bdecode()
+    if '--bench' in sys.argv[1:]:
+        benchmark()
@@ -9,12 +9,12 @@
 # See the LICENSE file for more details.
 #
 from errno import EAGAIN, EINTR
-from gobject import io_add_watch, IO_IN
 import socket
 from random import randint
 
 from bencode import fmt_bdecode, bencode
-from ioutils import create_udp_socket, send_broadcast, TCP_Queue
+from ioutils import create_udp_socket, send_broadcast, TCP_Queue, \
+     io_add_watch, IO_IN
 from plugins import Plugin, get_plugins, get_plugin_by_type
 from support import warning, info, debug, get_debug_mode
 from proximateprotocol import DEFAULT_COMMUNITY_NAME, FRIENDS_COMMUNITY_NAME, \
@@ -24,6 +24,7 @@ from proximateprotocol import DEFAULT_COMMUNITY_NAME, FRIENDS_COMMUNITY_NAME, \
      valid_nick, valid_port, valid_uid, valid_protocol_version, \
      PLUGIN_TYPE_COMMUNITY, PLUGIN_TYPE_FETCHER, \
      PLUGIN_TYPE_NOTIFICATION, PLUGIN_TYPE_SCHEDULER, PROFILE_ICON_CHANGED, \
+     PROTOCOL_VERSION_CHANGED, \
      PLUGIN_TYPE_NETWORK_CONTROL, \
      PLUGIN_TYPE_SETTINGS, DEFAULT_PROXIMATE_PORT, TP_MIN_PORT, TP_MAX_PORT
 from proximatestate import create_community, find_communities, get_community_dir, \
@@ -33,7 +34,7 @@ from proximatestate import create_community, find_communities, get_community_dir
      save_community_icon, save_communities, save_face, seek_face_name, \
      create_user, delete_face, create_user_communities, delete_community_icon, \
      normal_traffic_mode
-from typevalidator import validate, ZERO_OR_MORE
+from typevalidator import compile as compile_spec, validate, ZERO_OR_MORE
 from utils import read_file_contents, Rate_Limiter
 from pathname import get_path, FRIEND_COMMUNITY_ICON
 from meta import is_unsigned_int
@@ -52,6 +53,8 @@ MAX_ICON_ACTIVE = 30
 class Community_Plugin(Plugin):
     IP_NETWORK = 0
 
+    rpcspec = compile_spec({'t': str})
+
     def __init__(self, options):
         self.register_plugin(PLUGIN_TYPE_COMMUNITY)
         self.register_server(TP_HELLO, Hello_Server)
@@ -87,6 +90,9 @@ class Community_Plugin(Plugin):
         self.myself = get_myself()
         self.myuid = self.myself.get('uid')
 
+        # ((profile version, port), bencoded hello)
+        self.rpchello = None
+
         self.udp_listen = (options.udpmode & 1) != 0
         self.udp_send = (options.udpmode & 2) != 0
         if not self.udp_listen or not self.udp_send:
@@ -322,6 +328,15 @@ class Community_Plugin(Plugin):
                 'uid': self.myuid,
                }
 
+    def gen_rpc_hello_bencoded(self):
+        """ Returns bencode(self.gen_rpc_hello()). It is encoded again
+        only after my profile version or port changes. """
+
+        key = (self.myself.get('v'), self.myself.get('port'))
+        if self.rpchello == None or self.rpchello[0] != key:
+            self.rpchello = (key, bencode(self.gen_rpc_hello()))
+        return self.rpchello[1]
+
     def gen_rpc_bye(self):
         return bencode({'t': TP_QUIT, 'uid': self.myuid})
 
@@ -511,7 +526,7 @@ class Community_Plugin(Plugin):
         community = self.get_ordinary_community(cname)
         if community == None:
             return None
-        return {'cprofile': community.serialize()}
+        return {'cprofile': community.get_bencached()}
 
     def handle_community_profiles_fetch(self, user, request):
         validator = {
@@ -530,7 +545,7 @@ class Community_Plugin(Plugin):
                 continue
             if version < com.get('v'):
                 cnames.append(cname)
-                profiles.append(com.serialize())
+                profiles.append(com.get_bencached())
                 debug('Sending %s community profile to %s\n' %
                     (com.get('name'), user.get('nick')))
         return {'cname': cnames, 'profile': profiles}
@@ -610,14 +625,14 @@ class Community_Plugin(Plugin):
         request = {'t': 'iconpush', 'iconid': iconid, 'icon': icon, 'version': version}
 
         if normal_traffic_mode():
-            self.fetcher.fetch(user, PLUGIN_TYPE_COMMUNITY, request, None, ack=False)
+            self.fetcher.fetch(user, PLUGIN_TYPE_COMMUNITY, request, None, ack=False, priority=self.fetcher.PRIORITY_LOW)
         elif limiter == None or limiter.check():
-            self.fetcher.fetch_community(self.get_default_community(), PLUGIN_TYPE_COMMUNITY, request, None, ack=False)
+            self.fetcher.fetch_community(self.get_default_community(), PLUGIN_TYPE_COMMUNITY, request, None, ack=False, priority=self.fetcher.PRIORITY_LOW)
 
         return {}
 
     def handle_user_profile_fetch(self, user, request):
-        return {'uprofile': self.myself.serialize()}
+        return {'uprofile': self.myself.get_bencached()}
 
     def is_blacklisted(self, user):
         return self.blacklist.has_key(user)
@@ -700,14 +715,14 @@ class Community_Plugin(Plugin):
         if user.get('myfaceversion') != user.get('faceversion') and \
            len(self.activeusers) < MAX_ICON_ACTIVE:
             request = {'t': 'iconrequest', 'iconid': 'user'}
-            self.fetcher.fetch(user, PLUGIN_TYPE_COMMUNITY, request, None, ack=False)
+            self.fetcher.fetch(user, PLUGIN_TYPE_COMMUNITY, request, None, ack=False, priority=self.fetcher.PRIORITY_LOW)
 
     def request_com_icon(self, user, com):
         if com.get('myiconversion') != com.get('iconversion') and \
            not com.get('iconlocked') and len(self.activeusers) < MAX_ICON_ACTIVE:
             iconid = 'c:' + com.get('name')
             request = {'t': 'iconrequest', 'iconid': iconid}
-            self.fetcher.fetch(user, PLUGIN_TYPE_COMMUNITY, request, None, com, ack=False)
+            self.fetcher.fetch(user, PLUGIN_TYPE_COMMUNITY, request, None, com, ack=False, priority=self.fetcher.PRIORITY_LOW)
 
     def remote_discovery(self):
         """ remote discovery keeps remote connections open in each possible
@@ -716,7 +731,6 @@ class Community_Plugin(Plugin):
         if self.get_network_state(self.IP_NETWORK) == False:
             return
         hello = None
-        benhello = None
         for user in self.remoteusers:
             counter = self.remoteusers[user]
             if self.activeusers.has_key(user):
@@ -738,11 +752,7 @@ class Community_Plugin(Plugin):
             if counter != 0:
                 continue
 
-            if benhello == None:
-                if hello == None:
-                    hello = self.gen_rpc_hello()
-                benhello = bencode(hello)
-
+            benhello = self.gen_rpc_hello_bencoded()
             for address in addresses:
                 port = address[1]
                 if port == None:
@@ -751,7 +761,7 @@ class Community_Plugin(Plugin):
 
     def periodic_event(self, t, ctx):
         if self.udp_send:
-            self.broadcast(bencode(self.gen_rpc_hello()))
+            self.broadcast(self.gen_rpc_hello_bencoded())
 
         for user in self.activeusers.keys():
             if user.timeout():
@@ -838,12 +848,13 @@ class Community_Plugin(Plugin):
     def gen_port(self):
         port = randint(TP_MIN_PORT, TP_MAX_PORT)
         self.myself.set('port', port)
+        return True
 
     def got_rpc_msg(self, data, address):
         if not self.ipactive:
             return
 
-        d = fmt_bdecode({'t': str}, data)
+        d = fmt_bdecode(self.rpcspec, data)
         if d == None:
             return
 
@@ -875,8 +886,20 @@ class Community_Plugin(Plugin):
             ip = address[0]
         else:
             ip = None
+
+        # A restarted peer may run another protocol version, although its
+        # profile has not changed
+        user = get_user(d['uid'])
+        oldversion = None
+        if user != None:
+            oldversion = user.get('protocolversion')
+
         self.add_or_update_user(d['uid'], updatelist, d['pv'], ip, d['port'])
 
+        if oldversion != None and oldversion != d['v']:
+            user.set('protocolversion', d['v'])
+            self.announce_user_change(user, what=(PROTOCOL_VERSION_CHANGED, d['v']))
+
     def got_bye(self, d, address):
         """ User quit, denounce """
 
@@ -1047,7 +1070,7 @@ class Hello_Server:
 
     def msghandler(self, q, benhello, ctx):
         community.got_rpc_msg(benhello, self.address)
-        self.q.write(bencode(community.gen_rpc_hello()))
+        self.q.write(community.gen_rpc_hello_bencoded())
         self.q.close_after_send()
         return True
 
@@ -58,8 +58,11 @@ class Community(Meta):
     'keys' attributes.
     """
 
+    __slots__ = ['inprogress']
+
+    metaattributes = comattrs
+
     def __init__(self):
-        self.metaattributes = comattrs
         self.base_init()
 
         self.inprogress = False
@@ -23,10 +23,12 @@ for pubkey in ['author', 'communities', 'description', 'communities', 'keywords'
 contentattributes['fname'] = Meta_Attribute(str, public=False, save=False)
 
 class Content_Meta(Meta):
+    __slots__ = []
+
+    metaattributes = contentattributes
     metasection = 'meta'
 
     def __init__(self):
-        self.metaattributes = contentattributes
         self.base_init()
 
     def meta_name(self, fname):
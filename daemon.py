@@ -0,0 +1,269 @@
+#
+# Proximate - Peer-to-peer social networking
+#
+# Copyright (c) 2008-2011 Nokia Corporation
+#
+# All rights reserved.
+#
+# This software is licensed under The Clear BSD license.
+# See the LICENSE file for more details.
+#
+"""
+Headless Proximate node. Only networking plugins are loaded, and they run
+on the epoll event loop, so GTK, curses and other UI modules are never
+imported. This is useful for always-on content relays.
+
+Running this module directly starts a load test:
+
+    python daemon.py [options] [nconnections]
+"""
+import os
+import random
+import resource
+import shutil
+import signal
+import sys
+import tempfile
+from time import time
+
+from bencode import bencode, fmt_bdecode
+from ioutils import TCP_Queue, TCPQ_OK, TCPQ_ROLE_GET_FILE, \
+     Epoll_Event_Loop, get_event_loop, set_event_loop, set_socket_buffer_sizes
+from plugins import get_plugin_by_type, plugin_cleanup, plugins_ready
+import listener
+import proximatestate
+import support
+from support import die, print_exc, warning
+from proximateprotocol import PLUGIN_TYPE_COMMUNITY, \
+     PLUGIN_TYPE_FILE_SHARING, TP_CONNECT_TIMEOUT, TP_FETCH_RECORDS, \
+     TP_GET_FILE, TP_UID_BITS, SHARE_FILE, valid_uid
+from typevalidator import compile as compile_spec
+from utils import random_hexdigits
+
+# Initialized in this order after proximatestate. 'wlancontrol' and
+# 'community' must come first.
+DAEMON_PLUGINS = ['wlancontrol', 'community', 'udpfetcher', 'tcpfetcher',
+                  'fetcher', 'filesharing', 'settings', 'notify',
+                  'messaging', 'scheduler', 'messageboard']
+
+def raise_fd_limit():
+    """ Raise the soft limit of open files to the hard limit. Each
+    connection takes a file descriptor. Returns the new soft limit. """
+
+    (soft, hard) = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            soft = hard
+        except (ValueError, resource.error):
+            warning('Can not raise open file limit from %d\n' %(soft))
+    return soft
+
+def start(options):
+    """ Initialize networking plugins and start listening to TCP
+    connections. The event loop is not run. """
+
+    if options.debug:
+        support.set_debug_mode(options.verbose)
+
+    # Initialize seed for crypto and other plugins
+    random.seed()
+
+    for (role, rcvbuf, sndbuf) in options.socketbuffers:
+        if not set_socket_buffer_sizes(role, rcvbuf, sndbuf):
+            die('Invalid socket buffer role: %s\n' %(role))
+
+    set_event_loop(Epoll_Event_Loop())
+    raise_fd_limit()
+
+    # State plugin must be the first plugin that is initialized
+    proximatestate.init(options)
+
+    for modulename in DAEMON_PLUGINS:
+        module = __import__(modulename)
+        module.init(options)
+
+    # External plugins are not loaded, because they may need a UI
+
+    plugins_ready()
+
+    listener.init()
+
+def quit_handler(signum, frame):
+    get_event_loop().quit()
+
+def main(options, args):
+    start(options)
+
+    signal.signal(signal.SIGTERM, quit_handler)
+    signal.signal(signal.SIGINT, quit_handler)
+
+    rval = 1
+    try:
+        get_event_loop().run()
+        rval = 0
+    except Exception, err:
+        print_exc()
+        warning("proximate exception: %s\n" % err)
+    finally:
+        plugin_cleanup()
+
+    if rval == 0:
+        msg = 'success'
+    else:
+        msg = 'failure'
+    sys.stdout.write('Proximate daemon terminates (%s)\n' %(msg))
+    sys.exit(rval)
+
+class Load_Client:
+    """ A peer for the load test. It opens either a fetch connection or a
+    file get connection to the node, and keeps it open. """
+
+    fetchreplyspec = compile_spec({'rid': int, 'rt': str})
+    flenspec = compile_spec({'flen': int})
+
+    def __init__(self, address, finished, shareid=None):
+        self.finished = finished
+        self.uid = random_hexdigits(TP_UID_BITS)
+        while not valid_uid(self.uid):
+            self.uid = random_hexdigits(TP_UID_BITS)
+        self.shareid = shareid
+        self.flen = None
+        self.received = 0
+        self.done = False
+        self.closed = None
+
+        self.q = TCP_Queue(self.msghandler, closehandler=self.queue_closed, role=TCPQ_ROLE_GET_FILE)
+        if not self.q.connect(address, TP_CONNECT_TIMEOUT):
+            self.queue_closed(self.q, None, 'Can not connect')
+            return
+
+        if shareid == None:
+            self.q.write(TP_FETCH_RECORDS + '\n', writelength=False)
+            first = {'v': 0, 't': '', 'uid': self.uid, 'c': '', 'rid': -1, 'rt': ''}
+            self.q.write(bencode(first))
+            req = {'v': 0, 't': 'uprofile', 'c': '', 'rid': 0, 'rt': PLUGIN_TYPE_COMMUNITY}
+            self.q.write(bencode(req))
+        else:
+            self.q.write(TP_GET_FILE + '\n', writelength=False)
+            self.q.write(bencode({'uid': self.uid}))
+            self.q.write(bencode({'id': shareid, 'path': '/', 'keepalive': 0}))
+
+    def msghandler(self, q, data, parameter):
+        if self.shareid == None:
+            d = fmt_bdecode(self.fetchreplyspec, data, skipunknown=True)
+            if d == None or d['rid'] != 0 or len(d['rt']) != 0:
+                return False
+            self.set_done()
+            return True
+
+        d = fmt_bdecode(self.flenspec, data, skipunknown=True)
+        if d == None:
+            return False
+        self.flen = d['flen']
+        self.q.set_recv_handler(self.receive)
+        return True
+
+    def receive(self, data):
+        amount = min(len(data), self.flen - self.received)
+        self.received += amount
+        if self.received == self.flen:
+            self.q.set_recv_handler(None)
+            self.set_done()
+        return amount
+
+    def queue_closed(self, q, parameter, msg):
+        if not self.done and self.closed == None:
+            self.finished(self)
+        self.closed = msg
+
+    def set_done(self):
+        self.done = True
+        if self.closed == None:
+            self.finished(self)
+
+def load_test(options, nconnections=2000, flen=65536, holdtime=5):
+    """ Run a headless node in this process and open 'nconnections'
+    connections to it. Half of them are fetch connections that request
+    the user profile, and half are file get connections that download a
+    'flen' byte file. All connections are held open for 'holdtime'
+    seconds after the last transfer has completed. """
+
+    tmpdir = tempfile.mkdtemp(prefix='proximate-load-')
+    if options.proximatedir == None:
+        options.proximatedir = tmpdir
+
+    # Broadcasts are not needed, and the UDP port may be in use
+    options.udpmode = 0
+
+    start(options)
+    loop = get_event_loop()
+    limit = raise_fd_limit()
+    if limit < 2 * nconnections + 64:
+        warning('Open file limit %d is too low for %d connections\n' %(limit, nconnections))
+
+    fname = os.path.join(tmpdir, 'payload')
+    f = open(fname, 'w')
+    f.write('x' * flen)
+    f.close()
+    filesharing = get_plugin_by_type(PLUGIN_TYPE_FILE_SHARING)
+    share = filesharing.add_share(fname, announce=False, save=False, stype=SHARE_FILE)
+    shareid = share.meta['id']
+
+    community = get_plugin_by_type(PLUGIN_TYPE_COMMUNITY)
+    address = ('127.0.0.1', community.get_rpc_port())
+
+    finished = []
+
+    t0 = time()
+    clients = []
+    for i in xrange(nconnections):
+        if (i % 2) == 0:
+            clients.append(Load_Client(address, finished.append))
+        else:
+            clients.append(Load_Client(address, finished.append, shareid))
+        # Let the node accept connections while new ones are opened.
+        # Otherwise the listen backlog overflows.
+        if (i % 16) == 15:
+            loop.iteration(block=False)
+
+    deadline = t0 + TP_CONNECT_TIMEOUT
+    while len(finished) < nconnections and time() < deadline:
+        loop.iteration()
+    dt = time() - t0
+
+    holdend = time() + holdtime
+    while time() < holdend:
+        loop.iteration()
+
+    import tcpfetcher
+    fetchqueues = 0
+    for queuelist in tcpfetcher.fetchqueues.values():
+        fetchqueues += len(queuelist)
+
+    fetchclients = filter(lambda c: c.shareid == None, clients)
+    fileclients = filter(lambda c: c.shareid != None, clients)
+    fetchdone = len(filter(lambda c: c.done, fetchclients))
+    filedone = len(filter(lambda c: c.done, fileclients))
+    nopen = len(filter(lambda c: c.q.status == TCPQ_OK, clients))
+
+    print '%d connections in %.3f s' %(nconnections, dt)
+    print 'fetch: %d/%d replied, %d queues held by the node' %(fetchdone, len(fetchclients), fetchqueues)
+    print 'get file: %d/%d files of %d bytes received' %(filedone, len(fileclients), flen)
+    print '%d/%d connections open after %d s' %(nopen, nconnections, holdtime)
+
+    for c in clients:
+        c.q.close(msg='Load test done')
+    plugin_cleanup()
+    shutil.rmtree(tmpdir, ignore_errors=True)
+
+    return nopen == nconnections and fetchdone + filedone == nconnections
+
+if __name__ == '__main__':
+    from options import get_options
+    (options, args) = get_options()
+    nconnections = 2000
+    if len(args) > 0:
+        nconnections = int(args[0])
+    if not load_test(options, nconnections):
+        sys.exit(1)
@@ -8,33 +8,52 @@
 # This software is licensed under The Clear BSD license.
 # See the LICENSE file for more details.
 #
+from collections import deque
 from random import choice
 
 from bencode import bencode, fmt_bdecode
-from typevalidator import validate, OPTIONAL_KEY
+from typevalidator import compile as compile_spec, validate, OPTIONAL_KEY
+from ioutils import Timeout_Heap
 from plugins import Plugin, get_plugin_by_type
 from support import debug, die, warning
 from proximateprotocol import PLUGIN_TYPE_FETCHER, PLUGIN_TYPE_TCP_FETCHER, \
-     PLUGIN_TYPE_COMMUNITY, PLUGIN_TYPE_SCHEDULER, TP_FETCH_TIMEOUT, \
-     PLUGIN_TYPE_UDP_FETCHER
+     PLUGIN_TYPE_COMMUNITY, TP_FETCH_TIMEOUT, \
+     PLUGIN_TYPE_UDP_FETCHER, PLUGIN_TYPE_SETTINGS
 
-RETIREMENT_CYCLE = 5
-FETCH_TIMEOUT_STEPS = TP_FETCH_TIMEOUT // RETIREMENT_CYCLE
+# Default number of requests that may wait for a reply from a user at the
+# same time. Further requests are queued until replies arrive or requests
+# time out.
+FETCH_WINDOW = 8
+
+# Maximum number of queued requests per user
+FETCH_MAX_QUEUED = 1024
+
+# Priority classes. A lower number is served first.
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+NPRIORITIES = 3
 
 community = None
 fetcher = None
 
 pendingreqs = {}
 
+# Deadlines of pending requests, keyed by (user, rid)
+pendingtimeouts = None
+
+# user -> Peer_Queue
+peerqueues = {}
+
 class Request:
-    def __init__(self, rid, payload, callback, ctx, retries):
+    def __init__(self, rid, payload, callback, ctx, retries, rtype='', priority=PRIORITY_NORMAL):
         self.rid = rid
+        self.rtype = rtype
+        self.priority = priority
         self.payload = payload
         self.callback = callback
         self.ctx = ctx
         self.retries = retries
-        # +1 because timeout cycle is out of sync with creating the request
-        self.ttl = FETCH_TIMEOUT_STEPS + 1
         self.userreplies = {}
 
     def call(self, user, reply):
@@ -42,20 +61,54 @@ class Request:
             self.callback(user, reply, self.ctx)
             self.userreplies[user] = None
 
-        fetcher.get_pending(user, self.rid, pop=True)
-
-    def check_timeout(self, user):
-        self.ttl -= 1
-        if self.ttl <= 0:
-            self.call(user, None)
-            return False
-        return True
+        if fetcher.get_pending(user, self.rid, pop=True) != None:
+            fetcher.request_done(user)
 
     def retry(self):
         failure = (self.retries > 0)
         self.retries -= 1
         return failure
 
+class Peer_Queue:
+    """ Requests to a user that wait for a free slot in the in-flight
+    window. Higher priority classes are served first. Within a class,
+    request types (plugins) take turns, so one plugin can not starve
+    the others. """
+
+    def __init__(self):
+        self.inflight = 0
+        self.nqueued = 0
+        self.waiting = []    # priority -> {rtype: deque of requests}
+        self.order = []      # priority -> deque of rtypes that have requests
+        for i in xrange(NPRIORITIES):
+            self.waiting.append({})
+            self.order.append(deque())
+
+    def pop(self):
+        for priority in xrange(NPRIORITIES):
+            order = self.order[priority]
+            if len(order) == 0:
+                continue
+            rtype = order.popleft()
+            reqs = self.waiting[priority][rtype]
+            req = reqs.popleft()
+            if len(reqs) > 0:
+                order.append(rtype)
+            else:
+                self.waiting[priority].pop(rtype)
+            self.nqueued -= 1
+            return req
+        return None
+
+    def push(self, req):
+        reqs = self.waiting[req.priority].get(req.rtype)
+        if reqs == None:
+            reqs = deque()
+            self.waiting[req.priority][req.rtype] = reqs
+            self.order[req.priority].append(req.rtype)
+        reqs.append(req)
+        self.nqueued += 1
+
 class Special_Reply:
     pass
 
@@ -63,13 +116,22 @@ class Fetcher_Plugin(Plugin):
     POSTPONE_REPLY = Special_Reply()
     SILENT_COMMUNITY_ERROR = Special_Reply()
 
-    decodespec = {'rid': int, OPTIONAL_KEY('v'): int, 't': str, 'rt': str, 'c': str}
+    PRIORITY_HIGH = PRIORITY_HIGH
+    PRIORITY_NORMAL = PRIORITY_NORMAL
+    PRIORITY_LOW = PRIORITY_LOW
+
+    decodespec = compile_spec({'rid': int, OPTIONAL_KEY('v'): int, 't': str, 'rt': str, 'c': str})
 
     def __init__(self):
         self.register_plugin(PLUGIN_TYPE_FETCHER)
         self.handlers = {}
         self.handlername = {}
+        self.priorities = {}
         self.rid = 0
+        self.window_setting = None
+        # Users whose queued requests are sent after the current batch of
+        # messages, see handle_msgs()
+        self.deferred = None
 
     def close_ip_connections(self, msg):
         for queuelist in fetchqueues.values():
@@ -92,7 +154,7 @@ class Fetcher_Plugin(Plugin):
         msg['rt'] = rt
         return bencode(msg)
 
-    def fetch(self, user, rtype, request, callback, ctx=None, retries=0, ack=True):
+    def fetch(self, user, rtype, request, callback, ctx=None, retries=0, ack=True, priority=None):
         """ Tries to fetch data from an user.
 
             user: user to fetch from
@@ -106,11 +168,19 @@ class Fetcher_Plugin(Plugin):
             retries: number of retries
             ack: If True, reply is expected and a lost message is (possibly)
                  retransmitted according.
+            priority: PRIORITY_HIGH, PRIORITY_NORMAL or PRIORITY_LOW.
+                      The default is given by register_handler() for rtype.
+
+            If too many requests are waiting for a reply from the user, the
+            request is queued and sent later.
         """
         assert(retries >= 0)
 
         request.setdefault('c', '')
 
+        if priority == None:
+            priority = self.priorities.get(rtype, PRIORITY_NORMAL)
+
         rid = self.obtain_rid(ack)
 
         payload = self.encode(request, rid, rtype)
@@ -119,18 +189,22 @@ class Fetcher_Plugin(Plugin):
 
         self.log('fetcher.fetch', user, request, payload)
 
-        req = Request(rid, payload, callback, ctx, retries)
+        req = Request(rid, payload, callback, ctx, retries, rtype, priority)
 
-        success = self.backend.send_request(user, req)
+        peer = self.get_peer_queue(user)
 
-        # Add request to the pending queue, unless it is a no-ack request.
-        # The request is removed from the queue when req.call() is called.
-        if success and rid >= 0:
-            self.set_pending([user], req)
+        if peer.nqueued == 0 and peer.inflight < self.get_window():
+            success = self.send_request(user, req)
+            self.release_peer_queue(user)
+            return success
 
-        return success
+        if peer.nqueued >= FETCH_MAX_QUEUED:
+            warning('fetcher: too many queued requests for %s\n' %(user.tag()))
+            return False
+        peer.push(req)
+        return True
 
-    def fetch_community(self, com, rtype, request, callback, ctx=None, retries=0, ack=True):
+    def fetch_community(self, com, rtype, request, callback, ctx=None, retries=0, ack=True, priority=None):
         """ Send fetch to every user in given community.
 
             Because users in communities can appear and disappear at
@@ -138,7 +212,54 @@ class Fetcher_Plugin(Plugin):
         """
 
         request['c'] = com.get('name')
-        return self.backend.fetch_community(com, rtype, request, callback, ctx=ctx, retries=retries, ack=ack)
+        return self.backend.fetch_community(com, rtype, request, callback, ctx=ctx, retries=retries, ack=ack, priority=priority)
+
+    def get_window(self):
+        if self.window_setting == None:
+            return FETCH_WINDOW
+        # The configuration file value is not validated
+        return max(1, self.window_setting.value)
+
+    def get_peer_queue(self, user):
+        peer = peerqueues.get(user)
+        if peer == None:
+            peer = Peer_Queue()
+            peerqueues[user] = peer
+        return peer
+
+    def release_peer_queue(self, user):
+        peer = peerqueues.get(user)
+        if peer != None and peer.inflight == 0 and peer.nqueued == 0:
+            peerqueues.pop(user)
+
+    def request_done(self, user):
+        """ A reply arrived or the request timed out. Send queued requests
+        to the user. """
+
+        peer = peerqueues.get(user)
+        if peer == None:
+            return
+        peer.inflight -= 1
+        self.request_window_freed(user)
+
+    def send_queued(self, user):
+        peer = self.get_peer_queue(user)
+        while peer.nqueued > 0 and peer.inflight < self.get_window():
+            req = peer.pop()
+            if not self.send_request(user, req):
+                req.call(user, None)
+        self.release_peer_queue(user)
+
+    def send_request(self, user, req):
+        success = self.backend.send_request(user, req)
+
+        # Add request to the pending queue, unless it is a no-ack request.
+        # The request is removed from the queue when req.call() is called.
+        if success and req.rid >= 0:
+            self.set_pending([user], req)
+            self.get_peer_queue(user).inflight += 1
+
+        return success
 
     def is_fetch_community_efficient(self):
         return self.backend.efficient_fetch_community
@@ -156,14 +277,11 @@ class Fetcher_Plugin(Plugin):
         if user != None:
             d['uid'] = user.get('uid')
 
-    def fetch_queue_retirement(self, t, ctx):
-        for (user, ureqs) in pendingreqs.items():
-            for req in ureqs.values():
-                req.check_timeout(user)
-            if len(ureqs) == 0:
-                # Cleanup unused queues to avoid re-scanning in the future
-                pendingreqs.pop(user)
-        return True
+    def request_timeout(self, key):
+        (user, rid) = key
+        req = self.get_pending(user, rid)
+        if req != None:
+            req.call(user, None)
 
     def obtain_rid(self, ack):
         if ack:
@@ -174,8 +292,9 @@ class Fetcher_Plugin(Plugin):
         return rid
 
     def ready(self):
-        global community, fetcher
+        global community, fetcher, pendingtimeouts
         fetcher = self
+        pendingtimeouts = Timeout_Heap(self.request_timeout)
         community = get_plugin_by_type(PLUGIN_TYPE_COMMUNITY)
 
         for p in [PLUGIN_TYPE_UDP_FETCHER, PLUGIN_TYPE_TCP_FETCHER]:
@@ -183,20 +302,23 @@ class Fetcher_Plugin(Plugin):
             if self.backend != None and self.backend.functional():
                 break
 
-        sch = get_plugin_by_type(PLUGIN_TYPE_SCHEDULER)
-        sch.call_periodic(RETIREMENT_CYCLE * sch.SECOND, self.fetch_queue_retirement)
+        settings = get_plugin_by_type(PLUGIN_TYPE_SETTINGS)
+        self.window_setting = settings.register('fetcher.window', int, 'Maximum number of requests waiting for a reply from a user', default=FETCH_WINDOW, validator=lambda x: type(x) == int and x > 0)
 
-    def register_handler(self, rtype, handler, handlername):
+    def register_handler(self, rtype, handler, handlername, priority=PRIORITY_NORMAL):
         """ Register a slave handler that replies to the master.
             Handler will be called with the ip address and the payload
             of the message from master when a message with the
             corresponding rtype is received.
-            Handlername is used for debugging purposes. """
+            Handlername is used for debugging purposes.
+            Priority is the default priority class for requests of
+            this rtype. """
 
         if self.handlers.has_key(rtype):
             die('Fetch handler for rtype %s already registered\n' %(rtype))
         self.handlers[rtype] = handler
         self.handlername[rtype] = handlername
+        self.priorities[rtype] = priority
 
     def handle_msg(self, user, msg):
         if len(msg['rt']) == 0:
@@ -206,6 +328,33 @@ class Fetcher_Plugin(Plugin):
             # Act as a slave
             self.call_slave_handler(user, msg)
 
+    def handle_msgs(self, user, msgs, accept=None):
+        """ Handle a batch of messages from a user. Replies free slots in
+        the in-flight window, and queued requests are sent once after the
+        batch rather than after each reply.
+
+        If accept is given, accept(msg) is called before each message.
+        The rest of the batch is dropped when it returns False. """
+
+        deferred = self.deferred
+        self.deferred = set()
+        try:
+            for msg in msgs:
+                if accept != None and not accept(msg):
+                    break
+                self.handle_msg(user, msg)
+        finally:
+            users = self.deferred
+            self.deferred = deferred
+            for u in users:
+                self.request_window_freed(u)
+
+    def request_window_freed(self, user):
+        if self.deferred != None:
+            self.deferred.add(user)
+        else:
+            self.send_queued(user)
+
     def call_slave_handler(self, user, request):
         """ Fetch slave: handle incoming fetch request, call slavehandler """
 
@@ -267,6 +416,9 @@ class Fetcher_Plugin(Plugin):
         if ureqs != None:
             if pop:
                 req = ureqs.pop(rid, None)
+                pendingtimeouts.remove((user, rid))
+                if len(ureqs) == 0:
+                    pendingreqs.pop(user)
             else:
                 req = ureqs.get(rid)
         else:
@@ -274,9 +426,47 @@ class Fetcher_Plugin(Plugin):
         return req
 
     def set_pending(self, users, req):
+        """ The request is answered with None if no reply arrives in
+        TP_FETCH_TIMEOUT seconds. """
+
         for user in users:
             ureqs = pendingreqs.setdefault(user, {})
             ureqs[req.rid] = req
+            pendingtimeouts.add((user, req.rid), TP_FETCH_TIMEOUT)
 
 def init(options):
     Fetcher_Plugin()
+
+def test_handle_msgs():
+    """ A handler that raises in a batch does not leave queued requests
+    of other users deferred """
+
+    plugin = Fetcher_Plugin()
+    sent = []
+    plugin.send_queued = sent.append
+
+    def handle_msg(user, msg):
+        plugin.request_window_freed(user)
+        if msg == 'raise':
+            raise ValueError
+
+    plugin.handle_msg = handle_msg
+    plugin.handle_msgs('alice', ['ok', 'ok'])
+    assert(sent == ['alice'])
+    try:
+        plugin.handle_msgs('alice', ['ok', 'raise', 'ok'])
+        assert(False)
+    except ValueError:
+        pass
+    assert(plugin.deferred == None and sent == ['alice', 'alice'])
+    plugin.request_window_freed('bob')
+    assert(sent == ['alice', 'alice', 'bob'])
+
+    # The rest of the batch is dropped when accept() returns False
+    handled = []
+    plugin.handle_msg = lambda user, msg: handled.append(msg)
+    plugin.handle_msgs('carol', [1, 2, 3], accept=lambda msg: msg < 3)
+    assert(handled == [1, 2])
+
+if __name__ == '__main__':
+    test_handle_msgs()
@@ -8,19 +8,20 @@
 # This software is licensed under The Clear BSD license.
 # See the LICENSE file for more details.
 #
-from copy import deepcopy
-from gobject import timeout_add, source_remove, io_add_watch, IO_OUT, PRIORITY_LOW
 import os
 from random import randrange, shuffle
 import tempfile
+from time import time
 from errno import ENXIO, EINTR, EAGAIN
 
-from bencode import fmt_bdecode, bencode
-from ioutils import TCP_Queue, filesize, TCPQ_ERROR
+from bencode import Bencached, fmt_bdecode, bencode
+from ioutils import TCP_Queue, filesize, TCPQ_ERROR, TCPQ_ROLE_GET_FILE, \
+     timeout_add, source_remove, io_add_watch, IO_OUT, PRIORITY_LOW, \
+     Timeout_Heap
 from content import Content_Meta
 from plugins import Plugin, get_plugin_by_type
 from support import info, warning, debug
-from typevalidator import ANY, ZERO_OR_MORE, ONE_OR_MORE, OPTIONAL_KEY, validate
+from typevalidator import ANY, ZERO_OR_MORE, ONE_OR_MORE, OPTIONAL_KEY, compile as compile_spec, validate
 from proximateprotocol import PLUGIN_TYPE_COMMUNITY, PLUGIN_TYPE_FETCHER, \
      PLUGIN_TYPE_FILE_SHARING, PLUGIN_TYPE_STATE, \
      PLUGIN_TYPE_FILE_TRANSFER, PLUGIN_TYPE_NOTIFICATION, \
@@ -28,7 +29,7 @@ from proximateprotocol import PLUGIN_TYPE_COMMUNITY, PLUGIN_TYPE_FETCHER, \
      FS_PURPOSE_SHARE, FS_GID_LIMIT, FS_REPLICATE_DEFAULT_TTL, \
      FS_REPLICATE_MAX_SIZE, FS_REPLICATE_MAX_TTL, FS_REPLICATE_STORE_MAX, \
      FS_MAX_SHARES_TO_CHECK, valid_fs_gid, SHARE_BOGUS, \
-     SHARE_DIR, SHARE_FILE, TP_MAX_TRANSFER, PLUGIN_TYPE_SETTINGS
+     SHARE_DIR, SHARE_FILE, PLUGIN_TYPE_SETTINGS
 from proximatestate import normal_traffic_mode
 from utils import stepsafexrange, str_to_int, strip_extra_slashes, \
     unique_elements, timet_to_datetime, str_to_timet, \
@@ -100,10 +101,10 @@ def search_filelist(names, qany, filelist):
     return results
 
 class Get_File:
-    ackspec = {'flen': lambda flen: (type(flen) == int or type(flen) == long) and flen >= 0}
+    ackspec = compile_spec({'flen': lambda flen: (type(flen) == int or type(flen) == long) and flen >= 0})
 
     def __init__(self, user, name, files, cb, ctx, silent, totallen):
-        self.q = TCP_Queue(self.msghandler, closehandler=self.queue_closed)
+        self.q = TCP_Queue(self.msghandler, closehandler=self.queue_closed, role=TCPQ_ROLE_GET_FILE)
         self.user = user
         self.f = None
         self.name = name
@@ -172,7 +173,7 @@ class Get_File:
         return True
 
     def msghandler(self, q, data, parameter):
-        d = fmt_bdecode(self.ackspec, data)
+        d = fmt_bdecode(self.ackspec, data, skipunknown=True)
         if d == None:
             warning('get file: invalid msg: %s\n' % data)
             return False
@@ -233,11 +234,11 @@ class Get_File:
 class Get_File_Server:
     """ Process incoming file request connection """
 
-    hellospec = {'uid': str}
-    getspec = {'id': int, 'path': str}
+    hellospec = compile_spec({'uid': str})
+    getspec = compile_spec({'id': int, 'path': str, OPTIONAL_KEY('keepalive'): ANY})
 
     def __init__(self, address, sock, data):
-        self.q = TCP_Queue(self.msghandler, closehandler=self.queue_closed)
+        self.q = TCP_Queue(self.msghandler, closehandler=self.queue_closed, role=TCPQ_ROLE_GET_FILE)
 
         # Close queue that is idle for a period of time
         self.q.set_timeout(TP_CONNECT_TIMEOUT)
@@ -272,7 +273,7 @@ class Get_File_Server:
             spec = self.hellospec
         else:
             spec = self.getspec
-        d = fmt_bdecode(spec, data)
+        d = fmt_bdecode(spec, data, skipunknown=True)
         if d == None:
             warning('file server: invalid msg: %s\n' % data)
             return False
@@ -316,49 +317,38 @@ class Get_File_Server:
 
         self.q.write(bencode({'flen': self.flen}))
 
-        self.q.set_send_handler(self.send)
+        # The kernel copies the file to the socket after the header
+        self.q.send_file(self.f, 0, self.flen, self.sent)
         self.q.throttle()
         return True
 
-    def send(self):
-        amount = min(TP_MAX_TRANSFER * 4, self.flen - self.pos)
-
-        if not self.keepalive and amount == 0:
-            # Close the connection, as the client does not support persistent
-            # connections
-            self.q.set_send_handler(None)
-            self.q.close_after_send()
-            return ''
-
-        try:
-            chunk = self.f.read(amount)
-        except IOError, (errno, strerror):
-            self.q.close(TCPQ_ERROR, msg=strerror)
-            return None
-
+    def sent(self, amount):
         self.pos += amount
 
         if self.ui != None:
             self.ui.update(amount)
 
-        if self.pos == self.flen:
-            self.f.close()
-            self.f = None
-            if self.ui != None:
-                self.ui.cleanup('End')
-                self.ui = None
-            notification.notify('Sent a file to %s succefully: %s' % (self.user.get('nick'), self.name))
-            if self.keepalive:
-                self.q.set_send_handler(None)
-                self.q.throttle(False)
+        if self.pos < self.flen:
+            return
 
-        return chunk
+        self.f.close()
+        self.f = None
+        if self.ui != None:
+            self.ui.cleanup('End')
+            self.ui = None
+        notification.notify('Sent a file to %s succefully: %s' % (self.user.get('nick'), self.name))
+        if self.keepalive:
+            self.q.throttle(False)
+        else:
+            # Close the connection, as the client does not support
+            # persistent connections
+            self.q.close_after_send()
 
 class Stream:
-    ackspec = {'flen': lambda flen: (type(flen) == int or type(flen) == long) and flen >= 0}
+    ackspec = compile_spec({'flen': lambda flen: (type(flen) == int or type(flen) == long) and flen >= 0})
 
     def __init__(self, user, shareid, sharepath):
-        self.q = TCP_Queue(self.msghandler, closehandler=self.queue_closed)
+        self.q = TCP_Queue(self.msghandler, closehandler=self.queue_closed, role=TCPQ_ROLE_GET_FILE)
         self.user = user
         self.fd = None
         self.shareid = shareid
@@ -417,7 +407,7 @@ class Stream:
 
     def msghandler(self, q, data, parameter):
         self.initstate = False
-        d = fmt_bdecode(self.ackspec, data)
+        d = fmt_bdecode(self.ackspec, data, skipunknown=True)
         if d == None:
             warning('get file: invalid msg: %s\n' % data)
             return False
@@ -757,7 +747,12 @@ class Share:
             return
         meta.save_meta(path)
 
-class Share_Meta:
+# Share_Meta.priv dictionaries are shared between metas until they are
+# changed
+MY_SHARE_PRIV = {'mine': True, 'shared': False}
+OTHERS_SHARE_PRIV = {'mine': False, 'shared': False}
+
+class Share_Meta(object):
     """ 'gid' is a message identifier that is unique in probabilistic sense.
         It can be collided by anyone. 'gid' should be a 64-bit (random)
         unsigned integer less than FS_GID_LIMIT. Python does not limit the
@@ -767,19 +762,21 @@ class Share_Meta:
         than 64-bits. The downside is the increased chance for gid collision.
     """
 
-    validator = {str: ANY,
-                 'id': lambda i: type(i) == int and i >= 0,
-                 'purpose': lambda s: type(s) == str and len(s) > 0,
-                 'description': str,
-                 'type': lambda s: s in [SHARE_BOGUS, SHARE_DIR, SHARE_FILE],
-                 OPTIONAL_KEY('community'): lambda s: valid_community(s),
-                 OPTIONAL_KEY('dst'): str,
-                 OPTIONAL_KEY('gid'): valid_fs_gid,
-                 OPTIONAL_KEY('src'): str,
-                 OPTIONAL_KEY('timestart'): int,  # time_t
-                 OPTIONAL_KEY('timeend'): int,    # time_t
-                 OPTIONAL_KEY('ttl'): lambda i: type(i) == int and i >= 0,
-                }
+    __slots__ = ['d', 'priv', 'bencached']
+
+    validator = compile_spec({str: ANY,
+                              'id': lambda i: type(i) == int and i >= 0,
+                              'purpose': lambda s: type(s) == str and len(s) > 0,
+                              'description': str,
+                              'type': lambda s: s in [SHARE_BOGUS, SHARE_DIR, SHARE_FILE],
+                              OPTIONAL_KEY('community'): lambda s: valid_community(s),
+                              OPTIONAL_KEY('dst'): str,
+                              OPTIONAL_KEY('gid'): valid_fs_gid,
+                              OPTIONAL_KEY('src'): str,
+                              OPTIONAL_KEY('timestart'): int,  # time_t
+                              OPTIONAL_KEY('timeend'): int,    # time_t
+                              OPTIONAL_KEY('ttl'): lambda i: type(i) == int and i >= 0,
+                             })
 
     def __init__(self, d=None):
         """ Dictionary items in d are imported into the Share_Meta instance
@@ -790,14 +787,15 @@ class Share_Meta:
         # Usually this happens when one gets a Share_Meta from another peer.
         # 'mine' attribute is False iff the published item was not created
         # by myself.
-        self.priv = {'mine': True,
-                     'shared': False,
-                    }
+        self.priv = MY_SHARE_PRIV
         self.d = {'description': ''}
         if d != None:
             for (key, value) in d.items():
                 self.d[key] = value
 
+        # Bencached self.d. Reset by set() and unserialize().
+        self.bencached = None
+
     def __str__(self):
         return 'Share_Meta ' + str(self.d)
 
@@ -829,17 +827,33 @@ class Share_Meta:
             generate_meta_gid(self)
         self.set_priv('mine', True)
 
+    def get_bencached(self):
+        """ Returns self.d as a Bencached object that can be embedded in
+        messages. Values must be changed with set(), because the encoding
+        is cached. """
+
+        if self.bencached == None:
+            self.bencached = Bencached(bencode(self.d))
+        return self.bencached
+
     def serialize(self):
-        return deepcopy(self.d)
+        return self.d.copy()
 
     def serialize_to_disk(self):
-        return (self.serialize(), deepcopy(self.priv))
+        return (self.serialize(), self.priv.copy())
 
     def set(self, name, value):
         self.d[name] = value
+        self.bencached = None
 
     def set_priv(self, name, value):
-        self.priv[name] = value
+        # Copy on write
+        priv = self.priv.copy()
+        priv[name] = value
+        for shared in (MY_SHARE_PRIV, OTHERS_SHARE_PRIV):
+            if priv == shared:
+                priv = shared
+        self.priv = priv
 
     def set_time(self, name, s):
         # Convert timestamp string to time_t integer
@@ -868,7 +882,7 @@ class Share_Meta:
         ttl = self.get('ttl')
         if ttl == None or ttl <= 1:
             return False
-        if len(bencode(self.d)) > FS_REPLICATE_MAX_SIZE:
+        if len(self.get_bencached().bencoded) > FS_REPLICATE_MAX_SIZE:
             warning('Too large a chunk to be replicated: %s\n' % str(self.d))
             return False
         return not self.test_expiration()
@@ -877,8 +891,15 @@ class Share_Meta:
         if not self.validate(metadict):
             warning('Invalid metadict: %s\n' % str(metadict))
             self.d = {}
+            self.bencached = None
             return False
-        self.d = deepcopy(metadict)
+        # Values are not copied, because they are not modified in place.
+        # Key names are shared between metas.
+        d = {}
+        for (key, value) in metadict.iteritems():
+            d[intern(key)] = value
+        self.d = d
+        self.bencached = None
         self.set_priv('mine', False)
         return True
 
@@ -888,7 +909,10 @@ class Share_Meta:
             return False
         if not self.unserialize(metainfo[0]):
             return False
-        self.priv = deepcopy(metainfo[1])
+        if type(metainfo[1]) != dict:
+            warning('Invalid metainfo in database: %s\n' % str(metainfo))
+            return False
+        self.priv = dict(metainfo[1])
         return self.priv.get('mine') == True
 
     def validate(self, d=None):
@@ -919,9 +943,36 @@ class File_Sharing_Plugin(Plugin):
     CMD_LIST_SHARES      = 'list_shares'
     CMD_QUERY            = 'query'
 
-    listsharesspec = {OPTIONAL_KEY('ids'): [ZERO_OR_MORE, int],
-                      OPTIONAL_KEY('purpose'): str,
-                     }
+    # Validators for requests and replies from other users
+    listsharesspec = compile_spec({OPTIONAL_KEY('ids'): [ZERO_OR_MORE, int],
+                                   OPTIONAL_KEY('purpose'): str,
+                                  })
+    sharelistspec = compile_spec({'uid': str,
+                                  'metas': [ZERO_OR_MORE, {}],
+                                 })
+    getmetasspec = compile_spec({
+        'shareids': [ZERO_OR_MORE, lambda x: type(x) == int and x >= 0],
+        'sharepaths': [ZERO_OR_MORE, str],
+        })
+    metasreplyspec = compile_spec({
+        'shareids': [ZERO_OR_MORE, lambda x: type(x) == int and x >= 0],
+        'sharepaths': [ZERO_OR_MORE, str],
+        'metas': [ZERO_OR_MORE, {}],
+        })
+    queryspec = compile_spec({'shareid': int,
+                              'rfields': [ONE_OR_MORE, str],
+                              OPTIONAL_KEY('path'): str,
+                             })
+    queryreplyspec = compile_spec({
+        'rfields': lambda l: l == ['shareid', 'name', 'size', 'type'],
+        'shareid': [ZERO_OR_MORE, lambda x: type(x) == int and x >= 0],
+        'name': [ZERO_OR_MORE, str],
+        'size': [ZERO_OR_MORE, lambda x: type(x) == int and x >= 0],
+        'type': [ZERO_OR_MORE, lambda x: type(x) == int and x >= 0],
+        'metas': {int: {}},
+        })
+    criteriaspec = compile_spec({str: str})
+    keywordsspec = compile_spec([ONE_OR_MORE, str])
 
     def __init__(self):
         self.register_plugin(PLUGIN_TYPE_FILE_SHARING)
@@ -930,6 +981,9 @@ class File_Sharing_Plugin(Plugin):
         # my shares
         self.shares = {}
 
+        # Replicated shares are removed when they expire
+        self.sharetimeouts = Timeout_Heap(self.share_expired)
+
         self.subs = []
 
         self.sharestocheck = []
@@ -988,6 +1042,10 @@ class File_Sharing_Plugin(Plugin):
         self.shares[shareid] = share
         register_meta_gid(sharemeta)
         sharemeta.set_priv('shared', True)
+
+        timeend = sharemeta.get('timeend')
+        if timeend != None and not sharemeta.get_priv('mine'):
+            self.sharetimeouts.add(shareid, timeend - time())
         return share
 
     def gen_share_list(self, shareids, purpose=None):
@@ -995,7 +1053,7 @@ class File_Sharing_Plugin(Plugin):
         for shareid in shareids:
             share = self.get_share(shareid, purpose=purpose)
             if share != None:
-                metas.append(share.serialize())
+                metas.append(share.meta.get_bencached())
         return {'uid': community.get_myuid(),
                 'metas': metas,
                }
@@ -1088,10 +1146,7 @@ class File_Sharing_Plugin(Plugin):
         self.list_user_shares(user, check_user_shares_handler, None, shareids=shareids)
 
     def process_share_list(self, request):
-        validator = {'uid': str,
-                     'metas': [ZERO_OR_MORE, {}],
-                    }
-        if not validate(validator, request):
+        if not validate(self.sharelistspec, request):
             return None
 
         metas = []
@@ -1229,12 +1284,7 @@ class File_Sharing_Plugin(Plugin):
             callback(metas, ctx)
             return
 
-        validator = {
-            'shareids': [ZERO_OR_MORE, lambda x: type(x) == int and x >= 0],
-            'sharepaths': [ZERO_OR_MORE, str],
-            'metas': [ZERO_OR_MORE, {}],
-            }
-        if not validate(validator, reply):
+        if not validate(self.metasreplyspec, reply):
             warning('Invalid get_metas reply: %s\n' %(str(reply)))
             callback(metas, ctx)
             return
@@ -1255,15 +1305,7 @@ class File_Sharing_Plugin(Plugin):
             callback(user, None, {}, ctx)
             return
 
-        validator = {
-            'rfields': lambda l: l == ['shareid', 'name', 'size', 'type'],
-            'shareid': [ZERO_OR_MORE, lambda x: type(x) == int and x >= 0],
-            'name': [ZERO_OR_MORE, str],
-            'size': [ZERO_OR_MORE, lambda x: type(x) == int and x >= 0],
-            'type': [ZERO_OR_MORE, lambda x: type(x) == int and x >= 0],
-            'metas': {int: {}},
-            }
-        if not validate(validator, reply):
+        if not validate(self.queryreplyspec, reply):
             warning('Invalid query reply: %s\n' %(str(reply)))
             callback(user, None, {}, ctx)
             return
@@ -1349,7 +1391,7 @@ class File_Sharing_Plugin(Plugin):
 
         self.indicator = notification.get_progress_indicator('File sharing')
 
-        fetcher.register_handler(PLUGIN_TYPE_FILE_SHARING, self.slave_handler, 'filesharing')
+        fetcher.register_handler(PLUGIN_TYPE_FILE_SHARING, self.slave_handler, 'filesharing', priority=fetcher.PRIORITY_LOW)
 
         settings = get_plugin_by_type(PLUGIN_TYPE_SETTINGS)
         self.download_path_setting = settings.register('filesharing.download_path', str, 'Download path', default=None, validator=self.validate_path)
@@ -1444,12 +1486,19 @@ class File_Sharing_Plugin(Plugin):
         return sharefiles.has_key(sharepath)
 
     def remove_share(self, share):
+        self.sharetimeouts.remove(share.get_id())
         if self.shares.pop(share.get_id(), None) != None:
             share.deinit()
             self.save_shares()
         else:
             warning('Share %d already removed\n' % share.get_id())
 
+    def share_expired(self, shareid):
+        share = self.shares.get(shareid)
+        if share != None:
+            debug('Replicated share expired: %s\n' % str(share.meta))
+            self.remove_share(share)
+
     def remove_subscription(self, purpose):
         """ Remove all subscribtions whose purpose matches the given one """
 
@@ -1504,11 +1553,7 @@ class File_Sharing_Plugin(Plugin):
     def slave_get_metas(self, user, request):
         """ slave side handler for file/directory meta requests """
 
-        validator = {
-            'shareids': [ZERO_OR_MORE, lambda x: type(x) == int and x >= 0],
-            'sharepaths': [ZERO_OR_MORE, str],
-            }
-        if not validate(validator, request):
+        if not validate(self.getmetasspec, request):
             warning('Invalid slave_get_metas request: %s\n' %(str(request)))
             return None
 
@@ -1557,11 +1602,7 @@ class File_Sharing_Plugin(Plugin):
         return self.gen_share_list(shareids, purpose=purpose)
 
     def slave_query(self, user, request):
-        validator = {'shareid': int,
-                     'rfields': [ONE_OR_MORE, str],
-                     OPTIONAL_KEY('path'): str,
-                    }
-        if not validate(validator, request):
+        if not validate(self.queryspec, request):
             warning('Invalid query: %s\n' %(str(request)))
             return fetcher.SILENT_COMMUNITY_ERROR
         request.setdefault('path', '/')
@@ -1591,11 +1632,11 @@ class File_Sharing_Plugin(Plugin):
         criteria = request.get('criteria')
         keywords = request.get('keywords')
         if criteria != None:
-            if not validate({str: str}, criteria):
+            if not validate(self.criteriaspec, criteria):
                 warning('Invalid criteria\n')
                 return fetcher.SILENT_COMMUNITY_ERROR
         elif keywords != None:
-            if not validate([ONE_OR_MORE, str], keywords):
+            if not validate(self.keywordsspec, keywords):
                 warning('Invalid keywords\n')
                 return fetcher.SILENT_COMMUNITY_ERROR
 
@@ -1620,7 +1661,7 @@ class File_Sharing_Plugin(Plugin):
             if filelist == {}:
                 continue
 
-            metadict[share.meta.get('id')] = share.meta.serialize()
+            metadict[share.meta.get('id')] = share.meta.get_bencached()
 
             # Generate result listing
             for (sharename, ftype) in filelist.items():
@@ -8,22 +8,35 @@
 # This software is licensed under The Clear BSD license.
 # See the LICENSE file for more details.
 #
-from gobject import io_add_watch, timeout_add, source_remove, IO_IN, IO_OUT, \
-     PRIORITY_LOW
+from collections import deque
+from heapq import heapify, heappop, heappush
 from os import SEEK_END
 from socket import AF_INET, SOCK_DGRAM, SOCK_STREAM, SOL_SOCKET, \
-     SO_BROADCAST, SO_ERROR, SO_REUSEADDR, socket, error, herror, gaierror, \
-     inet_ntoa, inet_aton
-from errno import EAGAIN, EINPROGRESS, EINTR, EADDRNOTAVAIL
+     SO_BROADCAST, SO_ERROR, SO_REUSEADDR, SO_RCVBUF, SO_SNDBUF, socket, \
+     IPPROTO_IP, IP_ADD_MEMBERSHIP, error, herror, gaierror, inet_ntoa, \
+     inet_aton
+from errno import EAGAIN, EINPROGRESS, EINTR, EADDRNOTAVAIL, EINVAL, ENOSYS
 import fcntl
+import select
 import struct
 import os
+from time import time
 
 from support import debug, die, warning
 from proximateprotocol import TP_MAX_TRANSFER, TP_MAX_RECORD_SIZE
-from utils import str_to_int
 from plugins import get_plugin_by_type
 
+# IO conditions and priorities for io_add_watch(). The values are the same
+# as in gobject (and epoll).
+IO_IN = 1
+IO_PRI = 2
+IO_OUT = 4
+IO_ERR = 8
+IO_HUP = 16
+
+PRIORITY_DEFAULT = 0
+PRIORITY_LOW = 300
+
 TCPQ_NO_CONNECTION = 0
 TCPQ_OK = 1
 TCPQ_EOF = 2
@@ -35,6 +48,395 @@ TCPQ_PROTOCOL_VIOLATION = 7
 TCPQ_CONNECTING = 8
 TCPQ_ERROR = 9
 
+# Listen backlog for TCP listeners. A node may get hundreds of connection
+# attempts at once. The kernel caps this to net.core.somaxconn.
+TCP_LISTEN_BACKLOG = 1024
+
+# Initial size of the TCP_Queue receive buffer. The buffer grows on demand
+# to hold a whole record, and is shrunk back to this size when it drains.
+TCPQ_RECV_BUFFER_SIZE = 4 * TP_MAX_TRANSFER
+
+# Default high-water mark for pending output. The send handler is not asked
+# for more data while this many bytes are queued for sending.
+TCPQ_OUTPUT_HIGH_WATER = 16 * TP_MAX_TRANSFER
+
+# Maximum number of buffers passed to a single sendmsg() call
+TCPQ_MAX_IOV = 64
+
+# Maximum number of bytes copied by a single sendfile() call
+TCPQ_SENDFILE_CHUNK = 64 * TP_MAX_TRANSFER
+
+# Read and write sizes adapt between TP_MAX_TRANSFER and this value.
+# They grow while the socket fills the whole window (bulk transfers), and
+# shrink back for small RPC traffic.
+TCPQ_MAX_WINDOW = 64 * TP_MAX_TRANSFER
+
+# TCP_Queue roles. Socket buffer sizes can be set per role.
+TCPQ_ROLE_FETCH = 'fetch'
+TCPQ_ROLE_GET_FILE = 'get-file'
+TCPQ_ROLE_SEND_FILE = 'send-file'
+
+# role -> (SO_RCVBUF, SO_SNDBUF). None means the kernel default, which
+# allows the kernel to autotune buffer sizes.
+socket_buffer_sizes = {
+    TCPQ_ROLE_FETCH: (None, None),
+    TCPQ_ROLE_GET_FILE: (None, None),
+    TCPQ_ROLE_SEND_FILE: (None, None),
+    }
+
+have_sendmsg = hasattr(socket, 'sendmsg')
+
+# Python 2 has no monotonic clock, so clock_gettime() is called through
+# ctypes. time() is used if that is not possible.
+CLOCK_MONOTONIC = 1
+
+have_monotonic_clock = True
+try:
+    import ctypes
+    import ctypes.util
+
+    class Timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'libc.so.6')
+    clock_gettime = librt.clock_gettime
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(Timespec)]
+except (ImportError, OSError, AttributeError):
+    have_monotonic_clock = False
+
+def monotonic_time():
+    """ Returns time in seconds from an arbitrary starting point. Unlike
+    time(), the value does not jump when the wall clock is changed. """
+
+    if not have_monotonic_clock:
+        return time()
+    ts = Timespec()
+    clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts))
+    return ts.tv_sec + ts.tv_nsec * 1e-9
+
+# Python 2 has no os.sendfile(), so sendfile(2) is called through ctypes.
+# File bodies are read into the send queue if that is not possible.
+have_sendfile = True
+try:
+    import ctypes
+    import ctypes.util
+
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    c_sendfile = libc.sendfile64
+    c_sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+    c_sendfile.restype = ctypes.c_ssize_t
+except (ImportError, OSError, AttributeError):
+    have_sendfile = False
+
+def sendfile(outfd, infd, offset, count):
+    """ Copy at most 'count' bytes from file descriptor 'infd' starting
+    from 'offset' to 'outfd' in the kernel. Returns the number of bytes
+    copied. Raises OSError like os.sendfile(). """
+
+    off = ctypes.c_int64(offset)
+    n = c_sendfile(outfd, infd, ctypes.byref(off), count)
+    if n < 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+    return n
+
+class GObject_Event_Loop:
+    """ Event loop backend that uses the gobject main loop. This is the
+    default backend, and is required by the GTK GUI. """
+
+    def __init__(self):
+        import gobject
+        self.gobject = gobject
+        self.mainloop = None
+
+    def io_add_watch(self, fd, condition, callback, *args, **kwargs):
+        return self.gobject.io_add_watch(fd, condition, callback, *args, **kwargs)
+
+    def timeout_add(self, interval, callback, *args, **kwargs):
+        return self.gobject.timeout_add(interval, callback, *args, **kwargs)
+
+    def timeout_add_seconds(self, interval, callback, *args, **kwargs):
+        return self.gobject.timeout_add_seconds(interval, callback, *args, **kwargs)
+
+    def source_remove(self, tag):
+        return self.gobject.source_remove(tag)
+
+    def run(self):
+        self.mainloop = self.gobject.MainLoop()
+        self.mainloop.run()
+
+    def quit(self):
+        if self.mainloop != None:
+            self.mainloop.quit()
+
+class Epoll_Event_Loop:
+    """ Event loop backend based on epoll. It does not need gobject, so it
+    can be used to run networking plugins without GTK. Callbacks follow the
+    gobject conventions: a watch or a timeout is removed when its callback
+    returns False. Priorities are accepted but ignored.
+
+    iteration() can be used to drive the loop step by step, e.g. in tests.
+    """
+
+    def __init__(self):
+        self.epoll = select.epoll()
+        self.watches = {}      # tag -> (fd object, fileno, condition, callback, args)
+        self.fdtags = {}       # fileno -> list of watch tags
+        self.fdmasks = {}      # fileno -> registered epoll mask
+        self.timeouts = {}     # tag -> (interval, callback, args)
+        self.timeoutheap = []  # (deadline, tag)
+        self.nexttag = 1
+        self.running = False
+
+    def new_tag(self):
+        tag = self.nexttag
+        self.nexttag += 1
+        return tag
+
+    def update_fd(self, fileno):
+        """ Register the union of watched conditions for fileno """
+
+        tags = self.fdtags.get(fileno, [])
+        mask = 0
+        for tag in tags:
+            mask |= self.watches[tag][2]
+        registered = self.fdmasks.has_key(fileno)
+        try:
+            if len(tags) == 0:
+                self.fdtags.pop(fileno, None)
+                self.fdmasks.pop(fileno, None)
+                if registered:
+                    self.epoll.unregister(fileno)
+            elif not registered:
+                self.epoll.register(fileno, mask)
+            elif mask != self.fdmasks[fileno]:
+                self.epoll.modify(fileno, mask)
+        except (IOError, OSError), (errno, strerror):
+            # Closing an fd removes it from the epoll set. The fd may have
+            # been closed and reused behind our back.
+            if len(tags) > 0:
+                try:
+                    self.epoll.register(fileno, mask)
+                except (IOError, OSError):
+                    self.epoll.modify(fileno, mask)
+        if len(tags) > 0:
+            self.fdmasks[fileno] = mask
+
+    def io_add_watch(self, fd, condition, callback, *args, **kwargs):
+        if type(fd) == int:
+            fileno = fd
+        else:
+            fileno = fd.fileno()
+        tag = self.new_tag()
+        self.watches[tag] = (fd, fileno, condition, callback, args)
+        self.fdtags.setdefault(fileno, []).append(tag)
+        self.update_fd(fileno)
+        return tag
+
+    def timeout_add(self, interval, callback, *args, **kwargs):
+        """ interval is given in milliseconds """
+
+        tag = self.new_tag()
+        self.timeouts[tag] = (interval / 1000.0, callback, args)
+        heappush(self.timeoutheap, (monotonic_time() + interval / 1000.0, tag))
+        return tag
+
+    def timeout_add_seconds(self, interval, callback, *args, **kwargs):
+        return self.timeout_add(interval * 1000, callback, *args)
+
+    def source_remove(self, tag):
+        if self.timeouts.pop(tag, None) != None:
+            # The heap entry is skipped when it expires
+            return True
+        watch = self.watches.pop(tag, None)
+        if watch == None:
+            return False
+        fileno = watch[1]
+        self.fdtags[fileno].remove(tag)
+        self.update_fd(fileno)
+        return True
+
+    def iteration(self, block = True):
+        """ Wait for events and dispatch them. If block == False, only
+        dispatch events that are ready. """
+
+        timeout = 0
+        if block:
+            timeout = -1
+            if len(self.timeoutheap) > 0:
+                timeout = max(0, self.timeoutheap[0][0] - monotonic_time())
+
+        try:
+            events = self.epoll.poll(timeout)
+        except (IOError, OSError), (errno, strerror):
+            if errno != EINTR:
+                raise
+            events = []
+
+        for (fileno, mask) in events:
+            for tag in list(self.fdtags.get(fileno, [])):
+                watch = self.watches.get(tag)
+                if watch == None:
+                    continue
+                (fd, fileno, condition, callback, args) = watch
+                cond = mask & (condition | IO_ERR | IO_HUP)
+                if cond != 0 and not callback(fd, cond, *args):
+                    self.source_remove(tag)
+
+        now = monotonic_time()
+        while len(self.timeoutheap) > 0 and self.timeoutheap[0][0] <= now:
+            (deadline, tag) = heappop(self.timeoutheap)
+            timer = self.timeouts.get(tag)
+            if timer == None:
+                continue
+            (interval, callback, args) = timer
+            if callback(*args):
+                if self.timeouts.has_key(tag):
+                    heappush(self.timeoutheap, (max(deadline + interval, now), tag))
+            else:
+                self.timeouts.pop(tag, None)
+
+    def run(self):
+        self.running = True
+        while self.running:
+            self.iteration()
+
+    def quit(self):
+        self.running = False
+
+eventloop = None
+
+def get_event_loop():
+    global eventloop
+    if eventloop == None:
+        eventloop = GObject_Event_Loop()
+    return eventloop
+
+def set_event_loop(loop):
+    """ Select the event loop backend. This must be called before any
+    watches or timeouts are installed. """
+
+    global eventloop
+    eventloop = loop
+
+def io_add_watch(fd, condition, callback, *args, **kwargs):
+    """ Call callback(fd, condition, *args) when condition holds for fd.
+    Returns a tag for source_remove(). """
+
+    return get_event_loop().io_add_watch(fd, condition, callback, *args, **kwargs)
+
+def timeout_add(interval, callback, *args, **kwargs):
+    """ Call callback(*args) every 'interval' milliseconds until it
+    returns False. Returns a tag for source_remove(). """
+
+    return get_event_loop().timeout_add(interval, callback, *args, **kwargs)
+
+def timeout_add_seconds(interval, callback, *args, **kwargs):
+    return get_event_loop().timeout_add_seconds(interval, callback, *args, **kwargs)
+
+def source_remove(tag):
+    return get_event_loop().source_remove(tag)
+
+class Timeout_Heap:
+    """ A set of keys with deadlines. expirehandler(key) is called for each
+    key whose deadline has passed. A single event loop timeout is armed
+    for the earliest deadline, so the cost of expiring is proportional to
+    the number of keys that actually expire.
+
+    Adding a key is O(log n). Removing a key is O(1): its heap entry is
+    skipped when it comes up. 'clock' returns the current time in seconds.
+    """
+
+    def __init__(self, expirehandler, clock=monotonic_time):
+        self.expirehandler = expirehandler
+        self.clock = clock
+        self.heap = []         # (deadline, sequence number, key)
+        self.deadlines = {}    # key -> deadline
+        self.seq = 0
+        self.tag = None
+        self.armed = None      # deadline of the armed timeout
+
+    def __contains__(self, key):
+        return self.deadlines.has_key(key)
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def add(self, key, delay):
+        """ Expire key after 'delay' seconds. An existing deadline of the
+        key is replaced. """
+
+        self.add_at(key, self.clock() + delay)
+
+    def add_at(self, key, deadline):
+        """ Expire key when clock() reaches 'deadline' """
+
+        self.deadlines[key] = deadline
+        heappush(self.heap, (deadline, self.seq, key))
+        self.seq += 1
+        if len(self.heap) > 2 * len(self.deadlines) + 64:
+            self.compact()
+        self.arm()
+
+    def arm(self):
+        heap = self.heap
+        while len(heap) > 0 and self.deadlines.get(heap[0][2]) != heap[0][0]:
+            heappop(heap)
+        if len(heap) == 0:
+            self.disarm()
+            return
+        deadline = heap[0][0]
+        if self.tag != None and self.armed <= deadline:
+            # The armed timeout comes early enough
+            return
+        self.disarm()
+        delay = max(0, deadline - self.clock())
+        self.tag = timeout_add(int(delay * 1000) + 1, self.timeout)
+        self.armed = deadline
+
+    def compact(self):
+        """ Drop heap entries of removed and rescheduled keys """
+
+        self.heap = filter(lambda (deadline, seq, key): self.deadlines.get(key) == deadline, self.heap)
+        heapify(self.heap)
+
+    def disarm(self):
+        if self.tag != None:
+            source_remove(self.tag)
+            self.tag = None
+            self.armed = None
+
+    def expire(self):
+        """ Call expirehandler for keys whose deadline has passed. Returns
+        the number of expired keys. """
+
+        n = 0
+        now = self.clock()
+        # expirehandler may add keys, which can replace self.heap
+        while len(self.heap) > 0 and self.heap[0][0] <= now:
+            (deadline, seq, key) = heappop(self.heap)
+            if self.deadlines.get(key) != deadline:
+                continue
+            self.deadlines.pop(key)
+            n += 1
+            self.expirehandler(key)
+        return n
+
+    def get_deadline(self, key):
+        return self.deadlines.get(key)
+
+    def remove(self, key):
+        """ Returns True if the key was removed before it expired """
+
+        return self.deadlines.pop(key, None) != None
+
+    def timeout(self):
+        self.tag = None
+        self.armed = None
+        self.expire()
+        self.arm()
+        return False
+
 def bind_socket(sock, address, port):
     try:
         sock.bind((address, port))
@@ -85,7 +487,17 @@ def create_tcp_socket(address, port, reuse = False):
             debug('ioutils: Can not bind\n')
             return None
 
-        sock.listen(5)
+        # The role of an incoming connection is not known before the
+        # handshake, but the TCP window scale is fixed in it. Accepted
+        # sockets inherit the largest receive buffer of all roles.
+        rcvbuf = get_max_rcvbuf()
+        if rcvbuf != None:
+            try:
+                sock.setsockopt(SOL_SOCKET, SO_RCVBUF, rcvbuf)
+            except error, (errno, strerror):
+                warning('Can not set listening socket receive buffer size: %s\n' %(strerror))
+
+        sock.listen(TCP_LISTEN_BACKLOG)
 
     return sock
 
@@ -170,6 +582,26 @@ def create_udp_socket(address, port, bcast, reuse = False):
 
     return sock
 
+def create_multicast_socket(group, port):
+    """ Create a socket that listens to multicast group on port. The
+    group is joined on the default interface.
+
+    Returns the socket when successful, otherwise None."""
+
+    sock = create_udp_socket('', port, False, reuse = True)
+    if sock == None:
+        return None
+
+    mreq = struct.pack('4s4s', inet_aton(group), inet_aton('0.0.0.0'))
+    try:
+        sock.setsockopt(IPPROTO_IP, IP_ADD_MEMBERSHIP, mreq)
+    except error, (errno, strerror):
+        debug('ioutils error (%s): %s\n' %(errno, strerror))
+        sock.close()
+        return None
+
+    return sock
+
 def send_broadcast(address, bcast_port, msg):
     """ Send an UDP broadcast message. """
 
@@ -192,6 +624,84 @@ def send_broadcast(address, bcast_port, msg):
 
     return 0
 
+def send_datagrams(sock, address, port, datagrams):
+    """ Send a batch of UDP datagrams to (address, port) through a
+    non-blocking socket. Python has no sendmmsg(), so this is a tight
+    loop of sendto() calls. Returns the number of datagrams sent. The rest
+    are dropped if the socket buffer is full. """
+
+    n = 0
+    while n < len(datagrams):
+        try:
+            sock.sendto(datagrams[n], (address, port))
+        except error, (errno, strerror):
+            if errno == EINTR:
+                continue
+            if errno != EAGAIN:
+                warning('Error sending datagram to (%s, %d): %s\n' %(address, port, strerror))
+            break
+        n += 1
+    return n
+
+def recv_datagrams(sock, bufsize, maxcount):
+    """ Read up to 'maxcount' datagrams from a non-blocking socket. This
+    drains the socket with one wakeup under bursts. Returns a list of
+    (data, address) pairs, or None if the socket failed. """
+
+    datagrams = []
+    while len(datagrams) < maxcount:
+        try:
+            datagrams.append(sock.recvfrom(bufsize))
+        except error, (errno, strerror):
+            if errno == EINTR:
+                continue
+            if errno != EAGAIN:
+                warning('Socket error (%s): %s\n' %(errno, strerror))
+                if len(datagrams) == 0:
+                    return None
+            break
+    return datagrams
+
+def set_socket_buffer_sizes(role, rcvbuf, sndbuf):
+    """ Set SO_RCVBUF and SO_SNDBUF for TCP_Queues of the given role.
+    None leaves the kernel default. Affects queues connected after the
+    call, and listening sockets created after the call. """
+
+    if not socket_buffer_sizes.has_key(role):
+        warning('Unknown TCP_Queue role: %s\n' %(role))
+        return False
+    socket_buffer_sizes[role] = (rcvbuf, sndbuf)
+    return True
+
+def get_max_rcvbuf():
+    """ Returns the largest SO_RCVBUF of all roles, or None if no role
+    sets it """
+
+    sizes = filter(lambda rcvbuf: rcvbuf != None, map(lambda sizes: sizes[0], socket_buffer_sizes.values()))
+    if len(sizes) == 0:
+        return None
+    return max(sizes)
+
+def apply_socket_buffer_sizes(sock, role):
+    (rcvbuf, sndbuf) = socket_buffer_sizes.get(role, (None, None))
+    try:
+        if rcvbuf != None:
+            sock.setsockopt(SOL_SOCKET, SO_RCVBUF, rcvbuf)
+        if sndbuf != None:
+            sock.setsockopt(SOL_SOCKET, SO_SNDBUF, sndbuf)
+    except error, (errno, strerror):
+        warning('Can not set socket buffer sizes for %s: %s\n' %(role, strerror))
+
+def adapt_window(size, nbytes, maxsize):
+    """ Return a new read/write size given that the previous transfer of
+    'size' bytes moved 'nbytes' bytes. """
+
+    if nbytes >= size:
+        return min(2 * size, maxsize)
+    if nbytes < size // 4:
+        return max(size // 2, min(TP_MAX_TRANSFER, maxsize))
+    return size
+
 def valid_ip(ip):
     try:
         a = inet_aton(ip)
@@ -208,10 +718,11 @@ class TCP_Queue:
 
     initialized = False
 
-    def __init__(self, handler, parameter = None, closehandler = None):
+    def __init__(self, handler, parameter = None, closehandler = None, role = TCPQ_ROLE_FETCH):
         self.handler = handler
         self.parameter = parameter
         self.closehandler = closehandler
+        self.role = role
         self.status = TCPQ_NO_CONNECTION
 
         self.sock = None
@@ -223,17 +734,38 @@ class TCP_Queue:
 
         self.timeinterval = None
         self.maxsize = TP_MAX_RECORD_SIZE
+        # Current and maximum read and write sizes, see adapt_window()
+        self.rsize = TP_MAX_TRANSFER
+        self.maxrsize = TCPQ_MAX_WINDOW
         self.wsize = TP_MAX_TRANSFER
+        self.maxwsize = TCPQ_MAX_WINDOW
+        self.highwater = TCPQ_OUTPUT_HIGH_WATER
 
         self.bytestransferred = 0
         self.timeoutbytes = 1
 
-        self.inb = ''
-        self.outb = ''
+        # Received data is kept in a preallocated buffer. Unprocessed data
+        # is self.inb[self.inpos:self.inend].
+        self.inb = bytearray(TCPQ_RECV_BUFFER_SIZE)
+        self.inpos = 0
+        self.inend = 0
+        # Pending output is a queue of buffers. self.outpos bytes of the
+        # first buffer have already been sent.
+        self.outq = deque()
+        self.outpos = 0
+        self.outlen = 0
         self.msglen = None
 
         self.recv_handler = None
         self.send_handler = None
+        self.batch_handler = None
+
+        # File body that is sent after pending output, see send_file()
+        self.bodyfile = None
+        self.bodypos = 0
+        self.bodyleft = 0
+        self.bodyhandler = None
+        self.bodysendfile = have_sendfile
 
         self.closeaftersend = None
 
@@ -246,6 +778,9 @@ class TCP_Queue:
 
         self.sock.setblocking(False)
 
+        # Buffer sizes must be set before connect() to affect TCP window
+        apply_socket_buffer_sizes(self.sock, self.role)
+
         if not connect_socket(self.sock, address[0], address[1]):
             self.close(TCPQ_UNKNOWN_HOST, 'Unknown host')
             return False
@@ -279,6 +814,9 @@ class TCP_Queue:
         """ Called when connection is estabilished. """
 
         assert(self.status != TCPQ_OK)
+        if self.status != TCPQ_CONNECTING:
+            # An incoming connection
+            apply_socket_buffer_sizes(sock, self.role)
         self.sock = sock
         self.bytestransferred = 0
 
@@ -287,11 +825,11 @@ class TCP_Queue:
         if not self.throttled:
             self.readmode()
 
-        if len(self.inb) > 0:
+        if self.input_len() > 0:
             self.process()
 
         # Enable write mode if required
-        if len(self.outb) > 0 or self.send_handler != None:
+        if self.outlen > 0 or self.send_handler != None or self.bodyfile != None:
             self.writemode()
 
     def append_input(self, data):
@@ -305,7 +843,62 @@ class TCP_Queue:
         if self.status == TCPQ_OK:
             die('TCP_Queue: you may not insert data with append_input() after it has been initialized!\n')
 
-        self.inb += data
+        self.reserve_input(len(data))
+        self.inb[self.inend:(self.inend + len(data))] = data
+        self.inend += len(data)
+
+    def input_len(self):
+        """ Return the number of received bytes not yet processed. """
+
+        return self.inend - self.inpos
+
+    def get_input(self, n = None):
+        """ Return (at most) n bytes of unprocessed input as a string
+        without consuming them. All unprocessed input is returned if
+        n == None. """
+
+        end = self.inend
+        if n != None:
+            end = min(end, self.inpos + n)
+        return memoryview(self.inb)[self.inpos:end].tobytes()
+
+    def consume_input(self, n):
+        """ Discard n bytes from the beginning of unprocessed input. """
+
+        self.inpos = min(self.inpos + n, self.inend)
+        if self.inpos == self.inend:
+            self.reset_input()
+
+    def reset_input(self):
+        self.inpos = 0
+        self.inend = 0
+        if len(self.inb) > TCPQ_RECV_BUFFER_SIZE:
+            # Do not hold large buffers for idle connections
+            self.inb = bytearray(TCPQ_RECV_BUFFER_SIZE)
+
+    def reserve_input(self, n):
+        """ Make room for at least n bytes after the unprocessed input.
+        Unprocessed data is moved to the beginning of the buffer, and the
+        buffer is grown if necessary. Unprocessed data is copied at most
+        once per call. """
+
+        if len(self.inb) - self.inend >= n:
+            return
+
+        pending = self.inend - self.inpos
+        size = len(self.inb)
+        while size < pending + n:
+            size *= 2
+
+        if size == len(self.inb):
+            self.inb[0:pending] = memoryview(self.inb)[self.inpos:self.inend].tobytes()
+        else:
+            newb = bytearray(size)
+            newb[0:pending] = memoryview(self.inb)[self.inpos:self.inend]
+            self.inb = newb
+
+        self.inpos = 0
+        self.inend = pending
 
     def set_close_handler(self, f):
         self.closehandler = f
@@ -330,8 +923,25 @@ class TCP_Queue:
         self.maxsize = maxsize
 
     def set_wsize(self, wsize):
+        """ Set the maximum window size: at most 'wsize' bytes are written
+        to the socket at once. The window size adapts to traffic below the
+        maximum. """
+
         assert(wsize > 0)
         self.wsize = wsize
+        self.maxwsize = wsize
+
+    def set_high_water_mark(self, highwater):
+        """ The send handler is not called while at least 'highwater' bytes
+        are waiting to be sent. This bounds memory used for a slow peer. """
+
+        assert(highwater > 0)
+        self.highwater = highwater
+
+    def output_len(self):
+        """ Return the number of bytes waiting to be sent. """
+
+        return self.outlen
 
     def set_send_handler(self, handler = None):
         """ Start streaming mode. Given handler is called when output queue
@@ -349,6 +959,43 @@ class TCP_Queue:
         if handler != None:
             self.writemode()
 
+    def send_file(self, f, offset, length, handler = None):
+        """ Send 'length' bytes of file object 'f' starting from 'offset'
+            after all currently pending output. The file data is not passed
+            through the send queue: the kernel copies it directly to the
+            socket with sendfile(2), if available. Otherwise the file is
+            read into the send queue one chunk at a time.
+
+            handler(nbytes) is called each time nbytes of the file have been
+            sent (or queued for sending). The file body is complete when
+            the handler has been called for 'length' bytes in total. An empty
+            body calls handler(0) once. The caller owns the file object. """
+
+        assert(self.bodyfile == None and offset >= 0 and length >= 0)
+
+        self.bodyfile = f
+        self.bodypos = offset
+        self.bodyleft = length
+        self.bodyhandler = handler
+
+        if self.status == TCPQ_OK:
+            self.writemode()
+
+    def set_batch_handler(self, handler = None):
+        """ Deliver records in batches. handler(q, msgs, parameter) is
+            called with a list of all complete records that were parsed from
+            the input buffer in one pass, instead of calling the normal
+            handler once per record. The handler returns False on error, like
+            the normal handler.
+
+            Throttling and set_recv_handler() take effect after the whole
+            batch has been delivered, so the batch handler must not be used
+            for connections that switch to streaming mode.
+
+            Setting None returns to per-record delivery. """
+
+        self.batch_handler = handler
+
     def set_recv_handler(self, handler = None):
         """ Set handler for incoming data. Can be used for receiving streaming
             data. Handler should return number of bytes it consumed.
@@ -409,10 +1056,13 @@ class TCP_Queue:
 
     def close(self, status = TCPQ_EOF, msg = ''):
         debug('TCP_Queue closed: status %d (%s)\n' %(status, msg))
-        self.inb = ''
-        self.outb = ''
+        self.reset_input()
+        self.msglen = None
+        self.reset_output()
         self.send_handler = None
         self.recv_handler = None
+        self.bodyfile = None
+        self.bodyhandler = None
         self.throttled = False
         self.status = status
         self.remove_io_notifications()
@@ -458,29 +1108,30 @@ class TCP_Queue:
 
         if self.msglen == None:
             # Read bencoded unsigned integer. We don't actually need to check
-            # the initial prefix character 'i'.
-            i = self.inb.find('e')
+            # the initial prefix character 'i'. A valid header is short, so
+            # the terminator is not searched from the payload.
+            i = self.inb.find('e', self.inpos, min(self.inend, self.inpos + 12))
             if i < 0:
-                if len(self.inb) < 10:
+                if self.input_len() < 10:
                     return nothing
                 # Too long a header without a terminator, kill connection
                 return error
             try:
-                x = int(self.inb[1:i])
+                x = int(self.inb[(self.inpos + 1):i])
             except ValueError:
                 x = -1
             if x < 0 or (self.maxsize != None and x > self.maxsize):
                 return error
             self.msglen = x
-            self.inb = self.inb[(i + 1):]
+            self.inpos = i + 1
 
-        if self.msglen == None or len(self.inb) < self.msglen:
+        if self.msglen == None or self.input_len() < self.msglen:
             return nothing
 
-        # We got the full payload
-        # Remove the payload from the beginning of self.inb and return it
-        msg = self.inb[0:self.msglen]
-        self.inb = self.inb[self.msglen:]
+        # We got the full payload. Copy it out of the buffer once and
+        # advance the read cursor past it.
+        msg = self.get_input(self.msglen)
+        self.consume_input(self.msglen)
 
         # Next time: read a message length (don't come here)
         self.msglen = None
@@ -488,7 +1139,7 @@ class TCP_Queue:
         return (True, msg)
 
     def process(self):
-        """ Process all complete and valid messages in self.inb """
+        """ Process all complete and valid messages in the input buffer """
 
         assert(self.status == TCPQ_OK)
 
@@ -499,19 +1150,31 @@ class TCP_Queue:
         while success and not self.throttled:
             # In streaming mode, give all received data to handler
             if self.recv_handler != None:
-                consumed = self.recv_handler(self.inb)
+                consumed = self.recv_handler(self.get_input())
                 if consumed == None:
                     return False
-                self.inb = self.inb[consumed:]
-                if len(self.inb) == 0:
+                self.consume_input(consumed)
+                if self.input_len() == 0:
                     break
+            elif self.batch_handler != None:
+                msgs = []
+                while True:
+                    (success, msg) = self.get_one_msg()
+                    if msg == None:
+                        break
+                    msgs.append(msg)
+                # Records before a protocol violation are still delivered
+                if len(msgs) > 0 and not self.batch_handler(self, msgs, self.parameter):
+                    success = False
+                break
             else:
                 (success, msg) = self.get_one_msg()
                 if msg == None:
                     break
                 success = self.handler(self, msg, self.parameter)
 
-        if not success:
+        # A handler may have closed the queue already
+        if not success and self.status == TCPQ_OK:
             self.close(status)
 
         return success
@@ -521,8 +1184,15 @@ class TCP_Queue:
 
         assert(self.status == TCPQ_OK)
 
+        # Reserve space for the rest of the current record so that a large
+        # record is received into one buffer without reallocations
+        need = self.rsize
+        if self.msglen != None and self.recv_handler == None:
+            need = max(need, min(self.msglen - self.input_len(), TP_MAX_RECORD_SIZE))
+        self.reserve_input(need)
+
         try:
-            chunk = self.sock.recv(TP_MAX_TRANSFER)
+            nbytes = self.sock.recv_into(memoryview(self.inb)[self.inend:], self.rsize)
         except error, (errno, strerror):
             warning('TCP_Queue read error %d: %s\n' %(errno, strerror))
             ret = (errno == EAGAIN or errno == EINTR)
@@ -530,12 +1200,13 @@ class TCP_Queue:
                 self.close(TCPQ_ERROR, msg = strerror)
             return ret
 
-        if len(chunk) == 0:
+        if nbytes == 0:
             self.close(TCPQ_EOF)
             return False
 
-        self.bytestransferred += len(chunk)
-        self.inb += chunk
+        self.bytestransferred += nbytes
+        self.inend += nbytes
+        self.rsize = adapt_window(self.rsize, nbytes, self.maxrsize)
 
         if not self.process():
             return False
@@ -546,14 +1217,60 @@ class TCP_Queue:
             self.readmode(False)
         return ret
 
+    def append_output(self, data):
+        if len(data) > 0:
+            self.outq.append(data)
+            self.outlen += len(data)
+
+    def advance_output(self, n):
+        """ Remove n sent bytes from the beginning of the send queue. """
+
+        self.outlen -= n
+        while n > 0:
+            left = len(self.outq[0]) - self.outpos
+            if n < left:
+                self.outpos += n
+                break
+            n -= left
+            self.outq.popleft()
+            self.outpos = 0
+
+    def reset_output(self):
+        self.outq.clear()
+        self.outpos = 0
+        self.outlen = 0
+
+    def output_buffers(self):
+        """ Return a list of buffers to be sent next, at most window size
+        bytes in total. The first buffer is not copied. """
+
+        first = self.outq[0]
+        bufs = [memoryview(first)[self.outpos:(self.outpos + self.wsize)]]
+        total = len(bufs[0])
+        for i in xrange(1, len(self.outq)):
+            if total >= self.wsize or len(bufs) >= TCPQ_MAX_IOV:
+                break
+            data = self.outq[i]
+            if len(data) > self.wsize - total:
+                data = memoryview(data)[0:(self.wsize - total)]
+            bufs.append(data)
+            total += len(data)
+        return bufs
+
     def write_buffer(self):
         """ Write from the send queue to the socket. Maximum amount of written
             data is the window size. """
 
-        chunk = self.outb[0:self.wsize]
+        bufs = self.output_buffers()
 
         try:
-            bytes = self.sock.send(chunk)
+            if have_sendmsg:
+                bytes = self.sock.sendmsg(bufs)
+            elif len(bufs) == 1:
+                bytes = self.sock.send(bufs[0])
+            else:
+                # Coalesce small buffers into one send
+                bytes = self.sock.send(''.join([memoryview(b).tobytes() for b in bufs]))
         except error, (errno, strerror):
             warning('TCP_Queue send error %d: %s\n' %(errno, strerror))
             ret = (errno == EAGAIN or errno == EINTR)
@@ -561,34 +1278,92 @@ class TCP_Queue:
                 self.close(TCPQ_ERROR, msg = strerror)
             return ret
 
-        # Succefully sent data. Remove from the beginning of self.outb
+        # Succefully sent data. Remove from the beginning of the send queue
         self.bytestransferred += bytes
-        self.outb = self.outb[bytes:]
+        self.advance_output(bytes)
+        self.wsize = adapt_window(self.wsize, bytes, self.maxwsize)
         return True
 
+    def write_file_body(self):
+        """ Send the next part of the file body. """
+
+        amount = min(self.bodyleft, TCPQ_SENDFILE_CHUNK)
+        if amount == 0:
+            bytes = 0
+        elif self.bodysendfile:
+            try:
+                bytes = sendfile(self.sock.fileno(), self.bodyfile.fileno(), self.bodypos, amount)
+            except OSError, (errno, strerror):
+                if errno == EAGAIN or errno == EINTR:
+                    return True
+                if errno == EINVAL or errno == ENOSYS:
+                    # The file can not be sent with sendfile(), e.g. it is
+                    # not a regular file. Fall back to reading it.
+                    self.bodysendfile = False
+                    return True
+                warning('TCP_Queue sendfile error %d: %s\n' %(errno, strerror))
+                self.close(TCPQ_ERROR, msg = strerror)
+                return False
+            self.bytestransferred += bytes
+        else:
+            try:
+                self.bodyfile.seek(self.bodypos)
+                chunk = self.bodyfile.read(min(amount, self.highwater))
+            except IOError, (errno, strerror):
+                self.close(TCPQ_ERROR, msg = strerror)
+                return False
+            bytes = len(chunk)
+            self.append_output(chunk)
+
+        if amount > 0 and bytes == 0:
+            self.close(TCPQ_ERROR, msg = 'Unexpected end of file')
+            return False
+
+        self.bodypos += bytes
+        self.bodyleft -= bytes
+
+        handler = self.bodyhandler
+        if self.bodyleft == 0:
+            # The handler may start a new file body
+            self.bodyfile = None
+            self.bodyhandler = None
+
+        if handler != None:
+            handler(bytes)
+
+        return self.status == TCPQ_OK
+
     def socket_write(self, fd, condition):
         """ The socket can be now written to. """
 
         assert(self.status == TCPQ_OK)
 
-        # If we are sending stream, fill send queue
-        if self.send_handler != None and len(self.outb) < self.wsize:
+        # If we are sending stream, fill send queue up to the high-water mark
+        while self.send_handler != None and self.outlen < self.highwater:
             chunk = self.send_handler()
             if chunk == None:
                 return False
-            self.outb += chunk
+            if len(chunk) == 0:
+                break
+            self.append_output(chunk)
 
-        if not self.write_buffer():
-            return False
+        if self.outlen > 0:
+            if not self.write_buffer():
+                return False
+        elif self.bodyfile != None:
+            if not self.write_file_body():
+                return False
+            if self.outlen > 0 and not self.write_buffer():
+                return False
 
-        if not self.throttled and len(self.inb) > 0:
+        if not self.throttled and self.input_len() > 0:
             # We have possibly have come back from throttled mode, process
             # buffered data
             if not self.process():
                 return False
 
         # Do we continue in write mode?
-        ret = len(self.outb) > 0 or self.send_handler != None
+        ret = self.outlen > 0 or self.send_handler != None or self.bodyfile != None
         if not ret:
             if self.closeaftersend != None:
                 self.close(msg=self.closeaftersend)
@@ -612,9 +1387,9 @@ class TCP_Queue:
         """
 
         if writelength:
-            self.outb += 'i%de' % len(msg)
+            self.append_output('i%de' % len(msg))
 
-        self.outb += msg
+        self.append_output(msg)
 
         # If we do not currently in send mode, make sure we start writing to
         # the socket by enabling the write watch.
@@ -622,3 +1397,250 @@ class TCP_Queue:
         # it is no longer needed.
         if self.status == TCPQ_OK:
             self.writemode()
+
+def test_send_file(flen = 3 * TCPQ_SENDFILE_CHUNK + 123):
+    """ Send a file body twice over one connection, like a keepalive file
+    get, with sendfile(2) and by reading the file into the send queue.
+    Progress handlers must account for every byte. """
+
+    import tempfile
+
+    body = os.urandom(flen)
+    f = tempfile.TemporaryFile()
+    f.write(body)
+    f.flush()
+
+    def run(usesendfile):
+        lsock = socket(AF_INET, SOCK_STREAM)
+        lsock.bind(('127.0.0.1', 0))
+        lsock.listen(1)
+        csock = socket(AF_INET, SOCK_STREAM)
+        csock.connect(lsock.getsockname())
+        (ssock, address) = lsock.accept()
+        lsock.close()
+        csock.setblocking(False)
+        ssock.setblocking(False)
+
+        loop = get_event_loop()
+        received = []
+        progress = []
+
+        def receive(data):
+            received.append(str(data))
+            return len(data)
+
+        def sent(nbytes):
+            progress.append(nbytes)
+            if sum(progress) == flen:
+                # Keep the connection for the second body
+                sender.write('next')
+                sender.send_file(f, 0, flen, sent)
+            elif sum(progress) == 2 * flen:
+                sender.close_after_send()
+
+        sender = TCP_Queue(None, role=TCPQ_ROLE_GET_FILE)
+        receiver = TCP_Queue(None, closehandler=lambda q, parameter, msg: loop.quit(), role=TCPQ_ROLE_GET_FILE)
+        sender.bodysendfile = usesendfile
+        queued = [0]
+        append_output = sender.append_output
+        def count_output(data):
+            queued[0] += len(data)
+            append_output(data)
+        sender.append_output = count_output
+        receiver.set_recv_handler(receive)
+        sender.initialize(ssock)
+        receiver.initialize(csock)
+        sender.write('first')
+        sender.send_file(f, 0, flen, sent)
+        loop.run()
+
+        assert(''.join(received) == 'i5efirst' + body + 'i4enext' + body)
+        assert(sum(progress) == 2 * flen and min(progress) > 0)
+        assert(sender.bodysendfile == usesendfile)
+        # With sendfile(2), the file body does not pass the send queue
+        assert((queued[0] < flen) == usesendfile)
+
+    if have_sendfile:
+        run(True)
+    run(False)
+    f.close()
+
+def benchmark_receive(nrecords = 32, recordsize = TP_MAX_RECORD_SIZE):
+    """ Push 'nrecords' records of 'recordsize' bytes through a socketpair
+    and compare TCP_Queue receive path against the old string buffer that
+    appended each chunk to a string and sliced it after every record. """
+
+    from socket import socketpair
+    from threading import Thread
+
+    record = 'i%de' % recordsize + 'x' * recordsize
+
+    def writer(sock):
+        for i in xrange(nrecords):
+            sock.sendall(record)
+
+    class String_Receiver:
+        def __init__(self):
+            self.inb = ''
+            self.msglen = None
+            self.nrecords = 0
+            self.nbytes = 0
+
+        def read(self, sock):
+            self.inb += sock.recv(TP_MAX_TRANSFER)
+            while True:
+                if self.msglen == None:
+                    i = self.inb.find('e')
+                    if i < 0:
+                        return
+                    self.msglen = int(self.inb[1:i])
+                    self.inb = self.inb[(i + 1):]
+                if len(self.inb) < self.msglen:
+                    return
+                msg = self.inb[0:self.msglen]
+                self.inb = self.inb[self.msglen:]
+                self.msglen = None
+                self.nrecords += 1
+                self.nbytes += len(msg)
+
+    def run(name, setup, read, received):
+        (wsock, rsock) = socketpair()
+        rsock.setblocking(False)
+        setup(rsock)
+        t = Thread(target=writer, args=(wsock,))
+        t0 = time()
+        t.start()
+        while received() < nrecords:
+            select.select([rsock], [], [])
+            read(rsock)
+        dt = max(time() - t0, 1e-6)
+        t.join()
+        wsock.close()
+        rsock.close()
+        mbytes = nrecords * recordsize / 1048576.0
+        print '%s: %d records of %d bytes in %.3f s (%.1f MB/s)' %(name, nrecords, recordsize, dt, mbytes / dt)
+
+    sr = String_Receiver()
+    run('string buffer', lambda sock: None, sr.read, lambda: sr.nrecords)
+    assert(sr.nbytes == nrecords * recordsize)
+
+    counter = [0]
+    def handler(q, msg, parameter):
+        counter[0] += 1
+        return True
+    q = TCP_Queue(handler)
+    run('TCP_Queue', q.initialize, lambda sock: q.socket_read(sock, IO_IN), lambda: counter[0])
+    q.close()
+
+def benchmark_throughput(nbytes = 100 * 1024 * 1024):
+    """ Stream 'nbytes' bytes between two TCP_Queues over loopback TCP
+    with fixed 4 KB read and write sizes, and with adaptive sizes. """
+
+    chunk = 'x' * TCPQ_OUTPUT_HIGH_WATER
+
+    def run(name, maxwindow):
+        lsock = socket(AF_INET, SOCK_STREAM)
+        lsock.bind(('127.0.0.1', 0))
+        lsock.listen(1)
+        csock = socket(AF_INET, SOCK_STREAM)
+        csock.connect(lsock.getsockname())
+        (ssock, address) = lsock.accept()
+        lsock.close()
+        csock.setblocking(False)
+        ssock.setblocking(False)
+
+        loop = get_event_loop()
+        state = {'sent': 0, 'received': 0, 'reads': 0}
+
+        def send():
+            n = min(len(chunk), nbytes - state['sent'])
+            state['sent'] += n
+            if n == 0:
+                sender.set_send_handler(None)
+            return chunk[0:n]
+
+        def receive(data):
+            state['received'] += len(data)
+            state['reads'] += 1
+            if state['received'] == nbytes:
+                loop.quit()
+            return len(data)
+
+        sender = TCP_Queue(None, role=TCPQ_ROLE_GET_FILE)
+        receiver = TCP_Queue(None, role=TCPQ_ROLE_GET_FILE)
+        for q in (sender, receiver):
+            q.maxrsize = maxwindow
+            q.set_wsize(maxwindow)
+        receiver.set_recv_handler(receive)
+
+        t0 = time()
+        c0 = os.times()
+        sender.initialize(ssock)
+        receiver.initialize(csock)
+        sender.set_send_handler(send)
+        loop.run()
+        dt = max(time() - t0, 1e-6)
+        c1 = os.times()
+        cpu = (c1[0] - c0[0]) + (c1[1] - c0[1])
+
+        sender.close()
+        receiver.close()
+        mbytes = nbytes / 1048576.0
+        print '%s: %.1f MB in %.3f s (%.1f MB/s), %.3f s CPU, %d reads' %(name, mbytes, dt, mbytes / dt, cpu, state['reads'])
+
+    run('fixed 4 KB window', TP_MAX_TRANSFER)
+    run('adaptive window', TCPQ_MAX_WINDOW)
+
+def benchmark_datagrams(ndatagrams = 20000, size = 1024, batch = 8):
+    """ Send 'ndatagrams' datagrams of 'size' bytes over loopback in
+    batches of 'batch', first with a new socket per datagram
+    (send_broadcast), and then through one socket (send_datagrams). The
+    receiver drains the socket with recv_datagrams(). """
+
+    msg = 'x' * size
+
+    def run(name, send):
+        rsock = socket(AF_INET, SOCK_DGRAM)
+        rsock.setsockopt(SOL_SOCKET, SO_RCVBUF, 4 * 1024 * 1024)
+        rsock.bind(('127.0.0.1', 0))
+        rsock.setblocking(False)
+        port = rsock.getsockname()[1]
+        received = 0
+        wakeups = 0
+
+        t0 = time()
+        c0 = os.times()
+        for i in xrange(0, ndatagrams, batch):
+            send(port, [msg] * min(batch, ndatagrams - i))
+            while True:
+                datagrams = recv_datagrams(rsock, 2048, 64)
+                if datagrams == None or len(datagrams) == 0:
+                    break
+                wakeups += 1
+                received += len(datagrams)
+        dt = max(time() - t0, 1e-6)
+        c1 = os.times()
+        cpu = (c1[0] - c0[0]) + (c1[1] - c0[1])
+        rsock.close()
+        print '%s: %d/%d datagrams in %.3f s (%.0f/s), %.3f s CPU, %d reads' %(name, received, ndatagrams, dt, ndatagrams / dt, cpu, wakeups)
+
+    def send_each(port, datagrams):
+        for data in datagrams:
+            send_broadcast('127.0.0.1', port, data)
+
+    ssock = create_udp_socket('', 0, True)
+    ssock.setblocking(False)
+
+    def send_batch(port, datagrams):
+        send_datagrams(ssock, '127.0.0.1', port, datagrams)
+
+    run('socket per datagram', send_each)
+    run('persistent socket', send_batch)
+    ssock.close()
+
+if __name__ == '__main__':
+    set_event_loop(Epoll_Event_Loop())
+    test_send_file()
+    benchmark_receive()
+    benchmark_throughput()
+    benchmark_datagrams()
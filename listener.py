@@ -12,16 +12,19 @@
 Listen for incoming TCP connections
 """
 from errno import EAGAIN, EINTR
-from gobject import io_add_watch, source_remove, timeout_add, IO_IN
 import socket
 
-from ioutils import create_tcp_listener
+from ioutils import create_tcp_listener, io_add_watch, source_remove, \
+     timeout_add, IO_IN
 from plugins import rpc_commands, get_plugin_by_type
 from support import debug, warning, info
 from proximateprotocol import TP_PROTOCOL_TIMEOUT, TP_MAX_CMD_NAME_LEN, \
      RPC_MORE_DATA, RPC_CLOSE, RPC_RELEASE, PORT_RETRIES, DEFAULT_PROXIMATE_PORT, \
      PLUGIN_TYPE_COMMUNITY
 
+# Maximum number of connections accepted per listener event
+MAX_ACCEPTS = 64
+
 community = None
 
 listener = None
@@ -75,7 +78,7 @@ class Connection:
         elif status == RPC_CLOSE:
             self.close()
         elif status == RPC_RELEASE:
-            # We are not interested to gobject events anymore
+            # We are not interested to IO events anymore
             self.remove_io_notifications()
         else:
             self.close()
@@ -110,17 +113,20 @@ class Connection:
         return ret
 
 def tcp_listener_accept(rfd, conditions):
-    try:
-        (sock, address) = rfd.accept()
-    except socket.error, (errno, strerror):
-        ret = (errno == EAGAIN or errno == EINTR)
-        if not ret:
-            warning('Listener: Socket error (%s): %s\n' % (errno, strerror))
-        return ret
+    # Accept all pending connections so that the listen backlog does not
+    # overflow when many peers connect at once
+    for i in xrange(MAX_ACCEPTS):
+        try:
+            (sock, address) = rfd.accept()
+        except socket.error, (errno, strerror):
+            ret = (errno == EAGAIN or errno == EINTR)
+            if not ret:
+                warning('Listener: Socket error (%s): %s\n' % (errno, strerror))
+            return ret
 
-    sock.setblocking(False)
+        sock.setblocking(False)
 
-    Connection(sock, address)
+        Connection(sock, address)
     return True
 
 def init():
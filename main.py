@@ -15,6 +15,7 @@ from plugins import plugin_cleanup, plugins_ready
 import support
 import proximatestate
 import listener
+from ioutils import set_socket_buffer_sizes
 from support import die, print_exc, warning
 
 def main(options, args):
@@ -24,6 +25,10 @@ def main(options, args):
     # Initialize seed for crypto and other plugins
     random.seed()
 
+    for (role, rcvbuf, sndbuf) in options.socketbuffers:
+        if not set_socket_buffer_sizes(role, rcvbuf, sndbuf):
+            die('Invalid socket buffer role: %s\n' %(role))
+
     # Init order for plugins: proximatestate, wlancontrol, community, ... (others)
     # State plugin must be the second plugin that is initialized
     proximatestate.init(options)
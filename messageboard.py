@@ -8,11 +8,11 @@
 # This software is licensed under The Clear BSD license.
 # See the LICENSE file for more details.
 #
-from gobject import timeout_add_seconds, source_remove
 from random import random, randrange
 from time import time
 
 from filesharing import Share_Meta, Subscription
+from ioutils import timeout_add_seconds, source_remove
 from plugins import Plugin, get_plugin_by_type
 from support import warning
 from proximateprotocol import PLUGIN_TYPE_FETCHER, PLUGIN_TYPE_FILE_SHARING, \
@@ -141,7 +141,7 @@ class Message_Board(Plugin):
         self.gui = ui
 
     def cleanup(self):
-        self.state.set_plugin_variable(self.name, 'watchkeywords', self.keywords)
+        self.state.set_plugin_variable(self.name, 'watchkeywords', list(self.keywords))
 
         savednotifications = {}
         for (key, value) in self.notifications.items():
@@ -257,11 +257,11 @@ class Message_Board(Plugin):
     def read_state(self):
         l = self.state.get_plugin_variable(self.name, 'watchkeywords')
         if l != None:
-            self.keywords = l
+            self.keywords = list(l)
 
         notifications = self.state.get_plugin_variable(self.name, 'notifications')
         if notifications != None:
-            self.notifications = notifications
+            self.notifications = notifications.copy()
 
     def handle_msgpush(self, user, request):
         self.got_query_results(user, request, None)
@@ -478,7 +478,7 @@ class Message_Board(Plugin):
         # Subscribe to fileshares that are msgboard messages
         self.fs.subscribe(Subscription(purpose=self.name, callback=self.handle_message))
 
-        self.fetcher.register_handler(self.name, self.handle_request, self.name)
+        self.fetcher.register_handler(self.name, self.handle_request, self.name, priority=self.fetcher.PRIORITY_LOW)
 
         self.read_state()
 
@@ -361,7 +361,7 @@ class Messaging_Plugin(Plugin):
         self.myself = self.community.get_myself()
         self.my_addr = addr_from_user(self.myself)
 
-        self.fetcher.register_handler(PLUGIN_TYPE_MESSAGING, self.handle_messaging_command, 'messaging')
+        self.fetcher.register_handler(PLUGIN_TYPE_MESSAGING, self.handle_messaging_command, 'messaging', priority=self.fetcher.PRIORITY_HIGH)
 
         self.conversations = {}
 
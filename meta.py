@@ -8,9 +8,9 @@
 # This software is licensed under The Clear BSD license.
 # See the LICENSE file for more details.
 #
-from copy import deepcopy
 from pprint import pformat
 
+from bencode import Bencached, bencode
 from ossupport import safe_write
 from support import warning
 from proximateconfigparser import safe_write_config, \
@@ -85,13 +85,28 @@ def publicstringlist(default=None):
 def privatestringlist(default=None):
     return Meta_Attribute(list, public=False, is_valid=is_string_list)
 
-class Meta:
+class Meta(object):
+    """ Attribute values are stored in self.d. Attributes whose value is
+    None are left out from self.d, so that profiles with few attributes
+    stay small.
+
+    Values are not copied on import or export. Lists are replaced
+    instead of being modified in place, so defaults and imported values
+    can be shared safely. A list returned by get() must not be modified;
+    set a new list instead.
+
+    Subclasses set metaattributes as a class variable and declare the
+    instance variables they add in __slots__. """
+
+    __slots__ = ['d', 'dirty', 'fingerprint', 'fingerprintversion', 'serialized']
+
     def base_init(self):
         self.d = {}
 
         # Version number of this instance. This is a counter that is
         # incremented by one each time profile is visibly changed.
-        self.metaattributes['v'] = Meta_Attribute(int, public=True, is_valid=is_unsigned_int, default=0)
+        if not self.metaattributes.has_key('v'):
+            self.metaattributes['v'] = Meta_Attribute(int, public=True, is_valid=is_unsigned_int, default=0)
         self.d['v'] = 0
 
         # Initialize public and private attributes
@@ -100,6 +115,9 @@ class Meta:
         self.dirty = False
         self.fingerprintversion = -1
 
+        # (version, Bencached) of the public attributes
+        self.serialized = None
+
     def add_list_item(self, attr, value, validator=None):
         ma = self.metaattributes.get(attr)
         assert(ma != None)
@@ -107,12 +125,12 @@ class Meta:
         l = self.d.get(attr)
         if l == None:
             l = []
-            self.d[attr] = l
         if (validator != None and validator(value) == False) or value in l:
             return False
-        l.append(value)
+        self.d[attr] = l + [value]
         if ma.public:
             self.new_version()
+            self.serialized = None
         self.dirty = True
         return True
 
@@ -133,6 +151,15 @@ class Meta:
     def get(self, attr):
         return self.d.get(attr)
 
+    def get_bencached(self):
+        """ Returns serialize() as a Bencached object that can be embedded
+        in messages. It is encoded again only after the version changes. """
+
+        version = self.d['v']
+        if self.serialized == None or self.serialized[0] != version:
+            self.serialized = (version, Bencached(bencode(self.serialize())))
+        return self.serialized[1]
+
     def new_version(self):
         self.d['v'] += 1
 
@@ -200,10 +227,10 @@ class Meta:
                 return False
 
         self.reset_defaults(trusted)
+        self.serialized = None
 
         success = True
         for attr, value in d.items():
-            value = deepcopy(value)
             ma = self.metaattributes.get(attr)
             if ma == None:
                 if trusted == False:
@@ -222,7 +249,12 @@ class Meta:
                     warning('import_dictionary: ignored %s (not valid): %s\n' %(attr, str(value)))
                     success = False
                     continue
-            self.d[attr] = value
+                # Share the attribute name string between all instances
+                attr = intern(attr)
+            if value == None:
+                self.d.pop(attr, None)
+            else:
+                self.d[attr] = value
         return success
 
     def read_ini_file(self, s):
@@ -255,14 +287,14 @@ class Meta:
         assert(ma != None)
         assert(ma.vtype == list)
         l = self.d.get(attr)
-        if l == None:
-            return False
-        try:
-            l.remove(value)
-        except ValueError:
+        if l == None or value not in l:
             return False
+        l = list(l)
+        l.remove(value)
+        self.d[attr] = l
         if ma.public:
             self.new_version()
+            self.serialized = None
         self.dirty = True
         return True
 
@@ -273,7 +305,11 @@ class Meta:
         for attr, ma in self.metaattributes.items():
             if ma.public == False and trusted == False:
                 continue
-            self.d[attr] = deepcopy(ma.default)
+            if ma.default == None:
+                self.d.pop(attr, None)
+            else:
+                self.d[attr] = ma.default
+        self.serialized = None
 
     def save_to_config_section(self, c):
         c.add_section(self.metasection)
@@ -390,7 +426,11 @@ class Meta:
             return True
         if ma != None and ma.public:
             self.new_version()
-        self.d[attr] = value
+            self.serialized = None
+        if value == None:
+            self.d.pop(attr, None)
+        else:
+            self.d[attr] = value
         self.dirty = True
         return True
 
@@ -421,6 +461,7 @@ class Meta:
 
         self.d['v'] = version
         self.dirty = True
+        self.serialized = None
 
     def update_fingerprint(self):
         # self.dirty may not be used here. It is only used with user profiles.
@@ -434,3 +475,88 @@ class Meta:
         values = map(lambda key: str(self.d.get(key)).upper(), searchattrs)
         self.fingerprint = '\n'.join(values)
         self.fingerprintversion = self.d['v']
+
+def test_meta():
+    from user import User
+
+    u = User()
+    default = u.get('communities')
+    assert(u.get('status') == None and not u.d.has_key('status'))
+
+    # Lists are replaced, so the shared default is not modified
+    assert(u.add_list_item('communities', 'Helsinki'))
+    assert(u.get('communities') == default + ['Helsinki'])
+    assert(User().get('communities') == default)
+    assert(u.remove_list_item('communities', 'Helsinki'))
+    assert(u.get('communities') == default)
+    assert(not u.remove_list_item('communities', 'Helsinki'))
+
+    # Imported values are not copied
+    profile = {'uid': 'a' * 16, 'nick': 'alice', 'fscounter': 1, 'v': 3,
+               'communities': ['Proximate', 'Helsinki']}
+    assert(u.unserialize(profile))
+    assert(u.get('communities') is profile['communities'])
+    assert(u.get('v') == 3 and u.get('status') == None)
+
+    # Setting None removes the value
+    assert(u.set('status', 'Hacking'))
+    assert(u.set('status', None))
+    assert(not u.d.has_key('status'))
+    assert(u.get('v') == 5)
+    profile.update({'v': 5, 'faceversion': 0})
+    assert(u.serialize() == profile)
+
+def rss_bytes():
+    """ Returns resident memory size of this process on Linux """
+
+    import resource
+    f = open('/proc/self/statm', 'r')
+    pages = int(f.read().split()[1])
+    f.close()
+    return pages * resource.getpagesize()
+
+def benchmark(nusers=10000, nmetas=50000):
+    """ Measure memory and time per object for user profiles and share
+    metas that are imported from bdecoded messages """
+
+    import gc
+    from time import time
+    from bencode import bdecode, bencode
+    from filesharing import Share_Meta
+    from proximateprotocol import SHARE_DIR
+    from user import User
+
+    def new_user(i):
+        profile = {'v': 12, 'uid': '%016x' % (0xa000000000000000 + i),
+            'nick': 'user%d' % i, 'communities': ['Proximate', 'Helsinki'],
+            'faceversion': 2, 'fscounter': 5, 'status': 'Hacking',
+            'city': 'Helsinki', 'country': 'Finland', 'name': 'Name %d' % i,
+            'languages': 'en fi', 'description': 'Coffee and mesh networks'}
+        user = User()
+        assert(user.unserialize(bdecode(bencode(profile))))
+        return user
+
+    def new_share_meta(i):
+        metadict = {'id': i, 'purpose': 'share', 'type': SHARE_DIR,
+            'description': 'Photos from the trip %d' % i, 'src': '%016x' % i,
+            'gid': 123456789012 + i, 'ttl': 3, 'keywords': ['summer', 'beach']}
+        meta = Share_Meta()
+        assert(meta.unserialize(bdecode(bencode(metadict))))
+        return meta
+
+    for (name, n, create) in [('users', nusers, new_user),
+                              ('share metas', nmetas, new_share_meta)]:
+        gc.collect()
+        rss = rss_bytes()
+        t0 = time()
+        objects = map(create, xrange(n))
+        t1 = time()
+        gc.collect()
+        print '%-12s %6d objects %7.0f bytes and %5.1f us per object' %(name, n, float(rss_bytes() - rss) / n, 1000000 * (t1 - t0) / n)
+        del objects
+
+if __name__ == '__main__':
+    import sys
+    test_meta()
+    if '--bench' in sys.argv[1:]:
+        benchmark()
@@ -21,8 +21,7 @@ Guidelines for showing notifications:
       ok_dialog()
 """
 
-from gobject import source_remove, timeout_add_seconds
-
+from ioutils import source_remove, timeout_add_seconds
 from plugins import Plugin, get_plugin_by_type
 from support import info
 from proximateprotocol import PLUGIN_TYPE_NOTIFICATION, PLUGIN_TYPE_VIBRA, \
@@ -15,6 +15,25 @@ import sys
 from support import die, get_version
 from proximateprotocol import DEFAULT_PROXIMATE_PORT, valid_port
 
+def parse_socket_buffers(spec):
+    """ Parse 'role=rcvbuf,sndbuf' into (role, rcvbuf, sndbuf). A zero size
+    is returned as None. Returns None if the spec is invalid. """
+
+    fields = spec.split('=')
+    if len(fields) != 2:
+        return None
+    sizes = fields[1].split(',')
+    if len(sizes) != 2:
+        return None
+    try:
+        sizes = map(int, sizes)
+    except ValueError:
+        return None
+    if min(sizes) < 0:
+        return None
+    sizes = map(lambda x: x or None, sizes)
+    return (fields[0], sizes[0], sizes[1])
+
 def get_options():
     parser = OptionParser()
     parser.add_option('-b', '--broadcast-port',
@@ -28,6 +47,11 @@ def get_options():
                       action = 'store_false',
                       dest = 'chatcontext',
                       help = 'Disable conversation context recovery and sending in chat. This option makes messaging unreliable.')
+    parser.add_option('--daemon',
+                      default = False,
+                      action = 'store_true',
+                      dest = 'daemon',
+                      help = 'Run a headless node that only loads networking plugins. No GUI or curses UI is used.')
     parser.add_option('-d', '--debug',
                       default = False,
                       action = 'store_true',
@@ -72,6 +96,11 @@ def get_options():
                       dest = 'proximatedir',
                       metavar = 'dir',
                       help = 'Set Proximate directory. Default: $HOME/.proximate')
+    parser.add_option('--socket-buffers',
+                      action = 'append',
+                      dest = 'socketbuffers',
+                      metavar = 'role=rcvbuf,sndbuf',
+                      help = 'Set TCP socket receive and send buffer sizes in bytes for connections of a role: fetch, get-file or send-file. 0 means the kernel default. This option can be used multiple times. Default: kernel default for all roles.')
     parser.add_option('--test',
                       default = None,
                       dest = 'test',
@@ -88,6 +117,11 @@ def get_options():
                       action = 'store_true',
                       dest = 'udp_fetcher',
                       help = 'Use UDP for communication')
+    parser.add_option('--udp-fec',
+                      default = False,
+                      action = 'store_true',
+                      dest = 'udp_fec',
+                      help = 'Send parity fragments with UDP packets, so that the receiver can rebuild lost fragments without retransmissions. Only used with peers that support it.')
     parser.add_option('-u', '--udp-mode',
                       default = 3,
                       type = 'int',
@@ -110,7 +144,7 @@ def get_options():
         sys.exit(0)
 
     display = os.getenv('DISPLAY')
-    if display == None or len(display) == 0:
+    if display == None or len(display) == 0 or options.daemon:
         options.usegui = False
 
     portlist = []
@@ -122,4 +156,12 @@ def get_options():
         if not valid_port(port):
             die('Invalid port given: %d\n' %(port))
 
+    socketbuffers = []
+    for spec in options.socketbuffers or []:
+        sizes = parse_socket_buffers(spec)
+        if sizes == None:
+            die('Invalid socket buffer sizes given: %s\n' %(spec))
+        socketbuffers.append(sizes)
+    options.socketbuffers = socketbuffers
+
     return (options, args)
@@ -8,7 +8,6 @@
 # This software is licensed under The Clear BSD license.
 # See the LICENSE file for more details.
 #
-from gobject import io_add_watch, source_remove, IO_IN, IO_HUP
 from errno import EAGAIN, EINTR, EEXIST
 from os import abort, close, fdopen, fork, kill, mkdir, \
      pipe, read, rename, remove, waitpid, write
@@ -17,6 +16,7 @@ from signal import SIGTERM
 from subprocess import Popen, PIPE
 import os.path
 
+from ioutils import io_add_watch, source_remove, IO_IN, IO_HUP
 from support import warning
 
 def safe_write(fname, data, safe=True):
@@ -183,7 +183,7 @@ def xrun(cmd, cb, ctx, inputdata=None):
     when the command finishes with its output given to cb() at parameter
     'data'. If 'inputdata' is given, feed it to the command from stdin.
 
-    The result is relayed through the gobject mainloop.
+    The result is relayed through the main loop.
     """
 
     (rfd, wfd) = xpipe()
@@ -11,6 +11,8 @@
 from meta import Meta
 
 class Plugin_State(Meta):
+    __slots__ = ['metaattributes']
+
     def __init__(self):
         # metaattributes is not a class variable in plugin specific state
         self.metaattributes = {}
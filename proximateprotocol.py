@@ -10,7 +10,14 @@
 #
 import string
 
-PROXIMATE_PROTOCOL_VERSION = 0
+# Version history:
+# 0: Initial version
+# 1: udpfetcher uses binary fragment headers
+# 2: udpfetcher parity fragments
+# 3: udpfetcher listens to community fetches on a multicast group
+# 4: udpfetcher compression with a preset dictionary
+# 5: udpfetcher packet identifiers start from a random number
+PROXIMATE_PROTOCOL_VERSION = 5
 
 PLUGIN_TYPE_COMMUNITY = 'community'
 PLUGIN_TYPE_FETCHER = 'fetcher'
@@ -35,6 +42,10 @@ TP_MAX_PORT = 65535
 DEFAULT_PROXIMATE_PORT = 10651
 PORT_RETRIES = 13
 
+# udpfetcher sends no-ack community fetches to this multicast group
+TP_MULTICAST_GROUP = '239.255.106.51'
+TP_MULTICAST_PORT = 10650
+
 DEFAULT_COMMUNITY_NAME = 'Proximate'
 FRIENDS_COMMUNITY_NAME = 'Friends'
 BLACKLIST_COMMUNITY_NAME = 'Blacklist'
@@ -119,6 +130,7 @@ FS_GID_LIMIT = pow(2, 64)
 
 PROFILE_ICON_CHANGED = 0
 HOP_COUNT_CHANGED = 1
+PROTOCOL_VERSION_CHANGED = 2
 
 def valid_community(community):
     if type(community) != str:
@@ -11,7 +11,6 @@
 """
 User and community database management, configfile reading and writing
 """
-from copy import deepcopy
 import os
 import sys
 
@@ -490,7 +489,9 @@ class State_Plugin(Plugin):
         return pstate
 
     def get_plugin_variable(self, pluginname, varname):
-        return deepcopy(self.get_plugin_state(pluginname).get(varname))
+        """ The value is not copied. It must not be modified. """
+
+        return self.get_plugin_state(pluginname).get(varname)
 
     def save_plugin_state(self, pluginname):
         if pluginname == None:
@@ -503,7 +504,10 @@ class State_Plugin(Plugin):
                 pstate.save_to_python_file(self.get_plugin_state_path(name))
 
     def set_plugin_variable(self, pluginname, varname, value):
-        self.get_plugin_state(pluginname).set(varname, deepcopy(value))
+        """ The value is not copied. It must not be modified after this
+        call. """
+
+        self.get_plugin_state(pluginname).set(varname, value)
 
 def init(options):
     State_Plugin(options)
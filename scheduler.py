@@ -8,40 +8,61 @@
 # This software is licensed under The Clear BSD license.
 # See the LICENSE file for more details.
 #
-from gobject import timeout_add_seconds
 from datetime import datetime, timedelta
+from heapq import heapify, heappop, heappush
 from os import listdir, remove
-from os.path import join
+from os.path import basename, join
 from tempfile import mkstemp
-from time import time
+from time import mktime, time
 
-from ossupport import xclose
+from bencode import bencode, fmt_bdecode
+from ioutils import Timeout_Heap, monotonic_time
+from ossupport import safe_write, xclose
 from plugins import Plugin, get_plugin_by_type
 from support import die, warning
 from proximateprotocol import PLUGIN_TYPE_SCHEDULER, PLUGIN_TYPE_COMMUNITY
+from typevalidator import ZERO_OR_MORE, compile as compile_spec
 from utils import str_to_int
 
-# seconds
-SCHEDULE_PERIOD = 5
+def delta_seconds(rel):
+    """ Convert a datetime.timedelta or a number to seconds """
 
-class Periodic_Timer:
-    def __init__(self, period, callback, ctx):
-        assert((period % SCHEDULE_PERIOD) == 0)
-        self.div = period // SCHEDULE_PERIOD
+    if isinstance(rel, timedelta):
+        return 3600 * 24 * rel.days + rel.seconds + rel.microseconds / 1000000.0
+    return rel
+
+class Timer:
+    """ A handle for a scheduled call. A one-shot timer calls
+    callback(ctx), and a periodic timer calls callback(t, ctx). """
+
+    def __init__(self, timers, callback, ctx, period=None):
+        self.timers = timers
         self.callback = callback
         self.ctx = ctx
-        self.step = 0
+        self.period = period
+        self.deadline = None
+        self.cancelled = False
+
+    def cancel(self):
+        """ Remove the timer. Returns True iff it was still pending. A
+        periodic timer may cancel itself from its callback. """
+
+        self.cancelled = True
+        return self.timers.remove(self)
+
+    def pending(self):
+        return self in self.timers
+
+    def schedule(self, deadline):
+        self.deadline = deadline
+        self.timers.add_at(self, deadline)
 
     def call(self, t):
+        if self.period == None:
+            self.callback(self.ctx)
+            return False
         return self.callback(t, self.ctx)
 
-    def test(self, t):
-        self.step += 1
-        if self.step != self.div:
-            return True
-        self.step = 0
-        return self.call(t)
-
 class Scheduler_Plugin(Plugin):
 
     # These constants can be used to represent time deltas (relative times)
@@ -50,30 +71,45 @@ class Scheduler_Plugin(Plugin):
 
     EXPIRE_PREFIX = 'expiringfile'
 
+    # Expiring files are listed in this file under user's proximate
+    # directory, so that garbage collection does not need to scan the
+    # directory. 'clean' is 0 while the scheduler is running. If the index
+    # is not clean when it is loaded, it is rebuilt from the directory.
+    EXPIRE_INDEX = 'expiryindex'
+    expireindexspec = compile_spec({'clean': int, 'files': [ZERO_OR_MORE, [int, str]]})
+
     def __init__(self):
         self.register_plugin(PLUGIN_TYPE_SCHEDULER)
         self.community = None
 
-        self.callbacks = []
-        self.periodic = []
-        timeout_add_seconds(SCHEDULE_PERIOD, self.schedule)
+        # Min-heap of (expiration time, file name). Expiration times are
+        # wall clock seconds, because the files outlive the process.
+        self.expiring = []
+
+        # Deadlines are kept on the monotonic clock, so wall clock
+        # changes do not fire or stall timers
+        self.timers = Timeout_Heap(self.expire, clock=monotonic_time)
 
     def call_at(self, dt, callback, ctx=None):
-        """ Call callback(ctx) at dt, where dt is datetime.datetime object """
-        self.callbacks.append((dt, callback, ctx))
+        """ Call callback(ctx) at dt, where dt is datetime.datetime object.
+            Returns a Timer that can be cancelled. """
+
+        return self.call_in(dt - datetime.now(), callback, ctx)
 
     def call_in(self, rel, callback, ctx=None):
-        """ Call callback(ctx) is a datetime.timedelta object """
+        """ Call callback(ctx) after rel, which is a datetime.timedelta
+            object or a number of seconds. Returns a Timer that can be
+            cancelled. """
 
-        dt = datetime.now() + rel
-        self.call_at(dt, callback, ctx)
+        timer = Timer(self.timers, callback, ctx)
+        timer.schedule(monotonic_time() + max(0, delta_seconds(rel)))
+        return timer
 
     def call_periodic(self, period, callback, ctx=None, callnow=False):
         """ Install a periodic timer. Returns the timer iff it is
             installed, otherwise None.
 
-            Period is a datetime.timedelta object. The period must be a
-            multiple of SCHEDULE_PERIOD.
+            Period is a datetime.timedelta object or a number of seconds.
 
             The callback should return False or True. The timer is removed
             iff False is returned from the callback. The timer calls
@@ -82,15 +118,23 @@ class Scheduler_Plugin(Plugin):
             The timer is not installed if callnow == True and the first
             callback returns False. """
 
-        secs = 3600 * 24 * period.days + period.seconds
-        timer = Periodic_Timer(secs, callback, ctx)
-        success = True
-        if callnow:
-            success = timer.call(time())
-        if success:
-            self.periodic.append(timer)
-            return timer
-        return None
+        secs = delta_seconds(period)
+        assert(secs > 0)
+        timer = Timer(self.timers, callback, ctx, period=secs)
+        if callnow and (not timer.call(time()) or timer.cancelled):
+            return None
+        timer.schedule(monotonic_time() + secs)
+        return timer
+
+    def expire(self, timer):
+        if not timer.call(time()) or timer.cancelled:
+            return
+        # Periodic timers do not drift, unless they have fallen behind
+        now = monotonic_time()
+        deadline = timer.deadline + timer.period
+        if deadline <= now:
+            deadline = now + timer.period
+        timer.schedule(deadline)
 
     def parse_filename_datetime(self, name):
         fields = name.split('-')
@@ -111,29 +155,65 @@ class Scheduler_Plugin(Plugin):
         second = secs % 60
         return datetime(year, month, day, hour, minute, second)
 
-    def remove_garbage(self, t, ctx):
-        now = datetime.now()
+    def get_expire_index_name(self):
+        return join(self.community.get_user_dir(), self.EXPIRE_INDEX)
+
+    def load_expire_index(self):
+        """ Load the expiring file index. Returns False if the index is
+            missing, broken or was not saved cleanly. """
+
+        try:
+            f = open(self.get_expire_index_name(), 'r')
+            data = f.read()
+            f.close()
+        except IOError:
+            return False
+        d = fmt_bdecode(self.expireindexspec, data)
+        if d == None or d['clean'] == 0:
+            return False
+        self.expiring = map(tuple, d['files'])
+        heapify(self.expiring)
+        return True
+
+    def save_expire_index(self, clean):
+        d = {'clean': int(clean), 'files': map(list, self.expiring)}
+        return safe_write(self.get_expire_index_name(), bencode(d))
+
+    def rebuild_expire_index(self):
+        """ Recover the index from file names after a crash """
+
+        self.expiring = []
         dname = self.community.get_user_dir()
         for fname in listdir(dname):
             if not fname.startswith(self.EXPIRE_PREFIX):
                 continue
-            path = join(dname, fname)
             dt = self.parse_filename_datetime(fname)
             if dt == None:
-                warning('Bad expiring file name, just remove it: %s\n' % path)
-            if dt == None or dt <= now:
-                try:
-                    remove(path)
-                    warning('Garbage collected %s\n' % path)
-                except OSError:
-                    warning('Could not delete %s\n' % path)
+                warning('Bad expiring file name, just remove it: %s\n' % join(dname, fname))
+                t = 0
+            else:
+                t = int(mktime(dt.timetuple()))
+            self.expiring.append((t, fname))
+        heapify(self.expiring)
+
+    def remove_garbage(self, t, ctx):
+        dname = self.community.get_user_dir()
+        while len(self.expiring) > 0 and self.expiring[0][0] <= t:
+            (expires, fname) = heappop(self.expiring)
+            path = join(dname, fname)
+            try:
+                remove(path)
+                warning('Garbage collected %s\n' % path)
+            except OSError:
+                warning('Could not delete %s\n' % path)
         return True
 
     def get_expiring_file(self, dt=None, rel=None):
         """ Create a temp file, which expires at a given time. The temp file
             is stored under user's proximate directory. The file will expire
             (be deleted) after the given time. The actual deletion time is
-            not very accurate.
+            not very accurate. The file is added to the expiring file index,
+            so it must be created with this function to be collected.
 
             dt is a point in time, which is an instance of datetime.datetime.
             If dt == None, it is assumed to be now. If rel == None,
@@ -162,37 +242,26 @@ class Scheduler_Plugin(Plugin):
             warning('expiring_file: mkstemp() failed\n')
             return None
         xclose(fd)
+        heappush(self.expiring, (int(mktime(dt.timetuple())), basename(fname)))
         return fname
 
     def ready(self):
         self.community = get_plugin_by_type(PLUGIN_TYPE_COMMUNITY)
 
+        if not self.load_expire_index():
+            self.rebuild_expire_index()
+        # Files created from now on are only in memory until cleanup()
+        self.save_expire_index(False)
+
         # Cleanup garbage files every 5 mins
         self.call_periodic(300 * self.SECOND, self.remove_garbage)
 
     def remove_periodic(self, timer):
-        self.periodic.remove(timer)
-
-    def schedule(self):
-        now = datetime.now()
-        i = 0
-        while i < len(self.callbacks):
-            (t, callback, ctx) = self.callbacks[i]
-            if now >= t:
-                callback(ctx)
-                self.callbacks.pop(i)
-            else:
-                i += 1
+        timer.cancel()
 
-        t = time()
-        i = 0
-        while i < len(self.periodic):
-            if not self.periodic[i].test(t):
-                self.periodic.pop(i)
-                continue
-            i += 1
-
-        return True
+    def cleanup(self):
+        if self.community != None:
+            self.save_expire_index(True)
 
 def init(options):
     Scheduler_Plugin()
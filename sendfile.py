@@ -11,13 +11,14 @@
 import os
 
 from bencode import fmt_bdecode, bencode
-from ioutils import get_flen, TCP_Queue, TCPQ_ERROR
+from ioutils import get_flen, TCP_Queue, TCPQ_ERROR, TCPQ_ROLE_SEND_FILE
 from plugins import Plugin, get_plugin_by_type
 from support import warning
 from proximateprotocol import TP_SEND_FILE, valid_receive_name, \
      PLUGIN_TYPE_COMMUNITY, PLUGIN_TYPE_SEND_FILE, \
      TP_CONNECT_TIMEOUT, PLUGIN_TYPE_NOTIFICATION, \
-     PLUGIN_TYPE_FILE_TRANSFER, TP_MAX_TRANSFER
+     PLUGIN_TYPE_FILE_TRANSFER
+from typevalidator import compile as compile_spec
 from utils import format_bytes
 
 SEND_FILE_ACCEPT = 'mkay'
@@ -32,13 +33,13 @@ ACCEPT_TIMEOUT = 300
 class Send_File_Server:
     """ Process incoming sendfile connection """
 
-    sendspec = {'uid': str,
-                'flen': lambda flen: (type(flen) == int or type(flen) == long) and flen >= 0,
-                'name': valid_receive_name,
-               }
+    sendspec = compile_spec({'uid': str,
+                             'flen': lambda flen: (type(flen) == int or type(flen) == long) and flen >= 0,
+                             'name': valid_receive_name,
+                            })
 
     def __init__(self, address, sock, data):
-        self.q = TCP_Queue(self.msghandler, closehandler=self.queue_closed)
+        self.q = TCP_Queue(self.msghandler, closehandler=self.queue_closed, role=TCPQ_ROLE_SEND_FILE)
 
         # Close queue that is idle for a period of time
         self.q.set_timeout(ACCEPT_TIMEOUT)
@@ -78,7 +79,7 @@ class Send_File_Server:
 
         self.initstate = False
 
-        d = fmt_bdecode(self.sendspec, data)
+        d = fmt_bdecode(self.sendspec, data, skipunknown=True)
         if d == None:
             warning('send file server: invalid msg: %s\n' % data)
             return False
@@ -154,7 +155,7 @@ class Send_File_Server:
 
 class Send_File:
     def __init__(self, user, fname):
-        self.q = TCP_Queue(self.msghandler, closehandler=self.queue_closed)
+        self.q = TCP_Queue(self.msghandler, closehandler=self.queue_closed, role=TCPQ_ROLE_SEND_FILE)
         self.user = user
         self.f = None
         self.fname = fname
@@ -231,7 +232,7 @@ class Send_File:
         if data == SEND_FILE_ACCEPT:
             self.q.set_timeout(TP_CONNECT_TIMEOUT)
 
-            self.q.set_send_handler(self.send)
+            self.q.send_file(self.f, 0, self.flen, self.sent)
             return True
         elif data == SEND_FILE_DENY:
             return False
@@ -239,15 +240,7 @@ class Send_File:
         warning('send file: invalid message %s\n' % data)
         return False
 
-    def send(self):
-        amount = min(TP_MAX_TRANSFER * 4, self.flen - self.pos)
-
-        try:
-            chunk = self.f.read(amount)
-        except IOError, (errno, strerror):
-            self.q.close(TCPQ_ERROR, msg=strerror)
-            return None
-
+    def sent(self, amount):
         self.pos += amount
 
         if self.ui != None:
@@ -255,11 +248,8 @@ class Send_File:
 
         if self.pos == self.flen:
             notify('Sent a file to %s succefully: %s' % (self.user.get('nick'), self.name))
-            self.q.set_send_handler(None)
             self.q.close_after_send('Complete')
 
-        return chunk
-
 class Send_File_Plugin(Plugin):
     def __init__(self):
         global sendfile
@@ -8,17 +8,31 @@
 # This software is licensed under The Clear BSD license.
 # See the LICENSE file for more details.
 #
-from random import choice
+from time import time
 
-from ioutils import TCP_Queue, TCPQ_NO_CONNECTION
+from ioutils import TCP_Queue, TCPQ_NO_CONNECTION, TCPQ_OK
 from plugins import Plugin, get_plugin_by_type
-from support import debug, warning
+from support import debug, info, warning
 from proximateprotocol import TP_FETCH_RECORDS, TP_CONNECT_TIMEOUT, \
      PLUGIN_TYPE_FETCHER, PLUGIN_TYPE_TCP_FETCHER, PLUGIN_TYPE_COMMUNITY, \
      TP_FETCH_TIMEOUT
 
 MAX_QUEUES_PER_USER = 8
 
+# Connection pool: at most this many queues are opened to a user. This is
+# below MAX_QUEUES_PER_USER so that the other side does not reject them.
+POOL_QUEUES_PER_USER = MAX_QUEUES_PER_USER // 2
+
+# A new queue is opened only when every queue to the user has at least
+# this many outstanding requests
+POOL_QUEUE_LOAD = 8
+
+# Users that are contacted at least WARM_CONTACTS times within
+# TP_FETCH_TIMEOUT seconds are kept warm: their queues use a longer
+# idle timeout so that the next fetch does not pay for a new connection.
+WARM_CONTACTS = 4
+WARM_FETCH_TIMEOUT = 5 * TP_FETCH_TIMEOUT
+
 community = None
 fetcher = None
 
@@ -26,20 +40,64 @@ firstmsg = None
 
 fetchqueues = {}
 
+# user -> (number of contacts, start of the counting period)
+contacts = {}
+
+poolstats = {'hits': 0, 'misses': 0}
+
 def select_queue(user):
-    # Choose the queue by random, or create a new one if none exists
-    uqueues = fetchqueues.get(user)
-    if uqueues != None and len(uqueues) > 0:
-        return choice(uqueues)
-    else:
+    """ Choose the least loaded queue to the user. A new queue is opened
+    if none exists, or if all queues are busy and the pool is not full. """
+
+    best = None
+    bestload = None
+    uqueues = fetchqueues.get(user, [])
+    for fq in uqueues:
+        load = fq.load()
+        if best == None or load < bestload:
+            best = fq
+            bestload = load
+
+    if best == None or (bestload >= POOL_QUEUE_LOAD and len(uqueues) < POOL_QUEUES_PER_USER):
+        poolstats['misses'] += 1
         return Fetch_Queue(user)
 
+    poolstats['hits'] += 1
+    return best
+
+def reply_queue(user):
+    """ Choose a queue for a reply. Any queue to the user will do, and
+    connected ones are preferred. A queue is only opened if none exists.
+    Pool statistics are not counted. """
+
+    uqueues = fetchqueues.get(user, [])
+    for fq in uqueues:
+        if fq.q.status == TCPQ_OK:
+            return fq
+    if len(uqueues) > 0:
+        return uqueues[0]
+    return Fetch_Queue(user)
+
+def note_contact(user):
+    """ Count a request or a reply. Returns True if the user is contacted
+    frequently. """
+
+    t = time()
+    (n, since) = contacts.get(user, (0, t))
+    if t - since > TP_FETCH_TIMEOUT:
+        (n, since) = (0, t)
+    n += 1
+    contacts[user] = (n, since)
+    return n >= WARM_CONTACTS
+
 class Fetch_Queue:
     def __init__(self, user=None, sock=None, address=None, data=None):
         self.q = TCP_Queue(self.fetchhandler, closehandler=self.queue_closed)
+        self.q.set_batch_handler(self.fetchbatchhandler)
         self.user = user
         self.openingconnection = (user != None)
         self.reqs = {}
+        self.warm = False
         if self.openingconnection:
             # It's an outgoing queue
             self.add_connection(user)
@@ -57,6 +115,7 @@ class Fetch_Queue:
         if req.rid >= 0:
             self.reqs[req.rid] = req
         self.q.write(req.payload)
+        self.contact()
         return True
 
     def add_connection(self, user):
@@ -67,16 +126,25 @@ class Fetch_Queue:
     def cleanup(self, msg):
         if self.user == None:
             return
-        queuelist = fetchqueues.get(self.user)
+        queuelist = fetchqueues.get(self.user, [])
         try:
             queuelist.remove(self)
         except ValueError:
             pass
+        if len(queuelist) == 0:
+            # Forget users that have no connections
+            fetchqueues.pop(self.user, None)
+            contacts.pop(self.user, None)
         debug('fetcher: connection to %s closed: %s\n' % (self.user.tag(), msg))
 
     def close(self, msg):
         self.q.close(msg=msg)
 
+    def contact(self):
+        if note_contact(self.user) and not self.warm and self.q.status != TCPQ_NO_CONNECTION:
+            self.warm = True
+            self.q.set_timeout(WARM_FETCH_TIMEOUT)
+
     def connect(self):
         ip = self.user.get('ip')
         port = self.user.get('port')
@@ -107,32 +175,70 @@ class Fetch_Queue:
         self.q.set_timeout(TP_FETCH_TIMEOUT)
         return True
 
-    def fetchhandler(self, q, msg, parameter):
-        d = fetcher.decode(msg)
-        if d == None:
-            warning('fetch master: spurious msg\n')
-            return False
+    def load(self):
+        """ Returns the number of outstanding requests. Requests that were
+        answered or that timed out are forgotten. """
+
+        for (rid, req) in self.reqs.items():
+            if req.userreplies.has_key(self.user):
+                self.reqs.pop(rid)
+        return len(self.reqs)
 
+    def identify(self, q, d):
+        """ Fetch slave: the first record tells the uid of the master """
+
+        uid = d.get('uid')
+        if uid == None or type(uid) != str:
+            warning('fetch slave: no uid in fetch connection\n')
+            return False
+        self.user = community.safe_get_user(uid, q.remote[0])
         if self.user == None:
-            uid = d.get('uid')
-            if uid == None or type(uid) != str:
-                warning('fetch slave: no uid in fetch connection\n')
+            warning('fetch slave: Invalid uid from master: %s\n' % (uid))
+            return False
+        queuelist = self.add_connection(self.user)
+        if len(queuelist) > MAX_QUEUES_PER_USER:
+            warning('Not allowing too many connections from the same user: %s\n' % (self.user.tag()))
+            return False
+        debug('fetcher: connection from %s\n' % (self.user.tag()))
+        return True
+
+    def fetchhandler(self, q, msg, parameter):
+        return self.fetchbatchhandler(q, [msg], parameter)
+
+    def fetchbatchhandler(self, q, msgs, parameter):
+        """ All records are decoded first, and then handed to the fetcher
+        in one call """
+
+        ds = []
+        for msg in msgs:
+            d = fetcher.decode(msg)
+            if d == None:
+                warning('fetch master: spurious msg\n')
                 return False
-            self.user = community.safe_get_user(uid, q.remote[0])
             if self.user == None:
-                warning('fetch slave: Invalid uid from master: %s\n' % (uid))
-                return False
-            queuelist = self.add_connection(self.user)
-            if len(queuelist) > MAX_QUEUES_PER_USER:
-                warning('Not allowing too many connections from the same user: %s\n' % (self.user.tag()))
-                return False
-            debug('fetcher: connection from %s\n' % (self.user.tag()))
+                if not self.identify(q, d):
+                    return False
+            else:
+                ds.append(d)
+
+        if len(ds) == 0:
             return True
 
+        if len(filter(lambda d: len(d['rt']) > 0, ds)) > 0:
+            self.contact()
+
+        fetcher.handle_msgs(self.user, ds, self.accept_msg)
+        # The queue may have been closed by a handler
+        return q.status == TCPQ_OK
+
+    def accept_msg(self, d):
+        """ Stop the batch if the queue was closed by a handler. Requests
+        that were not answered yet are then migrated to another queue. """
+
+        if self.q.status != TCPQ_OK:
+            return False
         if len(d['rt']) == 0:
             self.reqs.pop(d['rid'], None)  # Remove pending req (master side)
-
-        fetcher.handle_msg(self.user, d)
         return True
 
     def queue_closed(self, q, parameter, msg):
@@ -168,17 +274,34 @@ class Fetch_Queue:
         self.q.write(payload)
         return True
 
+def get_pool_stats():
+    """ Returns a dictionary of connection pool statistics """
+
+    nqueues = 0
+    for queuelist in fetchqueues.values():
+        nqueues += len(queuelist)
+    nwarm = len(filter(lambda (n, since): n >= WARM_CONTACTS, contacts.values()))
+    return {'hits': poolstats['hits'],
+            'misses': poolstats['misses'],
+            'queues': nqueues,
+            'warm': nwarm,
+           }
+
 class TCP_Fetcher(Plugin):
     def __init__(self):
         self.register_plugin(PLUGIN_TYPE_TCP_FETCHER)
         self.register_server(TP_FETCH_RECORDS, Fetch_Queue)
         self.efficient_fetch_community = False
 
-    def fetch_community(self, com, rtype, request, callback, ctx, retries, ack):
+    def cleanup(self):
+        stats = get_pool_stats()
+        info('fetcher: connection pool: %d hits, %d misses\n' %(stats['hits'], stats['misses']))
+
+    def fetch_community(self, com, rtype, request, callback, ctx, retries, ack, priority):
         # Try to connect to every user individually.
         # Note, myself is not considered an active user.
         for user in community.get_community_members(com):
-            fetcher.fetch(user, rtype, request, callback, ctx=ctx, retries=retries, ack=ack)
+            fetcher.fetch(user, rtype, request, callback, ctx=ctx, retries=retries, ack=ack, priority=priority)
         return True
 
     def functional(self):
@@ -198,8 +321,84 @@ class TCP_Fetcher(Plugin):
         return select_queue(user).add(req)
 
     def send_reply(self, user, rid, payload):
-        if not select_queue(user).send_reply(payload):
+        if not reply_queue(user).send_reply(payload):
             warning('fetcher: Can not reply to rid %d for %s\n' % (rid, user.tag()))
 
 def init(options):
     TCP_Fetcher()
+
+def test_batch(nrecords=16):
+    """ Records that arrive in one read reach the fetcher in one call. If
+    a handler closes the queue, the rest of the batch is dropped, and the
+    requests that were not answered are migrated. """
+
+    global fetcher
+    from bencode import bdecode, bencode
+
+    class Test_Fetcher:
+        def __init__(self):
+            self.batches = []
+            self.closeat = None
+            self.fq = None
+        def decode(self, msg):
+            return bdecode(msg)
+        def handle_msgs(self, user, msgs, accept):
+            handled = []
+            self.batches.append(handled)
+            for d in msgs:
+                if not accept(d):
+                    break
+                handled.append(d['rid'])
+                if d['rid'] == self.closeat:
+                    self.fq.close('Closed by a handler')
+
+    class Test_Request:
+        def __init__(self, rid):
+            self.rid = rid
+            self.userreplies = {}
+        def retry(self):
+            return False
+        def call(self, user, reply):
+            failed.append(self.rid)
+
+    class Test_User:
+        def tag(self):
+            return 'test'
+
+    def run():
+        fq = Fetch_Queue(user)
+        fetcher.fq = fq
+        for rid in xrange(nrecords):
+            fq.reqs[rid] = Test_Request(rid)
+        data = ''
+        for rid in xrange(nrecords):
+            msg = bencode({'v': 0, 't': '', 'rid': rid, 'rt': '', 'c': ''})
+            data += 'i%de%s' % (len(msg), msg)
+        fq.q.append_input(data)
+        fq.q.status = TCPQ_OK
+        return (fq, fq.q.process())
+
+    oldfetcher = fetcher
+    fetcher = Test_Fetcher()
+    user = Test_User()
+    failed = []
+
+    (fq, success) = run()
+    assert(success)
+    assert(fetcher.batches == [range(nrecords)])
+    assert(len(fq.reqs) == 0)
+    fq.cleanup('Test done')
+    assert(not fetchqueues.has_key(user))
+
+    fetcher.batches = []
+    fetcher.closeat = 3
+    (fq, success) = run()
+    assert(not success and fq.q.status != TCPQ_OK)
+    assert(fetcher.batches == [range(4)])
+    assert(sorted(failed) == range(4, nrecords))
+    for fq in fetchqueues.pop(user):
+        fq.cleanup('Test done')
+    fetcher = oldfetcher
+
+if __name__ == '__main__':
+    test_batch()
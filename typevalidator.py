@@ -28,6 +28,15 @@ class OPTIONAL_KEY:
     def __init__(self, key):
         self.key = key
 
+class MAX_LEN:
+    """ A string, list or dictionary that has at most maxlen bytes, items
+    or keys, and matches fmt. fmt_bdecode() checks the limit before the
+    value is decoded. """
+
+    def __init__(self, maxlen, fmt=ANY):
+        self.maxlen = maxlen
+        self.fmt = fmt
+
 class Invalid_Format_Object(Exception):
     def __init__(self, reason=''):
         self.reason = reason
@@ -35,34 +44,42 @@ class Invalid_Format_Object(Exception):
     def __str__(self):
         return self.reason
 
+SIZED_TYPES = (str, list, dict)
+
 def validate_list(fmt, o):
     if type(o) != list:
         return False
-    fmt = list(fmt)
-    o = list(o)
-    while len(fmt) > 0:
-        fitem = fmt.pop(0)
+    # Walk both lists with indices. Popping from the front would make
+    # long lists quadratic.
+    i = 0
+    n = len(o)
+    fpos = 0
+    flen = len(fmt)
+    while fpos < flen:
+        fitem = fmt[fpos]
+        fpos += 1
         if fitem == ZERO_OR_MORE or fitem == ONE_OR_MORE:
-            if len(fmt) == 0:
+            if fpos == flen:
                 raise Invalid_Format_Object()
-            ftype = fmt.pop(0)
-            if len(o) == 0:
-                if len(fmt) > 0:
+            ftype = fmt[fpos]
+            fpos += 1
+            if i == n:
+                if fpos < flen:
                     continue
                 return fitem == ZERO_OR_MORE
-            while len(o) > 0:
-                if not validate(ftype, o[0]):
-                    if len(fmt) > 0:
+            while i < n:
+                if not validate(ftype, o[i]):
+                    if fpos < flen:
                         break
                     return False
-                o.pop(0)
+                i += 1
             continue
-        if len(o) == 0:
+        if i == n:
             return False
-        oitem = o.pop(0)
-        if not validate(fitem, oitem):
+        if not validate(fitem, o[i]):
             return False
-    return len(o) == 0
+        i += 1
+    return i == n
 
 def validate_dict(fmt, o):
     if type(o) != dict:
@@ -98,18 +115,249 @@ def validate(fmt, o):
         return validate_list(fmt, o)
     elif type(fmt) == dict:
         return validate_dict(fmt, o)
+    elif type(fmt) == Compiled_Validator:
+        return fmt.check(o)
     elif type(fmt) == type:
         if fmt != type(o):
             # Associate int type with long. We don't use LONG as a validator
             # keyword, just int
             if fmt != int or type(o) != long:
                 return False
+    elif isinstance(fmt, MAX_LEN):
+        if type(o) not in SIZED_TYPES or len(o) > fmt.maxlen:
+            return False
+        return validate(fmt.fmt, o)
     # If given format is a not a type but a value, compare input to the given value
     elif fmt != o:
         return False
 
     return True
 
+# Compiled validators
+#
+# compile(fmt) walks a format specification once and returns a
+# Compiled_Validator. It accepts exactly the same objects as
+# validate(fmt, o), but the checks are specialized closures, so the
+# specification is not interpreted again on every call. A compiled
+# validator can be passed to validate() and fmt_bdecode(), and it can be
+# nested inside other specifications. Use it for specifications that
+# are checked for each incoming message.
+
+class Compiled_Validator(object):
+    __slots__ = ['fmt', 'check']
+
+    def __init__(self, fmt, check):
+        self.fmt = fmt
+        self.check = check
+
+    def __call__(self, o):
+        return self.check(o)
+
+INT_TYPES = (int, long)
+
+def accept_any(o):
+    return True
+
+def is_int_type(o):
+    t = type(o)
+    return t == int or t == long
+
+def compile_type(fmt):
+    if fmt == int:
+        return is_int_type
+    def check_type(o):
+        return type(o) == fmt
+    return check_type
+
+def compile_value(fmt):
+    def check_value(o):
+        return not (fmt != o)
+    return check_value
+
+def compile_repetition(rep, fmt):
+    """ Specialized check for [ZERO_OR_MORE, fmt] and [ONE_OR_MORE, fmt] """
+
+    minlen = int(rep == ONE_OR_MORE)
+    if fmt == ANY:
+        def check_any_list(o):
+            return type(o) == list and len(o) >= minlen
+        return check_any_list
+
+    if type(fmt) == type:
+        if fmt == int:
+            types = INT_TYPES
+        else:
+            types = (fmt, )
+        def check_type_list(o):
+            if type(o) != list or len(o) < minlen:
+                return False
+            for x in o:
+                if type(x) not in types:
+                    return False
+            return True
+        return check_type_list
+
+    check = compile_check(fmt)
+    def check_list(o):
+        if type(o) != list or len(o) < minlen:
+            return False
+        for x in o:
+            if not check(x):
+                return False
+        return True
+    return check_list
+
+def compile_list(fmt):
+    items = []
+    fpos = 0
+    while fpos < len(fmt):
+        fitem = fmt[fpos]
+        fpos += 1
+        rep = None
+        if fitem == ZERO_OR_MORE or fitem == ONE_OR_MORE:
+            if fpos == len(fmt):
+                raise Invalid_Format_Object('Repetition without a type')
+            rep = fitem
+            fitem = fmt[fpos]
+            fpos += 1
+        items.append((rep, compile_check(fitem)))
+
+    if len(items) == 1 and items[0][0] != None:
+        return compile_repetition(fmt[0], fmt[1])
+
+    if len(filter(lambda item: item[0] != None, items)) == 0:
+        checks = map(lambda item: item[1], items)
+        nchecks = len(checks)
+        def check_fixed_list(o):
+            if type(o) != list or len(o) != nchecks:
+                return False
+            for i in xrange(nchecks):
+                if not checks[i](o[i]):
+                    return False
+            return True
+        return check_fixed_list
+
+    # General case: the same greedy matching as in validate_list()
+    last = len(items) - 1
+    def check_list(o):
+        if type(o) != list:
+            return False
+        i = 0
+        n = len(o)
+        for k in xrange(len(items)):
+            (rep, check) = items[k]
+            if rep != None:
+                if i == n:
+                    if k < last:
+                        continue
+                    return rep == ZERO_OR_MORE
+                while i < n:
+                    if not check(o[i]):
+                        if k < last:
+                            break
+                        return False
+                    i += 1
+                continue
+            if i == n or not check(o[i]):
+                return False
+            i += 1
+        return i == n
+    return check_list
+
+def compile_dict(fmt):
+    # Required keys are split by the kind of value check, so that
+    # the common cases do not need a function call per key
+    present = []
+    typed = []
+    checked = []
+    optional = []
+    keytypes = []
+    anykeytypes = []
+    for (key, value) in fmt.items():
+        check = compile_check(value)
+        if type(key) == type:
+            if key == int:
+                types = INT_TYPES
+            else:
+                types = (key, )
+            if value == ANY:
+                anykeytypes.append(types)
+            else:
+                keytypes.append((types, check))
+        elif isinstance(key, OPTIONAL_KEY):
+            optional.append((key.key, check))
+        elif value == ANY:
+            present.append(key)
+        elif type(value) == type:
+            if value == int:
+                typed.append((key, INT_TYPES))
+            else:
+                typed.append((key, (value, )))
+        else:
+            checked.append((key, check))
+
+    def check_dict(o):
+        if type(o) != dict:
+            return False
+        for key in present:
+            if key not in o:
+                return False
+        for (key, types) in typed:
+            if key not in o or type(o[key]) not in types:
+                return False
+        for (key, check) in checked:
+            if key not in o or not check(o[key]):
+                return False
+        for (key, check) in optional:
+            if key in o and not check(o[key]):
+                return False
+        for types in anykeytypes:
+            for key in o:
+                if type(key) not in types:
+                    return False
+        for (types, check) in keytypes:
+            for (key, value) in o.iteritems():
+                if type(key) not in types or not check(value):
+                    return False
+        return True
+    return check_dict
+
+def compile_max_len(fmt):
+    maxlen = fmt.maxlen
+    check = compile_check(fmt.fmt)
+    def check_max_len(o):
+        if type(o) not in SIZED_TYPES or len(o) > maxlen:
+            return False
+        return check(o)
+    return check_max_len
+
+def compile_check(fmt):
+    """ Returns a function that validates an object against fmt """
+
+    if fmt == ANY:
+        return accept_any
+    if type(fmt) == FunctionType:
+        return fmt
+    elif type(fmt) == list:
+        return compile_list(fmt)
+    elif type(fmt) == dict:
+        return compile_dict(fmt)
+    elif type(fmt) == Compiled_Validator:
+        return fmt.check
+    elif type(fmt) == type:
+        return compile_type(fmt)
+    elif isinstance(fmt, MAX_LEN):
+        return compile_max_len(fmt)
+    return compile_value(fmt)
+
+def compile(fmt):
+    """ Compile a format specification. Raises Invalid_Format_Object
+    if the specification is malformed. """
+
+    if type(fmt) == Compiled_Validator:
+        return fmt
+    return Compiled_Validator(fmt, compile_check(fmt))
+
 def test_validate():
     assert(validate([str, [ONE_OR_MORE, int], [ZERO_OR_MORE, int], {'a': int, 1: str}], ['fff', [0], [], {'a': 0, 1: 'foo'}]))
     assert(validate([str, [ONE_OR_MORE, int], [ZERO_OR_MORE, int], {'a': int, 1: str}], [1, [0], [], {'a': 0, 1: 'foo'}]) == False)
@@ -155,11 +403,72 @@ def test_validate():
     assert(validate({'x': int}, {'x': 0L}))
     assert(validate({int: ANY}, {0L: 'x'}))
 
+    # Test MAX_LEN
+    assert(validate({'x': MAX_LEN(3, str)}, {'x': 'foo'}))
+    assert(validate({'x': MAX_LEN(3, str)}, {'x': 'fooo'}) == False)
+    assert(validate({'x': MAX_LEN(3, str)}, {'x': 1}) == False)
+    assert(validate(MAX_LEN(2, [ZERO_OR_MORE, int]), [1, 2]))
+    assert(validate(MAX_LEN(2, [ZERO_OR_MORE, int]), [1, 2, 3]) == False)
+    assert(validate(MAX_LEN(1), {'a': 1}))
+    assert(validate(MAX_LEN(1), {'a': 1, 'b': 2}) == False)
+
     # Typevalidator can be used to check that values are equal
     assert(validate([1, 2, 3, [True, 'a']], [1, 2, 3, [True, 'a']]))
     assert(validate('foo', 'bar') == False)
 
-def benchmark():
+def test_compile():
+    even = lambda x: type(x) == int and x % 2 == 0
+    specs = [ANY, str, int, bool, 'foo', 1, even,
+             [str, [ONE_OR_MORE, int], [ZERO_OR_MORE, int], {'a': int, 1: str}],
+             [ONE_OR_MORE, int, ZERO_OR_MORE, str],
+             [ZERO_OR_MORE, int, ONE_OR_MORE, str],
+             [ZERO_OR_MORE, int], [ONE_OR_MORE, str], [ONE_OR_MORE, ANY],
+             [ZERO_OR_MORE, {'x': int}], [1, 2, 3, [True, 'a']], [],
+             {str: str}, {str: int}, {int: str}, {int: ANY}, {'x': int},
+             {'x': int, str: int}, {'x': bool}, {'x': ANY}, {'x': even},
+             {OPTIONAL_KEY('x'): int}, {str: ANY, 'x': [ZERO_OR_MORE, str]},
+             {}, compile({'x': int}), [ZERO_OR_MORE, compile([str, int])],
+             MAX_LEN(3), MAX_LEN(1, [ZERO_OR_MORE, int]), {'x': MAX_LEN(3, str)},
+            ]
+    objects = [None, 0, 1, 2, 0L, True, False, '', 'foo', 'bar', [], [0],
+               [1, 1, 1], [1, 1, 1, 's'], ['d'], ['a', 1], [1, 2, 3, [True, 'a']],
+               [{'x': 1}, {'x': 'y'}], [['a', 1], ['b', 2L]], [None],
+               ['fff', [0], [], {'a': 0, 1: 'foo'}],
+               ['fff', [], [], {'a': 0, 1: 'foo'}],
+               {}, {'a': 'b'}, {1: 'b'}, {'a': 1}, {1: 'a', 'b': 2}, {0L: 'x'},
+               {'x': 1}, {'y': 1}, {'x': 1, 'y': 1}, {'x': 1, 1: 1},
+               {'x': False}, {'x': 'invalid'}, {'x': 0L}, {'x': ['a', 'b']},
+               {'x': ['a', 1]},
+              ]
+    for fmt in specs:
+        validator = compile(fmt)
+        assert(compile(validator) is validator)
+        for o in objects:
+            assert(validator(o) == validate(fmt, o))
+            assert(validate(validator, o) == validate(fmt, o))
+
+    # Compiled validators work as class attributes
+    class Spec_Holder:
+        spec = compile({'x': int})
+    assert(validate(Spec_Holder().spec, {'x': 1}))
+    assert(Spec_Holder.spec({'x': 'y'}) == False)
+
+    try:
+        compile([ZERO_OR_MORE])
+        assert(False)
+    except Invalid_Format_Object:
+        pass
+
+    # Long lists are linear time in both implementations
+    l = range(200000)
+    assert(validate([ZERO_OR_MORE, int], l))
+    assert(validate([ZERO_OR_MORE, int, str], l + ['s']))
+    assert(compile([ZERO_OR_MORE, int, str])(l + ['s']))
+    assert(compile([ZERO_OR_MORE, int, str])(l) == False)
+
+def benchmark(n=100000):
+    from time import time
+
     specification = {'uid': str,
                      'ids': [ZERO_OR_MORE, int],
                      'purposes': [ZERO_OR_MORE, str],
@@ -170,9 +479,33 @@ def benchmark():
                'purposes': ['a', 'b', 'c', 'd', 'e'],
                'metas': [{}, {}, {}, {}, {}],
               }
-    for i in xrange(100000):
-        if not validate(specification, request):
-            assert(False)
+    fetchspec = {'rid': int, OPTIONAL_KEY('v'): int, 't': str, 'rt': str, 'c': str}
+    fetchrequest = {'v': 0, 't': 'uprofile', 'c': '', 'rid': 0, 'rt': 'community'}
+    sharesspec = {'uid': str, 'metas': [ZERO_OR_MORE, {str: ANY, 'id': int}]}
+    shares = {'uid': '0123456789abcdef',
+              'metas': [{'id': i, 'description': 'x'} for i in xrange(200)]}
+
+    print 'Validation benchmark (microseconds per call)'
+    print '%-16s %12s %12s' %('message', 'interpreted', 'compiled')
+    for (name, spec, o, count) in [('list request', specification, request, n),
+                                   ('fetch request', fetchspec, fetchrequest, n),
+                                   ('share list', sharesspec, shares, n // 100),
+                                   ('long int list', [ZERO_OR_MORE, int], range(10000), 10)]:
+        validator = compile(spec)
+        t0 = time()
+        for i in xrange(count):
+            if not validate(spec, o):
+                assert(False)
+        t1 = time()
+        for i in xrange(count):
+            if not validator(o):
+                assert(False)
+        t2 = time()
+        print '%-16s %12.2f %12.2f' %(name, (t1 - t0) * 1e6 / count, (t2 - t1) * 1e6 / count)
 
 if __name__ == '__main__':
+    import sys
     test_validate()
+    test_compile()
+    if '--bench' in sys.argv:
+        benchmark()
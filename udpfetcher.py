@@ -8,202 +8,1079 @@
 # This software is licensed under The Clear BSD license.
 # See the LICENSE file for more details.
 #
-from errno import EAGAIN, EINTR
-from gobject import io_add_watch, timeout_add, IO_IN, source_remove
+from binascii import hexlify, unhexlify
+from collections import deque, OrderedDict
+import struct
 import zlib
-from random import random
-from typevalidator import validate, ONE_OR_MORE
+from random import random, randint
+from typevalidator import compile as compile_spec, validate, MAX_LEN, ONE_OR_MORE, OPTIONAL_KEY
 
 from meta import is_unsigned_int
-from ioutils import create_udp_socket, send_broadcast
+from ioutils import create_udp_socket, create_multicast_socket, \
+     send_broadcast, send_datagrams, recv_datagrams, io_add_watch, IO_IN, \
+     Timeout_Heap, monotonic_time
 from plugins import Plugin, get_plugin_by_type
 from support import info, warning, debug
 from proximateprotocol import PLUGIN_TYPE_UDP_FETCHER, PLUGIN_TYPE_FETCHER, \
-     PLUGIN_TYPE_COMMUNITY, valid_uid, TP_MAX_RECORD_SIZE
+     PLUGIN_TYPE_COMMUNITY, PLUGIN_TYPE_SETTINGS, PLUGIN_TYPE_MESSAGE_BOARD, \
+     PLUGIN_TYPE_MESSAGING, PLUGIN_TYPE_FILE_SHARING, DEFAULT_COMMUNITY_NAME, \
+     valid_uid, TP_MAX_RECORD_SIZE, \
+     TP_MULTICAST_GROUP, TP_MULTICAST_PORT, PROXIMATE_PROTOCOL_VERSION, \
+     PROTOCOL_VERSION_CHANGED
 from fetcher import Request
 from bencode import fmt_bdecode, bencode
 from utils import decompress_with_limit
 
 MTU = 1024
+MAX_FRAGMENTS = TP_MAX_RECORD_SIZE // MTU + 1
 
 RETRY_INTERVAL = 10  # sec
 MAX_RETRIES = 3
-SEND_ACK_DELAY = 2 # sec
 RECEIVE_TIMEOUT = 40  # sec
 
+# Maximum number of datagrams read per wakeup
+MAX_READ_DATAGRAMS = 64
+
+# Partially received packets are reassembled into buffers of
+# fragcount * MTU bytes. The buffers of all users may take at most
+# REASSEMBLY_BUDGET bytes, and the buffers of one user at most
+# PEER_REASSEMBLY_QUOTA bytes. When a new packet does not fit, the least
+# recently progressed packets of the user are dropped first, and then
+# those of the user that holds the most memory. The sender retransmits
+# dropped fragments.
+REASSEMBLY_BUDGET = 8 * 1024 * 1024
+PEER_REASSEMBLY_QUOTA = REASSEMBLY_BUDGET // 4
+
+# Retransmission timeout (RTO) is computed from round trip time samples
+# as in RFC 6298. Seconds.
+INITIAL_RTO = 1.0
+MIN_RTO = 0.2
+MAX_RTO = RETRY_INTERVAL
+
+# Congestion window is counted in fragments
+INITIAL_CWND = 4
+MIN_SSTHRESH = 2
+MAX_CWND = 64
+
+# A fragment is considered lost when this many fragments that were sent
+# after it to the same user have been acked. Each fragment is acked at
+# once, and datagrams are rarely reordered on a local link.
+REORDER_THRESHOLD = 1
+
+# If no ack arrives in two round trip times, one fragment is sent beyond
+# the congestion window to get an ack sooner than the RTO (loss probe).
+# Seconds.
+MIN_PROBE_TIMEOUT = 0.01
+
 PACKET_DATA = 'data'
 PACKET_ACK = 'ack'
 
+# Peers that announce at least BINARY_HEADER_VERSION in their hello are
+# sent fragments with a fixed binary header. Older peers get bencoded
+# dictionaries. A bencoded datagram starts with 'd', so the first byte
+# tells the formats apart. Acks are sent in the format of the data.
+BINARY_HEADER_VERSION = 1
+BINARY_MAGIC = '\x81'
+BINARY_TYPE_DATA = 0
+BINARY_TYPE_ACK = 1
+BINARY_FLAG_ACK = 1
+
+# Forward error correction (FEC): packets to peers of at least
+# FEC_VERSION may carry one parity fragment per group of FEC_GROUP data
+# fragments. The parity is the XOR of the group, so the receiver rebuilds
+# one lost fragment per group without a retransmission. A parity fragment
+# has the group number in the fragment field. Its payload is the XOR of
+# the fragment lengths followed by the XOR of the fragments padded to MTU
+# bytes. FEC is only used with binary headers.
+FEC_VERSION = 2
+FEC_GROUP = 8
+BINARY_FLAG_PARITY = 2
+BINARY_FLAG_FEC = 4      # The packet has parity fragments
+fec_length = struct.Struct('!H')
+
+# No-ack fetches to a peer community are sent once to a multicast group
+# that peers of at least MULTICAST_VERSION listen to. Older members get
+# unicast copies. Multicast fragments are addressed to MULTICAST_UID, which
+# is not a valid user identifier.
+MULTICAST_VERSION = 3
+MULTICAST_UID = '0' * 16
+
+# Payloads shorter than COMPRESS_THRESHOLD bytes, and payloads that do not
+# shrink, are sent uncompressed. Peers of at least ZDICT_VERSION are sent
+# payloads of at most ZDICT_MAX_SIZE bytes compressed with a preset
+# dictionary of protocol vocabulary, which makes small messages several
+# times smaller. Other payloads are compressed with plain zlib. Binary
+# headers tell the method with flags. Older peers decode a payload as is
+# if it does not decompress.
+COMPRESS_ZLIB = 0
+COMPRESS_NONE = 1
+COMPRESS_ZDICT = 2
+COMPRESS_THRESHOLD = 32
+DEFAULT_COMPRESSION_LEVEL = 6
+ZDICT_VERSION = 4
+ZDICT_MAX_SIZE = 16 * 1024
+BINARY_FLAG_RAW = 8
+BINARY_FLAG_ZDICT = 16
+
+# Python 2 zlib has no preset dictionaries. Instead, the dictionary is
+# compressed and decompressed once, and the resulting stream states are
+# copied for each payload, which gives the same effect. A small window
+# keeps the copies cheap.
+ZDICT_WBITS = 12
+ZDICT_MEMLEVEL = 4
+
+# The dictionary is a part of the protocol. Changing it requires a new
+# protocol version. The most common strings are at the end.
+zdictsamples = [
+    {'uid': '', 'nick': '', 'communities': [DEFAULT_COMMUNITY_NAME],
+     'age': '', 'birth_date': '', 'city': '', 'country': '',
+     'description': '', 'email': '', 'gender': '', 'languages': '',
+     'name': '', 'occupation': '', 'phone_numbers': '', 'state': '',
+     'status': '', 'status_icon': '', 'www': '', 'faceversion': 0,
+     'fscounter': 0},
+    {'v': 0, 't': 'request', 'c': DEFAULT_COMMUNITY_NAME, 'rid': 0,
+     'rt': PLUGIN_TYPE_FILE_SHARING, 'keywords': [], 'criteria': {},
+     'shareids': [], 'sharepaths': []},
+    {'v': 0, 't': 'msg', 'c': '', 'rid': 0, 'rt': PLUGIN_TYPE_MESSAGING,
+     'msg': ''},
+    {'v': 0, 't': 'msgpush', 'c': DEFAULT_COMMUNITY_NAME, 'rid': -1,
+     'rt': PLUGIN_TYPE_MESSAGE_BOARD, 'msgs': []},
+    {'v': 0, 't': 'iconrequest', 'c': '', 'rid': 0,
+     'rt': PLUGIN_TYPE_COMMUNITY, 'version': 0},
+    {'v': 0, 't': 'uprofile', 'c': '', 'rid': 0,
+     'rt': PLUGIN_TYPE_COMMUNITY, 'version': 0},
+    {'v': 0, 't': '', 'c': '', 'rid': 0, 'rt': '', 'rs': ''},
+    ]
+zdict = ''.join(map(bencode, zdictsamples))
+zcompressors = {}         # level -> compressor after the dictionary
+zdecompressor = None
+
+# Identifiers of the last DUPLICATE_WINDOW completed packets of each user
+# are remembered, so that late retransmissions are acked but not handled
+# again. Older packets are dropped silently. The cache is forgotten if no
+# packet completes in DUPLICATE_TIMEOUT seconds, or when the user
+# reappears or announces another protocol version. Peers of at least
+# DUPLICATE_VERSION start packet identifiers from a random number, so a
+# restarted sender does not look like a duplicate. Older peers number
+# packets from 0, and the cache is not used for them.
+DUPLICATE_WINDOW = 1024
+DUPLICATE_TIMEOUT = 600
+DUPLICATE_VERSION = 5
+
+# magic, type, from uid, to uid, packet. An ack is followed by a bitmap
+# of received fragments.
+binary_header = struct.Struct('!cB8s8sI')
+# Data fragments add fragment number, fragment count and flags, and are
+# followed by the payload
+binary_data_header = struct.Struct('!cB8s8sIHHB')
+
+packetspec = compile_spec({
+    't': str,
+    'from': valid_uid,
+    'to': str,
+    OPTIONAL_KEY('payload'): MAX_LEN(MTU, str),
+    })
+
+dataspec = compile_spec({
+    'packet': int,
+    'frag': lambda i: is_unsigned_int('frag', i),
+    'fragcount': lambda i: is_unsigned_int('fragcount', i),
+    'payload': str,
+    'ack': bool,
+    OPTIONAL_KEY('sack'): bool,
+    })
+
+ackspec = compile_spec({
+    'packet': int,
+    OPTIONAL_KEY('ack'): MAX_LEN(MAX_FRAGMENTS, [ONE_OR_MORE, lambda i: is_unsigned_int('ack', i)]),
+    OPTIONAL_KEY('sack'): MAX_LEN((MAX_FRAGMENTS + 7) // 8, str),
+    })
+
 pending_sends = {}
 pending_receives = {}
+peers = {}
+reassembly_bytes = 0
 community = None
 plugin = None
 
+def receive_timeout(key):
+    o = pending_receives.pop(key, None)
+    if o != None:
+        o.release()
+
+# Receivers restart their timeout on each fragment
+receive_timeouts = Timeout_Heap(receive_timeout)
+
+def retransmit_timeout(o):
+    o.retry_timer()
+
+# Retransmission timers of peers and unacked senders
+retransmit_timeouts = Timeout_Heap(retransmit_timeout)
+
+def encode_bitmap(indices, n):
+    """ Return a string of n bits where bit i is set iff i is in indices """
+
+    bitmap = bytearray((n + 7) // 8)
+    for i in indices:
+        bitmap[i >> 3] |= 1 << (i & 7)
+    return str(bitmap)
+
+def full_bitmap(n):
+    """ Return a string of n bits that are all set """
+
+    bitmap = '\xff' * (n // 8)
+    if n % 8 != 0:
+        bitmap += chr((1 << (n % 8)) - 1)
+    return bitmap
+
+def decode_bitmap(bitmap):
+    indices = []
+    for byte in xrange(len(bitmap)):
+        bits = ord(bitmap[byte])
+        bit = 0
+        while bits != 0:
+            if bits & 1:
+                indices.append(8 * byte + bit)
+            bits >>= 1
+            bit += 1
+    return indices
+
+def encode_data(binary, fromuid, touid, packet, frag, fragcount, ack, payload, fec=False, parity=False, compression=COMPRESS_ZLIB):
+    if binary:
+        flags = 0
+        if ack:
+            flags |= BINARY_FLAG_ACK
+        if fec:
+            flags |= BINARY_FLAG_FEC
+        if parity:
+            flags |= BINARY_FLAG_PARITY
+        if compression == COMPRESS_NONE:
+            flags |= BINARY_FLAG_RAW
+        elif compression == COMPRESS_ZDICT:
+            flags |= BINARY_FLAG_ZDICT
+        return binary_data_header.pack(BINARY_MAGIC, BINARY_TYPE_DATA,
+            unhexlify(fromuid), unhexlify(touid), packet, frag, fragcount,
+            flags) + payload
+    return bencode({
+        't': PACKET_DATA,
+        'from': fromuid,
+        'to': touid,
+        'packet': packet,
+        'frag': frag,
+        'fragcount': fragcount,
+        'payload': payload,
+        'ack': ack,
+        'sack': True,
+        })
+
+def xor_fragments(fragments):
+    """ Return the XOR of fragments padded with zeros to MTU bytes """
+
+    x = 0
+    for fragment in fragments:
+        x ^= long(hexlify(fragment.ljust(MTU, '\0')), 16)
+    return unhexlify('%0*x' % (2 * MTU, x))
+
+def encode_parity(fragments):
+    length = 0
+    for fragment in fragments:
+        length ^= len(fragment)
+    return fec_length.pack(length) + xor_fragments(fragments)
+
+def encode_ack(binary, sack, fromuid, touid, packet, bitmap):
+    """ 'bitmap' has a bit set for each received fragment """
+
+    if binary:
+        return binary_header.pack(BINARY_MAGIC, BINARY_TYPE_ACK,
+            unhexlify(fromuid), unhexlify(touid), packet) + bitmap
+    d = {
+        't': PACKET_ACK,
+        'from': fromuid,
+        'to': touid,
+        'packet': packet,
+        }
+    # Old senders only understand a list of fragment numbers
+    if sack:
+        d['sack'] = bitmap
+    else:
+        d['ack'] = decode_bitmap(bitmap)
+    return bencode(d)
+
+def decode_binary(data):
+    if len(data) < binary_header.size:
+        return None
+    (magic, t, fromuid, touid, packet) = binary_header.unpack_from(data)
+    d = {'from': hexlify(fromuid), 'to': hexlify(touid), 'packet': packet, 'binary': True}
+    if t == BINARY_TYPE_DATA:
+        if len(data) < binary_data_header.size:
+            return None
+        (magic, t, fromuid, touid, packet, frag, fragcount, flags) = binary_data_header.unpack_from(data)
+        d['t'] = PACKET_DATA
+        d['frag'] = frag
+        d['fragcount'] = fragcount
+        d['ack'] = (flags & BINARY_FLAG_ACK) != 0
+        d['fec'] = (flags & BINARY_FLAG_FEC) != 0
+        d['parity'] = (flags & BINARY_FLAG_PARITY) != 0
+        if flags & BINARY_FLAG_ZDICT:
+            d['compression'] = COMPRESS_ZDICT
+        elif flags & BINARY_FLAG_RAW:
+            d['compression'] = COMPRESS_NONE
+        else:
+            d['compression'] = COMPRESS_ZLIB
+        d['sack'] = True
+        d['payload'] = data[binary_data_header.size:]
+    elif t == BINARY_TYPE_ACK:
+        sack = data[binary_header.size:]
+        if len(sack) > (MAX_FRAGMENTS + 7) // 8:
+            return None
+        d['t'] = PACKET_ACK
+        d['acked'] = decode_bitmap(sack)
+    else:
+        return None
+    return d
+
+def decode_bencoded(data):
+    d = fmt_bdecode(packetspec, data)
+    if d == None:
+        return None
+    d['binary'] = False
+    if d['t'] == PACKET_DATA:
+        if not validate(dataspec, d):
+            return None
+        d['fec'] = False
+        d['parity'] = False
+        d['compression'] = COMPRESS_ZLIB
+    elif d['t'] == PACKET_ACK:
+        if not validate(ackspec, d):
+            return None
+        if d.has_key('sack'):
+            d['acked'] = decode_bitmap(d['sack'])
+        elif d.has_key('ack'):
+            d['acked'] = d['ack']
+        else:
+            return None
+    return d
+
+def decode_datagram(data):
+    """ Decode a fragment or an ack in either format. Returns a dictionary
+    in the bencoded layout, or None if the datagram is invalid. Acked
+    fragments are listed in 'acked'. """
+
+    if data[0:1] == BINARY_MAGIC:
+        return decode_binary(data)
+    return decode_bencoded(data)
+
+def get_zdict_compressor(level):
+    c = zcompressors.get(level)
+    if c == None:
+        c = zlib.compressobj(level, zlib.DEFLATED, ZDICT_WBITS, ZDICT_MEMLEVEL)
+        c.compress(zdict)
+        c.flush(zlib.Z_SYNC_FLUSH)
+        zcompressors[level] = c
+    return c
+
+def get_zdict_decompressor():
+    global zdecompressor
+    if zdecompressor == None:
+        c = zlib.compressobj(DEFAULT_COMPRESSION_LEVEL, zlib.DEFLATED, ZDICT_WBITS, ZDICT_MEMLEVEL)
+        zdecompressor = zlib.decompressobj(ZDICT_WBITS)
+        zdecompressor.decompress(c.compress(zdict) + c.flush(zlib.Z_SYNC_FLUSH))
+    return zdecompressor
+
+def compress_payload(payload, level, usezdict):
+    """ Returns (compression, data) """
+
+    if len(payload) < COMPRESS_THRESHOLD:
+        return (COMPRESS_NONE, payload)
+    if usezdict and len(payload) <= ZDICT_MAX_SIZE:
+        c = get_zdict_compressor(level).copy()
+        data = c.compress(payload) + c.flush()
+        compression = COMPRESS_ZDICT
+    else:
+        data = zlib.compress(payload, level)
+        compression = COMPRESS_ZLIB
+    if len(data) >= len(payload):
+        return (COMPRESS_NONE, payload)
+    return (compression, data)
+
+def decompress_payload(compression, data):
+    """ Returns the payload, or None if it is corrupt """
+
+    if compression == COMPRESS_NONE:
+        return data
+    if compression == COMPRESS_ZLIB:
+        dec = decompress_with_limit(data, TP_MAX_RECORD_SIZE)
+        if dec == None:
+            # The message is corrupt or not compressed. Decode anyway.
+            dec = data
+        return dec
+    d = get_zdict_decompressor().copy()
+    try:
+        dec = d.decompress(data, TP_MAX_RECORD_SIZE)
+    except zlib.error:
+        return None
+    if len(d.unconsumed_tail) > 0:
+        return None
+    return dec
+
+def get_peer(user):
+    peer = peers.get(user)
+    if peer == None:
+        peer = UDP_Peer(user)
+        peers[user] = peer
+    return peer
+
+class UDP_Peer:
+    """ Round trip time estimate, congestion window and retransmission
+    timer towards a user. Fragments of all packets to the user share the
+    window and the timer. """
+
+    def __init__(self, user):
+        self.user = user
+        self.srtt = None
+        self.rttvar = None
+        self.baserto = INITIAL_RTO
+        self.rto = INITIAL_RTO # baserto with exponential backoff
+        self.cwnd = INITIAL_CWND
+        self.ssthresh = MAX_CWND
+        self.inflight = 0
+        self.seq = 0           # Transmission sequence number
+        self.maxacked = -1     # Highest acked seq
+        self.recover = 0       # Losses before this seq do not shrink cwnd
+        self.probed = False
+        self.senders = deque() # Senders that have fragments to transmit
+        self.active = set()    # Senders that have fragments in flight
+        self.outq = []         # Datagrams to send in one batch
+        # Partially received packets, least recently progressed first
+        self.receivers = OrderedDict()
+        self.reassembly = 0    # Bytes in reassembly buffers
+        # Bit i is set iff packet maxcompleted - i has been received
+        self.completed = 0
+        self.maxcompleted = None
+        self.completedtime = None
+
+    def set_completed(self, packet):
+        now = monotonic_time()
+        if self.maxcompleted == None or now - self.completedtime > DUPLICATE_TIMEOUT:
+            self.completed = 1
+            self.maxcompleted = packet
+        else:
+            # Packet identifiers wrap at 32 bits
+            ahead = (packet - self.maxcompleted) & 0xffffffff
+            if ahead >= DUPLICATE_WINDOW and ahead < 0x80000000:
+                self.completed = 1
+                self.maxcompleted = packet
+            elif ahead < DUPLICATE_WINDOW:
+                self.completed = ((self.completed << ahead) | 1) & ((1 << DUPLICATE_WINDOW) - 1)
+                self.maxcompleted = packet
+            else:
+                behind = (self.maxcompleted - packet) & 0xffffffff
+                if behind < DUPLICATE_WINDOW:
+                    self.completed |= 1 << behind
+        self.completedtime = now
+
+    def reset_completed(self):
+        self.completed = 0
+        self.maxcompleted = None
+        self.completedtime = None
+
+    def is_completed(self, packet):
+        """ Returns True if the packet has been received recently """
+
+        behind = self.get_completed_age(packet)
+        return behind != None and behind < DUPLICATE_WINDOW and (self.completed & (1 << behind)) != 0
+
+    def is_stale(self, packet):
+        """ Returns True if the packet is too old to tell whether it has
+        been received """
+
+        behind = self.get_completed_age(packet)
+        return behind != None and behind >= DUPLICATE_WINDOW
+
+    def get_completed_age(self, packet):
+        if self.maxcompleted == None or monotonic_time() - self.completedtime > DUPLICATE_TIMEOUT:
+            return None
+        behind = (self.maxcompleted - packet) & 0xffffffff
+        if behind >= 0x80000000:
+            # Newer than any completed packet
+            return None
+        return behind
+
+    def add_rtt_sample(self, rtt):
+        if self.srtt == None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.baserto = min(max(self.srtt + 4 * self.rttvar, MIN_RTO), MAX_RTO)
+        self.rto = self.baserto
+
+    def acked(self, n):
+        # Under heavy loss most acks are for retransmitted fragments, which
+        # give no RTT samples. Drop the backoff anyway, since data flows.
+        self.rto = self.baserto
+        self.probed = False
+        self.inflight -= n
+        for i in xrange(n):
+            if self.cwnd < self.ssthresh:
+                self.cwnd += 1
+            else:
+                self.cwnd += 1.0 / self.cwnd
+        self.cwnd = min(self.cwnd, MAX_CWND)
+
+    def lost(self, seq):
+        """ A fragment transmitted with 'seq' was lost. The window is
+        halved once per window of data. """
+
+        self.inflight -= 1
+        if seq < self.recover:
+            return
+        self.ssthresh = max(int(self.cwnd) // 2, MIN_SSTHRESH)
+        self.cwnd = self.ssthresh
+        self.recover = self.seq
+
+    def detect_losses(self):
+        """ Fragments that were sent before an acked one are lost """
+
+        for sender in list(self.active):
+            sender.detect_losses(self.maxacked - REORDER_THRESHOLD)
+
+    def add_sender(self, sender):
+        if not sender.queued:
+            sender.queued = True
+            self.senders.append(sender)
+        self.send()
+
+    def send(self, force=False):
+        """ Transmit fragments of queued packets in round robin order
+        while the congestion window has room. If force is True, one
+        fragment is sent regardless of the window. """
+
+        while (force or self.inflight < int(self.cwnd)) and len(self.senders) > 0:
+            force = False
+            sender = self.senders.popleft()
+            if sender.send_next():
+                self.senders.append(sender)
+            else:
+                sender.queued = False
+        self.flush()
+
+    def flush(self):
+        if len(self.outq) > 0:
+            plugin.send_batch(self.user, self.outq)
+            self.outq = []
+
+    def arm_timer(self):
+        """ (Re)start the retransmission timer, or the probe timer if it
+        is sooner """
+
+        if len(self.active) == 0:
+            retransmit_timeouts.remove(self)
+            return
+        delay = self.rto
+        if not self.probed and self.srtt != None:
+            delay = min(delay, max(2 * self.srtt, MIN_PROBE_TIMEOUT))
+        retransmit_timeouts.add(self, delay)
+
+    def sent(self, sender):
+        self.active.add(sender)
+        if self not in retransmit_timeouts:
+            self.arm_timer()
+
+    def retry_timer(self):
+        now = monotonic_time()
+        for sender in list(self.active):
+            if now >= sender.deadline:
+                sender.cleanup(False)
+        if len(self.active) == 0:
+            return
+
+        if not self.probed and self.srtt != None:
+            # Probe with one fragment without reducing the window. New
+            # data is preferred. The ack tells which fragments are lost.
+            self.probed = True
+            if len(self.senders) > 0:
+                self.send(force=True)
+            else:
+                iter(self.active).next().probe()
+                self.flush()
+            self.arm_timer()
+            return
+
+        # Retransmit everything that is in flight
+        n = 0
+        for sender in list(self.active):
+            n += sender.retransmit()
+        self.active.clear()
+        self.inflight -= n
+        self.ssthresh = max(int(self.cwnd) // 2, MIN_SSTHRESH)
+        self.cwnd = 1
+        self.rto = min(2 * self.rto, MAX_RTO)
+        self.recover = self.seq
+        # Probe again before the next timeout
+        self.probed = False
+        self.send()
+        self.arm_timer()
+
 class UDP_Sender:
-    def __init__(self, user, packet, fragments, retries, first=True, ack=False):
+    """ Sends a packet without acks. All fragments and parity fragments
+    are sent at once, and sent again 'retries' times, one retransmission
+    timeout apart. If user is None, the packet is sent to the multicast
+    group. """
+
+    def __init__(self, user, packet, fragments, parity, retries):
         self.user = user
         self.packet = packet   # Packet identifier number
-        self.fragments = fragments # Fragments that are not yet acked
+        self.fragments = fragments
+        self.parity = parity
         self.fragcount = len(fragments)
         self.retries = retries
-        self.ack = ack
+        self.peer = None
+        if user != None:
+            self.peer = get_peer(user)
 
-        if first:
-            self.send_fragments()
-
-        self.retrytag = timeout_add(RETRY_INTERVAL * 1000, self.retry_timer)
+        self.send_fragments()
+        retransmit_timeouts.add(self, self.get_rto())
 
     def cleanup(self, success):
-        if self.retrytag != None:
-            source_remove(self.retrytag)
-            self.retrytag = None
+        retransmit_timeouts.remove(self)
+
+    def get_rto(self):
+        if self.peer == None:
+            return INITIAL_RTO
+        return self.peer.rto
 
     def send_fragments(self):
         debug('%d send frag %s\n' % (self.packet, str(self.fragments.keys())))
-        for frag, data in self.fragments.items():
-            plugin.send_lowlevel(self.user, data)
+        datagrams = self.fragments.values() + self.parity.values()
+        if self.user == None:
+            plugin.send_multicast(datagrams)
+        else:
+            plugin.send_batch(self.user, datagrams)
 
     def retry_timer(self):
         if self.retries == 0:
             self.cleanup(False)
-            return False
-
+            return
         self.send_fragments()
-
         self.retries -= 1
-        return True
-
-class UDP_Sender_With_Ack(UDP_Sender):
-    def __init__(self, user, packet, fragments, retries, cb, ctx, first=True):
-        UDP_Sender.__init__(self, user, packet, fragments, retries, first, True)
+        retransmit_timeouts.add(self, self.get_rto())
+
+class UDP_Sender_With_Ack:
+    """ Sends a packet reliably. Fragments are paced by the peer's
+    congestion window, and acked fragments open room for new ones.
+    Acks carry a bitmap of received fragments, so a lost fragment is
+    retransmitted as soon as a later fragment is acked. Otherwise the
+    peer's retransmission timer resends fragments in flight. The send
+    fails if no fragment is acked within (retries + 1) * RETRY_INTERVAL
+    seconds.
+
+    The parity fragment of a group is sent once, after the first
+    transmission of the group. A fragment with parity is not declared
+    lost before a fragment sent after the parity is acked, since the
+    receiver may rebuild it. """
+
+    def __init__(self, user, packet, fragments, parity, retries, cb, ctx):
+        self.user = user
+        self.packet = packet   # Packet identifier number
+        self.fragments = fragments # Fragments that are not yet acked
+        self.parity = parity   # group -> parity fragment
+        self.parityseq = {}    # group -> peer seq after the parity
+        self.fragcount = len(fragments)
+        self.retries = retries
         self.cb = cb
         self.ctx = ctx
+        self.peer = get_peer(user)
+
+        self.unsent = deque(xrange(self.fragcount))
+        self.inflight = {}     # frag -> (peer seq, send time, transmissions)
+        self.transmissions = {}
+        self.queued = False
+        self.done = False
+        self.set_deadline()
 
         key = (self.user, self.packet)
         global pending_sends
         pending_sends[key] = self
 
+        self.peer.add_sender(self)
+
     def cleanup(self, success):
         global pending_sends
 
         key = (self.user, self.packet)
         pending_sends.pop(key)
 
+        self.done = True
+        self.peer.inflight -= len(self.inflight)
+        self.inflight = {}
+        self.peer.active.discard(self)
+
         if self.cb != None:
             self.cb(self.user, self.ctx, success)
 
-        UDP_Sender.cleanup(self, success)
+        self.peer.send()
+        self.peer.arm_timer()
+
+    def set_deadline(self):
+        self.deadline = monotonic_time() + (self.retries + 1) * RETRY_INTERVAL
+
+    def transmit(self, frag):
+        n = self.transmissions.get(frag, 0) + 1
+        self.transmissions[frag] = n
+        self.inflight[frag] = (self.peer.seq, monotonic_time(), n)
+        self.peer.seq += 1
+        debug('%d send frag %d\n' % (self.packet, frag))
+        # The peer sends queued fragments in one batch
+        self.peer.outq.append(self.fragments[frag])
+
+        group = frag // FEC_GROUP
+        if n == 1 and self.parity.has_key(group) and \
+           ((frag % FEC_GROUP) == FEC_GROUP - 1 or frag == self.fragcount - 1):
+            debug('%d send parity %d\n' % (self.packet, group))
+            self.peer.outq.append(self.parity[group])
+            self.parityseq[group] = self.peer.seq
+
+    def send_next(self):
+        """ Transmit one fragment. Returns True iff more fragments are
+        waiting for transmission. """
+
+        while len(self.unsent) > 0 and not self.done:
+            frag = self.unsent.popleft()
+            if not self.fragments.has_key(frag) or self.inflight.has_key(frag):
+                continue
+            self.transmit(frag)
+            self.peer.inflight += 1
+            self.peer.sent(self)
+            break
+        return len(self.unsent) > 0 and not self.done
+
+    def probe(self):
+        """ Send the last fragment in flight again """
+
+        (seq, frag) = max(map(lambda (frag, sent): (sent[0], frag), self.inflight.items()))
+        self.transmit(frag)
+
+    def retransmit(self):
+        """ Queue all fragments in flight for retransmission. Returns the
+        number of fragments. """
+
+        lost = self.inflight.keys()
+        lost.sort()
+        self.inflight = {}
+        self.unsent.extendleft(reversed(lost))
+        if len(lost) > 0 and not self.queued:
+            self.queued = True
+            self.peer.senders.appendleft(self)
+        return len(lost)
+
+    def detect_losses(self, maxseq):
+        """ Queue fragments sent at or before 'maxseq' for retransmission """
+
+        lost = []
+        for (frag, (seq, t, n)) in self.inflight.items():
+            if seq <= maxseq and not self.may_recover(frag, maxseq):
+                lost.append((seq, frag))
+        if len(lost) == 0:
+            return
+        lost.sort()
+        for (seq, frag) in lost:
+            debug('%d lost %d\n' % (self.packet, frag))
+            self.inflight.pop(frag)
+            self.peer.lost(seq)
+        self.unsent.extendleft(reversed(map(lambda (seq, frag): frag, lost)))
+        if len(self.inflight) == 0:
+            self.peer.active.discard(self)
+        if not self.queued:
+            self.queued = True
+            self.peer.senders.append(self)
+
+    def may_recover(self, frag, maxseq):
+        """ Returns True if the receiver may still rebuild 'frag' from the
+        parity of its group """
+
+        group = frag // FEC_GROUP
+        if not self.parity.has_key(group):
+            return False
+        seq = self.parityseq.get(group)
+        return seq == None or seq > maxseq
+
+    def handle_ack(self, acked):
+        now = monotonic_time()
+        nacked = 0
+        rttsample = None
+        for frag in acked:
+            if self.fragments.pop(frag, None) == None:
+                continue
+            debug('%d acked %d\n' % (self.packet, frag))
+            sent = self.inflight.pop(frag, None)
+            if sent == None:
+                # Acked after it was declared lost
+                continue
+            (seq, t, n) = sent
+            nacked += 1
+            if seq > self.peer.maxacked:
+                self.peer.maxacked = seq
+                # Karn's algorithm: skip retransmitted fragments
+                if n == 1:
+                    rttsample = now - t
+
+        if nacked == 0:
+            if len(self.fragments) == 0:
+                self.cleanup(True)
+            return
 
-    def handle_ack(self, d):
-        for frag in d['ack']:
-            if frag in self.fragments:
-                debug('%d acked %d\n' % (self.packet, frag))
-                self.fragments.pop(frag)
+        if rttsample != None:
+            self.peer.add_rtt_sample(rttsample)
+        self.peer.acked(nacked)
+        self.set_deadline()
 
         if len(self.fragments) == 0:    # All fragments acked
             debug('%d sent!\n' % (self.packet))
             self.cleanup(True)
+        elif len(self.inflight) == 0:
+            self.peer.active.discard(self)
+
+        self.peer.detect_losses()
+        self.peer.send()
+        # Restart the retransmission timer, since data is flowing
+        self.peer.arm_timer()
+
+def evict_receivers(peer, size):
+    """ Drop partially received packets until a new buffer of 'size'
+    bytes fits the quota of 'peer' and the global budget. Returns False
+    if it can not fit. """
+
+    if size > PEER_REASSEMBLY_QUOTA:
+        return False
+    while peer.reassembly + size > PEER_REASSEMBLY_QUOTA:
+        peer.receivers.itervalues().next().evict()
+    while reassembly_bytes + size > REASSEMBLY_BUDGET:
+        victim = max(peers.itervalues(), key=lambda p: p.reassembly)
+        victim.receivers.itervalues().next().evict()
+    return True
 
 class UDP_Receiver:
-    def __init__(self, user, packet):
+    """ Fragments are copied into a buffer at offset frag * MTU, and a
+    bitmap records which fragments have arrived. Every fragment but the
+    last one must be exactly MTU bytes. When the packet completes, the
+    receiver is replaced with a UDP_Completed stub, and the packet is
+    recorded to the peer's completed packets.
+
+    If the packet has parity fragments, a missing fragment is rebuilt
+    when the rest of its group and the parity have arrived. """
+
+    def __init__(self, user, packet, fragcount, ack, sack, binary, fec, compression):
         self.user = user
         self.packet = packet      # Packet identifier number
-        self.fragments = {}
-        self.fragcount = None
-        self.ack = True
-        self.acktag = None
+        self.fragcount = fragcount
+        self.ack = ack
+        self.sack = sack
+        self.binary = binary
+        self.fec = fec
+        self.compression = compression
+        self.parity = {}          # group -> parity payload
+        self.bitmap = bytearray((fragcount + 7) // 8)
+        self.received = 0
+        self.length = (fragcount - 1) * MTU
+        self.buf = None
+        self.size = 0             # Reserved bytes
+        self.peer = get_peer(user)
+        self.key = (user, packet)
+
+    def allocate(self):
+        """ Reserve a reassembly buffer. Returns False if the packet is
+        too large for the quota. """
+
+        global reassembly_bytes
+        size = self.fragcount * MTU
+        if self.fec:
+            ngroups = (self.fragcount + FEC_GROUP - 1) // FEC_GROUP
+            size += ngroups * (fec_length.size + MTU)
+        if not evict_receivers(self.peer, size):
+            return False
+        self.buf = bytearray(self.fragcount * MTU)
+        self.size = size
+        self.peer.reassembly += size
+        reassembly_bytes += size
+        self.peer.receivers[self.key] = self
+        pending_receives[self.key] = self
+        receive_timeouts.add(self.key, RECEIVE_TIMEOUT)
+        return True
 
-        self.timeouttag = timeout_add(RECEIVE_TIMEOUT * 1000, self.timeout)
+    def release(self):
+        global reassembly_bytes
+        if self.buf == None:
+            return
+        self.buf = None
+        self.parity = {}
+        self.peer.reassembly -= self.size
+        reassembly_bytes -= self.size
+        self.peer.receivers.pop(self.key, None)
+
+    def evict(self):
+        debug('%d evicted with %d/%d fragments\n' % (self.packet, self.received, self.fragcount))
+        self.release()
+        pending_receives.pop(self.key, None)
+        receive_timeouts.remove(self.key)
 
-        key = (self.user, self.packet)
-        global pending_receives
-        pending_receives[key] = self
+    def send_ack(self):
+        debug('%d send ack, %d fragments\n' % (self.packet, self.received))
+        data = encode_ack(self.binary, self.sack, community.get_myuid(),
+                          self.user.get('uid'), self.packet, str(self.bitmap))
+        plugin.send_lowlevel(self.user, data)
 
-    def remove_delayed_ack(self):
-        if self.acktag != None:
-            source_remove(self.acktag)
-            self.acktag = None
+    def has(self, frag):
+        return (self.bitmap[frag >> 3] & (1 << (frag & 7))) != 0
 
-    def timeout(self):
-        global pending_receives
+    def store(self, frag, payload):
+        self.bitmap[frag >> 3] |= 1 << (frag & 7)
+        self.received += 1
+        offset = frag * MTU
+        self.buf[offset:offset + len(payload)] = payload
+        if frag == self.fragcount - 1:
+            self.length += len(payload)
 
-        key = (self.user, self.packet)
-        pending_receives.pop(key)
-        self.remove_delayed_ack()
-        return False
+    def recover(self, group):
+        """ Rebuild the missing fragment of a group from the parity.
+        Returns True iff a fragment was rebuilt. """
 
-    def delayed_ack(self):
-        self.acktag = None
-        self.send_ack()
-        return False
+        parity = self.parity.get(group)
+        if parity == None:
+            return False
+        frags = xrange(group * FEC_GROUP, min((group + 1) * FEC_GROUP, self.fragcount))
+        missing = filter(lambda frag: not self.has(frag), frags)
+        if len(missing) != 1:
+            return False
+        lost = missing[0]
+
+        # Padding of the last fragment is zeros in the buffer
+        (length, ) = fec_length.unpack_from(parity)
+        x = long(hexlify(parity[fec_length.size:]), 16)
+        for frag in frags:
+            if frag == lost:
+                continue
+            if frag == self.fragcount - 1:
+                length ^= self.length - (self.fragcount - 1) * MTU
+            else:
+                length ^= MTU
+            x ^= long(hexlify(str(self.buf[frag * MTU:frag * MTU + MTU])), 16)
+        if length == 0 or length > MTU or (lost != self.fragcount - 1 and length != MTU):
+            warning('Invalid parity for packet %d\n' % (self.packet))
+            return False
 
-    def send_ack(self):
-        debug('%d send ack %s\n' % (self.packet, str(self.fragments.keys())))
-        data = bencode({
-            't': PACKET_ACK,
-            'from': community.get_myuid(),
-            'to': self.user.get('uid'),
-            'packet': self.packet,
-            'ack': self.fragments.keys()
-            })
-        plugin.send_lowlevel(self.user, data)
+        debug('%d recovered %d\n' % (self.packet, lost))
+        self.store(lost, unhexlify('%0*x' % (2 * MTU, x))[0:length])
+        return True
 
     def handle_data(self, d):
-        frag = d['frag']      # Fragment number
-        if self.fragcount == None:
-            self.fragcount = d['fragcount']
-            self.ack = d['ack']
-        elif self.fragcount != d['fragcount']:
+        frag = d['frag']      # Fragment number, or group number of parity
+        payload = d['payload']
+        if self.fragcount != d['fragcount']:
             warning('Invalid number of fragments %d\n' % d['fragcount'])
             return
+        if d.get('parity', False):
+            self.handle_parity(frag, payload)
+            return
         if frag >= self.fragcount:
             warning('Invalid fragment %d\n' % (frag))
             return
+        last = (frag == self.fragcount - 1)
+        if len(payload) > MTU or len(payload) == 0 or (not last and len(payload) != MTU):
+            warning('Invalid fragment size %d\n' % len(payload))
+            return
 
-        # Start timer to receive more fragments before sending the ack
-        if self.acktag == None and self.ack:
-            self.acktag = timeout_add(SEND_ACK_DELAY * 1000, self.delayed_ack)
-
-        if frag in self.fragments:     # Already received
+        # Restart timeout
+        receive_timeouts.add(self.key, RECEIVE_TIMEOUT)
+
+        # Each fragment is acked at once, so that acks clock the sender's
+        # window. A duplicate means that the previous ack was lost.
+        duplicate = self.has(frag)
+        if not duplicate:
+            self.store(frag, payload)
+            if self.fec:
+                self.recover(frag // FEC_GROUP)
+        if self.ack:
+            self.send_ack()
+        if duplicate:
             debug('%d duplicate %d\n' % (self.packet, frag))
             return
-        self.fragments[frag] = d['payload']
         debug('%d recv %d\n' % (self.packet, frag))
 
-        if len(self.fragments) == self.fragcount:
-            # All fragments received. Send ack instantly.
-            debug('%d received!\n' % (self.packet))
-            self.remove_delayed_ack()
-            if self.ack:
-                self.send_ack()
+        self.progress()
 
-            payload = ''
-            for frag in range(self.fragcount):
-                payload += self.fragments[frag]
+    def handle_parity(self, group, payload):
+        if not self.fec or group * FEC_GROUP >= self.fragcount or \
+           len(payload) != fec_length.size + MTU:
+            warning('Invalid parity %d\n' % (group))
+            return
+        if self.buf == None or self.parity.has_key(group):
+            # The packet is complete, or a duplicate parity
+            return
 
-            plugin.handle_packet(self.user, payload)
+        receive_timeouts.add(self.key, RECEIVE_TIMEOUT)
+        self.parity[group] = payload
+        if not self.recover(group):
+            return
+        if self.ack:
+            self.send_ack()
+        self.progress()
+
+    def progress(self):
+        if self.received < self.fragcount:
+            # Keep the least recently progressed packet first for eviction
+            receivers = self.peer.receivers
+            del receivers[self.key]
+            receivers[self.key] = self
+            return
 
-        # Restart timeout
-        source_remove(self.timeouttag)
-        self.timeouttag = timeout_add(RECEIVE_TIMEOUT * 1000, self.timeout)
+        # All fragments received
+        debug('%d received!\n' % (self.packet))
+        payload = str(self.buf[0:self.length])
+        self.release()
+        pending_receives[self.key] = UDP_Completed(self.key, self.packet)
+        receive_timeouts.add(self.key, RECEIVE_TIMEOUT)
+        self.peer.set_completed(self.packet)
+        plugin.handle_packet(self.user, payload, self.compression)
 
+class UDP_Completed:
+    """ A completed packet stays in pending_receives until its receive
+    timeout, so that duplicates from peers of any version are acked but
+    not handled again. The reassembly buffer is already released. """
 
-class UDP_Fetcher(Plugin):
-    packetspec = {
-        't': str,
-        'from': valid_uid,
-        'to': str,
-        }
+    def __init__(self, key, packet):
+        self.key = key
+        self.packet = packet
+
+    def release(self):
+        pass
+
+    def handle_data(self, d):
+        debug('%d duplicate packet\n' % (self.packet))
+        ack_completed(self.key[0], d)
+
+def ack_completed(user, d):
+    """ Ack every fragment of a completed packet, if the sender wants acks """
 
+    if d['ack']:
+        plugin.send_lowlevel(user, encode_ack(d['binary'],
+            d.get('sack', False), community.get_myuid(), user.get('uid'),
+            d['packet'], full_bitmap(d['fragcount'])))
+
+class UDP_Fetcher(Plugin):
     def __init__(self, options):
         if not options.udp_fetcher:
             return
 
         self.register_plugin(PLUGIN_TYPE_UDP_FETCHER)
         self.fetcher = None
-        self.packet = 0
+        self.sendsock = None
+        self.packet = randint(0, 0xffffffff)
         self.efficient_fetch_community = False
         self.packetloss = 0.0
+        self.fec = options.udp_fec
+        self.compression_level_setting = None
 
         self.handlers = {
             PACKET_DATA: self.got_data,
@@ -219,7 +1096,12 @@ class UDP_Fetcher(Plugin):
         self.fetcher = get_plugin_by_type(PLUGIN_TYPE_FETCHER)
         plugin = self
 
+        settings = get_plugin_by_type(PLUGIN_TYPE_SETTINGS)
+        self.compression_level_setting = settings.register('udpfetcher.compression_level', int, 'zlib compression level of UDP packets, 0-9', default=DEFAULT_COMPRESSION_LEVEL, validator=lambda x: type(x) == int and x >= 0 and x <= 9)
+
         self.create_udp_listener()
+        self.create_udp_sender()
+        self.create_multicast_listener()
 
     def create_udp_listener(self):
         port = community.get_rpc_port()
@@ -232,26 +1114,52 @@ class UDP_Fetcher(Plugin):
         rfd.setblocking(False)
         io_add_watch(rfd, IO_IN, self.udp_listener_read)
 
+    def create_multicast_listener(self):
+        """ Community fetches are only sent to the multicast group if we
+        can listen to it too """
+
+        if self.sendsock == None:
+            return
+        rfd = create_multicast_socket(TP_MULTICAST_GROUP, TP_MULTICAST_PORT)
+        if rfd == None:
+            warning('fetcher: Can not listen to multicast group %s port %d\n' % (TP_MULTICAST_GROUP, TP_MULTICAST_PORT))
+            return
+
+        rfd.setblocking(False)
+        io_add_watch(rfd, IO_IN, self.udp_listener_read)
+        self.efficient_fetch_community = True
+
+    def create_udp_sender(self):
+        """ All datagrams are sent through one socket. send_broadcast() is
+        used if the socket can not be created. """
+
+        self.sendsock = create_udp_socket('', 0, True)
+        if self.sendsock == None:
+            warning('fetcher: Can not create UDP socket for sending\n')
+            return
+        self.sendsock.setblocking(False)
+
     def udp_listener_read(self, rfd, condition):
-        try:
-            data, address = rfd.recvfrom(2048)
-        except socket.error, (errno, strerror):
-            ret = (errno == EAGAIN or errno == EINTR)
-            if not ret:
-                warning('Socket error (%s): %s\n' % (errno, strerror))
-            return ret
+        datagrams = recv_datagrams(rfd, 2048, MAX_READ_DATAGRAMS)
+        if datagrams == None:
+            return False
+        for (data, address) in datagrams:
+            self.handle_datagram(data)
+        return True
 
+    def handle_datagram(self, data):
         if self.packetloss > 0.0 and random() < self.packetloss:
-            return True
+            return
 
-        d = fmt_bdecode(self.packetspec, data)
+        d = decode_datagram(data)
         if d == None:
-            warning('fetcher: Received an invalid packet: %s\n' % data)
+            warning('fetcher: Received an invalid packet: %s\n' % repr(data))
             return
 
         if d['from'] == community.get_myuid():   # Received own packet
             return
-        if d['to'] != community.get_myuid():    # Packet not for me
+        if d['to'] != community.get_myuid() and d['to'] != MULTICAST_UID:
+            # Packet not for me
             return
 
         user = community.get_user(d['from'])
@@ -265,87 +1173,120 @@ class UDP_Fetcher(Plugin):
             return
 
         handler(user, d)
-        return True
 
     def got_data(self, user, d):
-        validator = {
-            'packet': int,
-            'frag': lambda i: is_unsigned_int('frag', i),
-            'fragcount': lambda i: is_unsigned_int('fragcount', i),
-            'payload': str,
-            'ack': bool,
-        }
-        if not validate(validator, d):
-            warning('fetcher: Invalid data packet %s\n' % str(d))
-            return
-
-        if d['fragcount'] > TP_MAX_RECORD_SIZE // MTU + 1:
-            warning('fetcher: Too large packet %d\n' % d['fragcount'])
-            return
-        if len(d['payload']) > MTU * 2:
-            warning('fetcher: Received too large fragment %d\n' % len(d['payload']))
+        if d['fragcount'] > MAX_FRAGMENTS or d['fragcount'] == 0:
+            warning('fetcher: Invalid number of fragments %d\n' % d['fragcount'])
             return
 
         key = (user, d['packet'])
         o = pending_receives.get(key)
+        peer = None
+        if o == None and user.get('protocolversion') >= DUPLICATE_VERSION:
+            peer = get_peer(user)
+        if peer != None:
+            if peer.is_completed(d['packet']):
+                # A retransmission after the receive timeout. The sender
+                # missed our acks.
+                debug('%d late duplicate packet\n' % (d['packet']))
+                ack_completed(user, d)
+                return
+            if peer.is_stale(d['packet']):
+                debug('%d stale packet\n' % (d['packet']))
+                return
+
         if o == None:
             # We have not yet received any fragments from this packet
-            o = UDP_Receiver(user, d['packet'])
+            o = UDP_Receiver(user, d['packet'], d['fragcount'], d['ack'],
+                             d.get('sack', False), d['binary'], d['fec'],
+                             d['compression'])
+            if not o.allocate():
+                warning('fetcher: No reassembly memory for packet %d\n' % d['packet'])
+                return
 
         o.handle_data(d)
 
     def got_ack(self, user, d):
-        validator = {
-            'packet': int,
-            'ack': [ONE_OR_MORE, lambda i: is_unsigned_int('ack', i)],
-        }
-        if not validate(validator, d):
-            warning('fetcher: Invalid ack packet %s\n' % str(d))
-            return
-
         key = (user, d['packet'])
         o = pending_sends.get(key)
         if o != None:
-            o.handle_ack(d)
+            o.handle_ack(d['acked'])
 
     def send_lowlevel(self, user, data):
+        self.send_batch(user, [data])
+
+    def send_batch(self, user, datagrams):
         ip = user.get('ip')
         port = user.get('port')
         if ip == None or port == None:
             warning('fetcher: No ip/port to open %s\n' % (user.tag()))
             return
-        send_broadcast(ip, port, data)
+        if self.sendsock == None:
+            for data in datagrams:
+                send_broadcast(ip, port, data)
+            return
+        send_datagrams(self.sendsock, ip, port, datagrams)
 
-    def send_packet(self, user, payload, cb, ctx=None, ack=True):
-        payload = zlib.compress(payload)
+    def send_multicast(self, datagrams):
+        if self.sendsock == None:
+            return
+        send_datagrams(self.sendsock, TP_MULTICAST_GROUP, TP_MULTICAST_PORT, datagrams)
+
+    def get_compression_level(self):
+        if self.compression_level_setting == None:
+            return DEFAULT_COMPRESSION_LEVEL
+        # The configuration file value is not validated
+        return min(max(self.compression_level_setting.value, 0), 9)
+
+    def fragment_packet(self, uid, payload, ack, binary, fec, usezdict):
+        """ Returns (fragments, parity) dictionaries of datagrams for
+        self.packet """
+
+        (compression, payload) = compress_payload(payload, self.get_compression_level(), usezdict)
 
         fragcount = (len(payload) + (MTU - 1)) // MTU
+        fec = fec and fragcount > 1
+        myuid = community.get_myuid()
+        chunks = map(lambda frag: payload[frag * MTU:frag * MTU + MTU], xrange(fragcount))
         fragments = {}
         for frag in range(fragcount):
-            fragments[frag] = bencode({
-                't': PACKET_DATA,
-                'from': community.get_myuid(),
-                'to': user.get('uid'),
-                'packet': self.packet,
-                'frag': frag,
-                'fragcount': fragcount,
-                'payload': payload[frag * MTU:frag * MTU + MTU],
-                'ack': ack
-                })
+            fragments[frag] = encode_data(binary, myuid, uid, self.packet,
+                frag, fragcount, ack, chunks[frag], fec=fec,
+                compression=compression)
+
+        # A group of one fragment gets no parity
+        parity = {}
+        if fec:
+            for group in xrange((fragcount + FEC_GROUP - 1) // FEC_GROUP):
+                groupchunks = chunks[group * FEC_GROUP:(group + 1) * FEC_GROUP]
+                if len(groupchunks) > 1:
+                    parity[group] = encode_data(binary, myuid, uid,
+                        self.packet, group, fragcount, ack,
+                        encode_parity(groupchunks), fec=True, parity=True,
+                        compression=compression)
+        return (fragments, parity)
+
+    def send_packet(self, user, payload, cb, ctx=None, ack=True):
+        version = user.get('protocolversion')
+        binary = version >= BINARY_HEADER_VERSION
+        fec = self.fec and version >= FEC_VERSION
+        usezdict = version >= ZDICT_VERSION
+        (fragments, parity) = self.fragment_packet(user.get('uid'), payload, ack, binary, fec, usezdict)
 
         if ack:
-            UDP_Sender_With_Ack(user, self.packet, fragments, MAX_RETRIES, cb, ctx)
+            UDP_Sender_With_Ack(user, self.packet, fragments, parity, MAX_RETRIES, cb, ctx)
         else:
             # send the packet twice
-            UDP_Sender(user, self.packet, fragments, 1)
+            UDP_Sender(user, self.packet, fragments, parity, 1)
 
-        self.packet += 1
+        # Binary headers have 32 bits for the packet number
+        self.packet = (self.packet + 1) & 0xffffffff
 
-    def handle_packet(self, user, payload):
-        dec = decompress_with_limit(payload, TP_MAX_RECORD_SIZE)
+    def handle_packet(self, user, payload, compression):
+        dec = decompress_payload(compression, payload)
         if dec == None:
-            # The message is corrupt or not compressed. Decode anyway.
-            dec = payload
+            warning('fetcher: Can not decompress a packet from %s\n' % user.tag())
+            return
 
         msg = self.fetcher.decode(dec)
         if msg == None:
@@ -356,11 +1297,33 @@ class UDP_Fetcher(Plugin):
 
         self.fetcher.handle_msg(user, msg)
 
-    def fetch_community(self, com, rtype, request, callback, ctx, retries, ack):
-        # Try to connect to every user individually.
+    def send_multicast_packet(self, payload, usezdict):
+        (fragments, parity) = self.fragment_packet(MULTICAST_UID, payload, False, True, self.fec, usezdict)
+        # send the packet twice
+        UDP_Sender(None, self.packet, fragments, parity, 1)
+        self.packet = (self.packet + 1) & 0xffffffff
+
+    def fetch_community(self, com, rtype, request, callback, ctx, retries, ack, priority):
         # Note, myself is not considered an active user.
-        for user in community.get_community_members(com):
-            self.fetcher.fetch(user, rtype, request, callback, ctx=ctx, retries=retries, ack=ack)
+        members = community.get_community_members(com)
+
+        # Requests with replies and requests to personal communities are
+        # sent to every user individually
+        if ack or not self.efficient_fetch_community or not com.get('peer'):
+            multicast = set()
+        else:
+            multicast = set(filter(lambda user: user.get('protocolversion') >= MULTICAST_VERSION, members))
+
+        for user in members:
+            if user not in multicast:
+                self.fetcher.fetch(user, rtype, request, callback, ctx=ctx, retries=retries, ack=ack, priority=priority)
+
+        if len(multicast) > 0:
+            payload = self.fetcher.encode(request, -1, rtype)
+            if payload != None:
+                # Every member must know the dictionary
+                usezdict = min(map(lambda user: user.get('protocolversion'), multicast)) >= ZDICT_VERSION
+                self.send_multicast_packet(payload, usezdict)
         return True
 
     def send_request(self, user, req):
@@ -374,12 +1337,528 @@ class UDP_Fetcher(Plugin):
 
         if req.retry():
             debug('Retrying fetch to %s\n' % user.tag())
-            self.fetch(user, req)
+            self.send_request(user, req)
         else:
             req.call(user, None)
 
     def send_reply(self, user, rid, payload):
         self.send_packet(user, payload, None)
 
+    def user_changes(self, user, what=None):
+        if what != None and what[0] == PROTOCOL_VERSION_CHANGED:
+            peer = peers.get(user)
+            if peer != None:
+                peer.reset_completed()
+
+    def user_disappears(self, user):
+        # A user that appears again gets a new peer, since it may have
+        # restarted. Senders in progress keep the old peer until they end.
+        peer = peers.pop(user, None)
+        if peer != None:
+            for o in peer.receivers.values():
+                o.evict()
+
 def init(options):
     UDP_Fetcher(options)
+
+def test_bitmap():
+    assert(decode_bitmap(encode_bitmap([], 0)) == [])
+    assert(encode_bitmap([0, 9], 10) == '\x01\x02')
+    assert(decode_bitmap(encode_bitmap([0, 7, 8, 1024], MAX_FRAGMENTS)) == [0, 7, 8, 1024])
+    assert(len(encode_bitmap([], MAX_FRAGMENTS)) == (MAX_FRAGMENTS + 7) // 8)
+
+def test_datagrams():
+    a = 'a' * 16
+    b = '0123456789abcdef'
+    for binary in (True, False):
+        data = encode_data(binary, a, b, 7, 2, 3, True, 'payload')
+        d = decode_datagram(data)
+        assert(d['t'] == PACKET_DATA and d['from'] == a and d['to'] == b)
+        assert(d['packet'] == 7 and d['frag'] == 2 and d['fragcount'] == 3)
+        assert(d['ack'] and d['sack'] and d['payload'] == 'payload')
+        assert(d['binary'] == binary)
+        assert(not d['fec'] and not d['parity'])
+
+        d = decode_datagram(encode_ack(binary, True, b, a, 7, encode_bitmap([0, 2], 3)))
+        assert(d['t'] == PACKET_ACK and d['from'] == b and d['to'] == a)
+        assert(d['packet'] == 7 and d['acked'] == [0, 2])
+
+    d = decode_datagram(encode_data(True, a, b, 7, 1, 3, False, 'p', fec=True, parity=True))
+    assert(d['fec'] and d['parity'] and not d['ack'])
+
+    d = decode_datagram(encode_ack(False, False, b, a, 7, encode_bitmap([0, 2], 3)))
+    assert(d['acked'] == [0, 2])
+    assert(decode_datagram(BINARY_MAGIC + 'short') == None)
+    assert(decode_datagram('') == None)
+
+def test_duplicates():
+    peer = UDP_Peer(None)
+    assert(not peer.is_completed(5) and not peer.is_stale(5))
+    for packet in (0xfffffffe, 0, 2, 1):
+        peer.set_completed(packet)
+    for packet in (0xfffffffe, 0, 1, 2):
+        assert(peer.is_completed(packet))
+    assert(not peer.is_completed(0xffffffff) and not peer.is_completed(3))
+    assert(not peer.is_stale(0xffffffff) and not peer.is_stale(3))
+    peer.set_completed(DUPLICATE_WINDOW + 1)
+    assert(peer.is_completed(2) and not peer.is_completed(1))
+    assert(peer.is_stale(1) and not peer.is_stale(2))
+    peer.set_completed(0x80000000)
+    assert(not peer.is_completed(2) and peer.is_stale(2))
+    assert(full_bitmap(10) == encode_bitmap(range(10), 10))
+    assert(full_bitmap(16) == encode_bitmap(range(16), 16))
+
+def test_restart():
+    """ Duplicates of a completed packet are dropped until the receive
+    timeout. After that, only peers of at least DUPLICATE_VERSION are
+    checked against completed packets. Older peers number packets from 0
+    again after a restart, which must not be mistaken for duplicates. """
+
+    global community, plugin
+    from user import User
+
+    class Test_Community:
+        def get_myuid(self):
+            return 'f' * 16
+
+    class Options:
+        # The plugin is not registered. Only got_data() is used.
+        udp_fetcher = False
+
+    received = []
+    acks = []
+    oldcommunity = community
+    oldplugin = plugin
+    community = Test_Community()
+    plugin = UDP_Fetcher(Options())
+    plugin.handle_packet = lambda user, payload, compression: received.append(payload)
+    plugin.send_lowlevel = lambda user, data: acks.append(data)
+
+    user = User()
+    user.set('uid', 'a' * 16)
+
+    def send(packet, payload, ack=True):
+        data = encode_data(True, user.get('uid'), 'f' * 16, packet, 0, 1,
+                           ack, payload, compression=COMPRESS_NONE)
+        plugin.got_data(user, decode_datagram(data))
+
+    def expire():
+        # RECEIVE_TIMEOUT passes
+        for key in pending_receives.keys():
+            receive_timeouts.remove(key)
+            receive_timeout(key)
+
+    # A no-ack packet is sent twice, and an acked one may be retransmitted
+    for version in (0, DUPLICATE_VERSION):
+        user.set('protocolversion', version)
+        send(9, 'x', ack=False)
+        send(9, 'x', ack=False)
+        send(10, 'y')
+        send(10, 'y')
+        assert(received == ['x', 'y'])
+        assert(len(acks) == 2 and decode_datagram(acks[1])['acked'] == [0])
+        del received[:]
+        del acks[:]
+        expire()
+        plugin.user_disappears(user)
+
+    for version in (DUPLICATE_VERSION - 1, 0):
+        user.set('protocolversion', version)
+        send(0, 'a')
+        send(1, 'b')
+        expire()
+        # Restart
+        send(0, 'c')
+        send(1, 'd')
+        expire()
+    assert(received == ['a', 'b', 'c', 'd'] * 2)
+
+    # A late retransmission from a new peer is acked, but not handled
+    user.set('protocolversion', DUPLICATE_VERSION)
+    del received[:]
+    del acks[:]
+    send(7, 'e')
+    expire()
+    send(7, 'e')
+    assert(received == ['e'] and len(acks) == 2)
+
+    # A departing user releases its reassembly buffers
+    data = encode_data(True, user.get('uid'), 'f' * 16, 8, 0, 2, True,
+                       'x' * MTU, compression=COMPRESS_NONE)
+    plugin.got_data(user, decode_datagram(data))
+    assert(reassembly_bytes > 0)
+    plugin.user_disappears(user)
+    assert(not peers.has_key(user) and reassembly_bytes == 0)
+    send(7, 'f')
+    assert(received == ['e', 'f'])
+
+    # Announcing another protocol version forgets completed packets
+    expire()
+    plugin.user_changes(user, (PROTOCOL_VERSION_CHANGED, DUPLICATE_VERSION))
+    send(7, 'g')
+    assert(received == ['e', 'f', 'g'])
+
+    expire()
+    receive_timeouts.arm()
+    peers.clear()
+    community = oldcommunity
+    plugin = oldplugin
+
+def test_reassembly():
+    """ Reassemble out of order fragments, rebuild lost fragments from
+    parity, and check that the memory budget holds with many partial
+    packets from two users """
+
+    global plugin
+    received = []
+    class Test_Plugin:
+        def handle_packet(self, user, payload, compression):
+            received.append(payload)
+    oldplugin = plugin
+    plugin = Test_Plugin()
+
+    def fragment(user, packet, frag, fragcount, payload, fec=False, parity=False):
+        d = {'frag': frag, 'fragcount': fragcount, 'payload': payload, 'parity': parity}
+        o = pending_receives.get((user, packet))
+        if o == None:
+            o = UDP_Receiver(user, packet, fragcount, False, False, True, fec, COMPRESS_NONE)
+            if not o.allocate():
+                return
+        o.handle_data(d)
+
+    data = ''.join(map(chr, xrange(256))) * 10
+    fragments = [data[i:i + MTU] for i in xrange(0, len(data), MTU)]
+    for frag in (2, 0, 0, 1):
+        fragment('a', 0, frag, len(fragments), fragments[frag])
+    assert(received == [data])
+    assert(reassembly_bytes == 0)
+
+    # Groups of 8 and 3 fragments, each missing one fragment. The parity
+    # of the first group arrives before the rest of the group.
+    data = data * 4 + 'tail'
+    fragments = [data[i:i + MTU] for i in xrange(0, len(data), MTU)]
+    assert(len(fragments) == FEC_GROUP + 3)
+    fragment('a', 1, 0, len(fragments), encode_parity(fragments[0:FEC_GROUP]), True, True)
+    for frag in range(0, 3) + range(4, len(fragments) - 1):
+        fragment('a', 1, frag, len(fragments), fragments[frag], True)
+    assert(len(received) == 1)
+    fragment('a', 1, 1, len(fragments), encode_parity(fragments[FEC_GROUP:]), True, True)
+    assert(received[-1] == data)
+    assert(reassembly_bytes == 0)
+
+    # Each packet misses its last fragment
+    fragcount = 64
+    for packet in xrange(2, 200):
+        for user in ('a', 'b'):
+            for frag in xrange(fragcount - 1):
+                fragment(user, packet, frag, fragcount, 'x' * MTU)
+            assert(get_peer(user).reassembly <= PEER_REASSEMBLY_QUOTA)
+    assert(reassembly_bytes <= REASSEMBLY_BUDGET)
+    assert(reassembly_bytes == get_peer('a').reassembly + get_peer('b').reassembly)
+    # The newest packets survive
+    fragment('a', 199, fragcount - 1, fragcount, 'y')
+    assert(received[-1] == 'x' * (MTU * (fragcount - 1)) + 'y')
+
+    for key in pending_receives.keys():
+        receive_timeouts.remove(key)
+        receive_timeout(key)
+    assert(reassembly_bytes == 0)
+    # Cancel the event loop timeout
+    receive_timeouts.arm()
+    peers.clear()
+    plugin = oldplugin
+
+def test_fetch_community(nmembers=20):
+    """ A no-ack community fetch is sent once to the multicast group, and
+    individually to old members """
+
+    global community, plugin
+    from user import User
+
+    members = []
+    for i in xrange(nmembers):
+        user = User()
+        user.set('uid', 'a%015x' % i)
+        user.set('protocolversion', MULTICAST_VERSION - (i == 0))
+        members.append(user)
+
+    class Test_Community:
+        def get_myuid(self):
+            return 'f' * 16
+        def get_community_members(self, com):
+            return members
+
+    class Test_Fetcher:
+        def __init__(self):
+            self.fetched = []
+        def fetch(self, user, rtype, request, callback, ctx=None, retries=0, ack=True, priority=None):
+            self.fetched.append(user)
+        def encode(self, msg, rid, rt):
+            msg['rid'] = rid
+            msg['rt'] = rt
+            return bencode(msg)
+
+    class Options:
+        udp_fetcher = True
+        udp_fec = False
+
+    class Test_Community_Profile:
+        def __init__(self, peer):
+            self.peer = peer
+        def get(self, name):
+            assert(name == 'peer')
+            return self.peer
+
+    multicast = []
+    oldcommunity = community
+    oldplugin = plugin
+    community = Test_Community()
+    plugin = UDP_Fetcher(Options())
+    plugin.fetcher = Test_Fetcher()
+    plugin.efficient_fetch_community = True
+    plugin.send_multicast = multicast.extend
+
+    request = {'t': 'msgpush', 'c': 'Proximate', 'msgs': ['x' * 4000]}
+    plugin.fetch_community(Test_Community_Profile(True), 'messageboard', request, None, None, 0, False, None)
+    assert(plugin.fetcher.fetched == [members[0]])
+    assert(len(multicast) > 0)
+    d = decode_datagram(multicast[0])
+    assert(d['to'] == MULTICAST_UID and not d['ack'])
+
+    # Acked fetches and personal communities are unicast
+    plugin.fetcher.fetched = []
+    plugin.fetch_community(Test_Community_Profile(True), 'messageboard', request, None, None, 0, True, None)
+    plugin.fetch_community(Test_Community_Profile(False), 'messageboard', request, None, None, 0, False, None)
+    assert(len(plugin.fetcher.fetched) == 2 * nmembers)
+
+    for sender in retransmit_timeouts.deadlines.keys():
+        retransmit_timeouts.remove(sender)
+    retransmit_timeouts.arm()
+    community = oldcommunity
+    plugin = oldplugin
+
+def test_compression():
+    for level in (1, DEFAULT_COMPRESSION_LEVEL, 9):
+        for usezdict in (False, True):
+            for payload in ('d1:ti0ee', bencode({'v': 0, 't': 'uprofile', 'c': '', 'rid': 5, 'rt': PLUGIN_TYPE_COMMUNITY, 'version': 1}), 'x' * 100000):
+                (compression, data) = compress_payload(payload, level, usezdict)
+                assert(decompress_payload(compression, data) == payload)
+    assert(compress_payload('d1:ti0ee', 6, True)[0] == COMPRESS_NONE)
+    assert(compress_payload('x' * 1000, 6, True)[0] == COMPRESS_ZDICT)
+    assert(compress_payload('x' * (ZDICT_MAX_SIZE + 1), 6, True)[0] == COMPRESS_ZLIB)
+    assert(decompress_payload(COMPRESS_ZDICT, 'garbage') == None)
+
+def benchmark_compression(n=10000):
+    """ Measure bytes on air (payload and binary headers) and the CPU
+    time of compressing and decompressing typical messages with plain
+    zlib at the default level, and with the adaptive method """
+
+    from time import time
+
+    uid = '3f2a9c01b7e4d588'
+    profile = {'uid': uid, 'nick': 'alice',
+        'communities': [DEFAULT_COMMUNITY_NAME, 'Helsinki'],
+        'faceversion': 2, 'fscounter': 5, 'status': 'Hacking',
+        'city': 'Helsinki', 'country': 'Finland', 'name': 'Alice',
+        'description': 'Coffee and mesh networks', 'languages': 'en fi'}
+    profile.update({'v': 0, 't': '', 'c': '', 'rid': 17, 'rt': ''})
+    meta = {'id': uid + ':12', 'src': uid, 'subject': 'Lunch?',
+        'msg': 'Anyone up for lunch at noon at the usual place?',
+        'timestart': '2011-05-04 11:00', 'keywords': ['food']}
+    messages = [
+        ('error reply', {'v': 0, 't': '', 'c': '', 'rid': 17, 'rt': '', 'rs': ''}),
+        ('uprofile', {'v': 0, 't': 'uprofile', 'c': '', 'rid': 17, 'rt': PLUGIN_TYPE_COMMUNITY, 'version': 3}),
+        ('profile reply', profile),
+        ('msg', {'v': 0, 't': 'msg', 'c': '', 'rid': 18, 'rt': PLUGIN_TYPE_MESSAGING, 'msg': 'See you at the station in 5 minutes'}),
+        ('msgpush', {'v': 0, 't': 'msgpush', 'c': DEFAULT_COMMUNITY_NAME, 'rid': -1, 'rt': PLUGIN_TYPE_MESSAGE_BOARD, 'msgs': [meta] * 3}),
+        ('query reply', {'v': 0, 't': '', 'c': '', 'rid': 19, 'rt': '', 'msgs': [meta] * 30}),
+        ]
+
+    def on_air(data):
+        return len(data) + ((len(data) + MTU - 1) // MTU) * binary_data_header.size
+
+    for (name, msg) in messages:
+        payload = bencode(msg)
+        results = []
+        for usezdict in (None, True):
+            t0 = time()
+            for i in xrange(n):
+                if usezdict == None:
+                    (compression, data) = (COMPRESS_ZLIB, zlib.compress(payload))
+                else:
+                    (compression, data) = compress_payload(payload, DEFAULT_COMPRESSION_LEVEL, usezdict)
+            tc = time() - t0
+            t0 = time()
+            for i in xrange(n):
+                decompress_payload(compression, data)
+            td = time() - t0
+            results.append((on_air(data), 1000000 * tc / n, 1000000 * td / n))
+        print '%-13s %6d B bencoded: zlib %6d B %6.1f + %5.1f us, adaptive %6d B %6.1f + %5.1f us' %((name, len(payload)) + results[0] + results[1])
+
+def benchmark_decode(n=100000):
+    """ Measure the cost of decoding a 1 KB data fragment with a bencoded
+    and a binary header """
+
+    from time import time
+
+    payload = 'x' * MTU
+    for binary in (False, True):
+        data = encode_data(binary, 'a' * 16, 'b' * 16, 12345, 17, 100, True, payload)
+        t0 = time()
+        for i in xrange(n):
+            decode_datagram(data)
+        dt = time() - t0
+        if binary:
+            name = 'binary'
+        else:
+            name = 'bencoded'
+        print '%s: %d header bytes, %.2f us per datagram' %(name, len(data) - MTU, 1000000 * dt / n)
+
+def benchmark(npackets=200, size=8 * 1024, concurrency=4, losses=(0.01, 0.05, 0.2), fecmodes=(False, True)):
+    """ Send 'npackets' reliable packets of 'size' random bytes to a
+    receiver in a child process over loopback. Both ends drop received
+    datagrams with the given probability using the packetloss knob.
+    Reports goodput and packet latency percentiles for each loss rate,
+    with and without parity fragments. """
+
+    import os
+    import signal
+    from socket import socket, AF_INET, SOCK_DGRAM
+    from time import sleep
+    from ioutils import Epoll_Event_Loop, get_event_loop, set_event_loop
+    from ossupport import xfork
+    from user import User
+
+    class Options:
+        udp_fetcher = True
+        udp_fec = False
+
+    class Benchmark_Community:
+        def __init__(self, myuid, port, peer):
+            self.myuid = myuid
+            self.port = port
+            self.peer = peer
+
+        def get_myuid(self):
+            return self.myuid
+
+        def get_rpc_port(self):
+            return self.port
+
+        def get_user(self, uid):
+            if uid == self.peer.get('uid'):
+                return self.peer
+            return None
+
+        def is_blacklisted(self, user):
+            return False
+
+    def free_port():
+        sock = socket(AF_INET, SOCK_DGRAM)
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        return port
+
+    def new_user(uid, port):
+        user = User()
+        user.set('uid', uid)
+        user.set('nick', uid[0:4])
+        user.set('ip', '127.0.0.1')
+        user.set('port', port)
+        user.set('protocolversion', PROXIMATE_PROTOCOL_VERSION)
+        return user
+
+    def start_node(myuid, port, peer, loss):
+        global community, plugin
+        community = Benchmark_Community(myuid, port, new_user(peer[0], peer[1]))
+        plugin = UDP_Fetcher(Options())
+        plugin.packetloss = loss
+        plugin.create_udp_listener()
+        plugin.create_udp_sender()
+        return community.peer
+
+    def run(loss, fec):
+        senderuid = 'a' * (64 // 4)
+        receiveruid = 'b' * (64 // 4)
+        senderport = free_port()
+        receiverport = free_port()
+
+        pid = xfork()
+        if pid == 0:
+            start_node(receiveruid, receiverport, (senderuid, senderport), loss)
+            plugin.handle_packet = lambda user, payload, compression: None
+            get_event_loop().run()
+            os._exit(0)
+        if pid < 0:
+            warning('benchmark: fork failed\n')
+            return
+        # Let the receiver bind its port
+        sleep(0.2)
+
+        user = start_node(senderuid, senderport, (receiveruid, receiverport), loss)
+        plugin.fec = fec
+        peers.clear()
+        loop = get_event_loop()
+        payloads = map(lambda i: os.urandom(size), xrange(concurrency))
+        latencies = []
+        failures = [0]
+        started = [0]
+
+        def send_next():
+            i = started[0]
+            started[0] += 1
+            plugin.send_packet(user, payloads[i % concurrency], done, monotonic_time())
+
+        def done(user, t0, success):
+            if success:
+                latencies.append(monotonic_time() - t0)
+            else:
+                failures[0] += 1
+            if started[0] < npackets:
+                send_next()
+
+        t0 = monotonic_time()
+        for i in xrange(min(concurrency, npackets)):
+            send_next()
+        while len(latencies) + failures[0] < npackets:
+            loop.iteration()
+        dt = max(monotonic_time() - t0, 1e-6)
+
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+
+        latencies.sort()
+        def percentile(p):
+            if len(latencies) == 0:
+                return 0.0
+            return 1000 * latencies[min(len(latencies) - 1, int(p * len(latencies)))]
+
+        peer = get_peer(user)
+        if fec:
+            mode = 'fec'
+        else:
+            mode = '   '
+        print '%4.1f%% loss %s: %7.1f KiB/s goodput, latency p50 %6.1f ms p99 %7.1f ms max %7.1f ms, %d failed, srtt %.1f ms cwnd %.1f' %(
+            100 * loss, mode, len(latencies) * size / 1024.0 / dt, percentile(0.5),
+            percentile(0.99), percentile(1.0), failures[0],
+            1000 * (peer.srtt or 0), peer.cwnd)
+
+    set_event_loop(Epoll_Event_Loop())
+    for loss in losses:
+        for fec in fecmodes:
+            run(loss, fec)
+
+if __name__ == '__main__':
+    from ioutils import Epoll_Event_Loop, set_event_loop
+    set_event_loop(Epoll_Event_Loop())
+    test_bitmap()
+    test_datagrams()
+    test_duplicates()
+    test_restart()
+    test_reassembly()
+    test_fetch_community()
+    test_compression()
+    benchmark_compression()
+    benchmark_decode()
+    benchmark()
@@ -17,7 +17,7 @@ from proximateprotocol import valid_cid, valid_community, \
      valid_nick, valid_status, TP_NICK_DEFAULT, \
      valid_port, valid_protocol_version, valid_uid, \
      DEFAULT_COMMUNITY_NAME, FRIENDS_COMMUNITY_NAME, \
-     MAX_USER_INACTIVITY_TIME, PROXIMATE_PROTOCOL_VERSION
+     MAX_USER_INACTIVITY_TIME
 from utils import relative_time_string
 
 # Meta attributes are defined as class variables. That is, each instance
@@ -60,7 +60,8 @@ userattributes['myfaceversion'] = privateunsignedint()
 # Private non-saved attributes
 userattributes['ip'] = Meta_Attribute(str, public=False, save=False, is_valid=lambda n, v: valid_ip(v))
 userattributes['port'] = Meta_Attribute(int, public=False, save=False, is_valid=lambda n, v: valid_port(v))
-userattributes['protocolversion'] = Meta_Attribute(int, public=False, save=False, is_valid=lambda n, v: valid_protocol_version(v), default=PROXIMATE_PROTOCOL_VERSION)
+# Protocol version is known from the hello. Assume the oldest version before that.
+userattributes['protocolversion'] = Meta_Attribute(int, public=False, save=False, is_valid=lambda n, v: valid_protocol_version(v), default=0)
 
 userattributes['tempcommunities'] = Meta_Attribute(list, public=False, save=False, is_valid=lambda n, v: validate_list(v, valid_community), default=[])
 
@@ -69,8 +70,11 @@ userattributes['hops'] = Meta_Attribute(int, public=False, save=False, is_valid=
 userattributes['hophistory'] = Meta_Attribute(list, public=False, save=False)
 
 class User(Meta):
+    __slots__ = ['present', 'inprogress']
+
+    metaattributes = userattributes
+
     def __init__(self):
-        self.metaattributes = userattributes
         self.base_init()
 
         # Initialize per session information
@@ -155,10 +159,7 @@ class User(Meta):
         l = self.get('disappearances')
         if l == None:
             l = []
-        l.insert(0, time.time())
-        while len(l) > 3:
-            l.pop()
-        self.set('disappearances', l)
+        self.set('disappearances', [time.time()] + l[0:2])
 
     def tag(self):
         s = self.get('nick')
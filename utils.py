@@ -9,12 +9,12 @@
 # See the LICENSE file for more details.
 #
 from datetime import datetime, timedelta
-import gtk
 import random
 from time import localtime, strftime, time, mktime
-from gobject import timeout_add, GError
 import zlib
 
+from ioutils import timeout_add
+
 class ETA:
     """ A class for computing estimated time of arrival (ETA) """
 
@@ -76,7 +76,14 @@ class Rate_Limiter:
 
 def check_image(fname):
     """ Tries to open an image file. If GError exception is caught
-    returns False. """
+    returns False. Headless nodes do not have gtk. They do not show
+    images, so the image is accepted as it is. """
+
+    try:
+        import gtk
+        from gobject import GError
+    except ImportError:
+        return True
 
     try:
         image = gtk.gdk.pixbuf_new_from_file(fname)
@@ -11,14 +11,18 @@
 """
 Try to determine local IP and broadcast IP, report when IP changes
 """
-import dbus
-from dbus.mainloop.glib import DBusGMainLoop
-from dbus.exceptions import DBusException
+try:
+    import dbus
+    from dbus.mainloop.glib import DBusGMainLoop
+    from dbus.exceptions import DBusException
+except ImportError:
+    # Headless nodes may not have dbus. ICd is not used then.
+    dbus = None
 
 from plugins import Plugin, get_plugin_by_type
 from support import debug, info
 from utils import str_to_int
-from ioutils import get_ip_address
+from ioutils import get_ip_address, get_event_loop, GObject_Event_Loop
 from proximateprotocol import PLUGIN_TYPE_NETWORK_CONTROL, PLUGIN_TYPE_SCHEDULER
 
 POLL_INTERVAL = 5
@@ -83,6 +87,10 @@ class Network_Control(Plugin):
         sch.call_periodic(POLL_INTERVAL * sch.SECOND, self.periodic_poll)
 
     def initialize_icd(self):
+        # ICd signals are delivered through the gobject main loop
+        if dbus == None or not isinstance(get_event_loop(), GObject_Event_Loop):
+            return False
+
         DBusGMainLoop(set_as_default=True)
 
         self.system_bus = dbus.SystemBus()